@@ -54,6 +54,19 @@ AWS_SERVER_NAME = keys['aws']['bucket_name']
 AWS_KEY = keys["aws"]["key"]
 AWS_SECRET = keys["aws"]["secret"]
 
+# The S3 client is shared by every request in a process. Its connection
+# pool should be at least as big as the number of threads serving
+# requests. Timeouts are in seconds; retries back off between attempts.
+
+S3_MAX_POOL_CONNECTIONS = 20
+S3_CONNECT_TIMEOUT = 2
+S3_READ_TIMEOUT = 10
+S3_MAX_ATTEMPTS = 3
+
+# Point the client at an S3 stand-in (minio, moto server) instead of AWS.
+
+S3_ENDPOINT_URL = None
+
 USE_LOCAL_API = True
 
 # Turn S3 caching on and off
@@ -61,10 +74,94 @@ USE_LOCAL_API = True
 DONT_CHECK_CACHE = True
 DONT_CACHE = True
 
-# Profile versioning (for cache invalidation)
+# Profile versioning (for cache invalidation). Cached profiles are versioned
+# by a hash of the template and the release; bump this only when the code
+# that builds profiles changes their output.
 
 PROFILE_VERSION = '2021-0.1.0'
 
+# Serve out of date profiles (marked "profile_stale") while they're rebuilt
+# by a pool of background threads, instead of making the request wait for
+# the rebuild. BACKGROUND_WORKERS is the size of that pool.
+
+SERVE_STALE_PROFILES = True
+BACKGROUND_WORKERS = 2
+
+# Only one request builds a missing profile; the rest wait up to
+# BUILD_LOCK_TIMEOUT seconds for it. Locks between processes live in this
+# cache, so it has to be one they all share (memcached, redis) for that
+# part to work. BUILD_LOCK_TTL frees the lock of a process that died.
+
+BUILD_LOCK_CACHE = "default"
+BUILD_LOCK_TIMEOUT = 30
+BUILD_LOCK_TTL = 120
+
+# Geoids that fail to build are turned away without another attempt for
+# this many seconds, by reason (see ProfileFailureModes). Upstream
+# failures are kept short so the api coming back is noticed quickly.
+
+NEGATIVE_CACHE_TIMEOUTS = {
+    "UNKNOWN_GEOID": 60 * 60 * 24,
+    "EMPTY_DATA": 60 * 60,
+    "UPSTREAM_FAILURE": 30,
+}
+
+# When the profile version changes, each process rebuilds the profiles it
+# has served most often, this many per timeframe, in the background. 0
+# turns prewarming off.
+
+PREWARM_TOP_N = 100
+
+# How profiles are compressed in S3: "gzip", or "zstd" with the zstandard
+# package installed. None uses the codec's default level. Only gzip objects
+# can be passed straight through to clients. See benchmark_compression.
+
+PROFILE_CACHE_CODEC = "gzip"
+PROFILE_CACHE_COMPRESSION_LEVEL = None
+
+# Profile cache tiers in front of S3. The memory tier holds this many
+# profiles per process; the disk tier is off unless a directory is set.
+
+PROFILE_MEMORY_CACHE_SIZE = 256
+PROFILE_DISK_CACHE_DIR = None
+PROFILE_DISK_CACHE_BYTES = 512 * 1024 * 1024
+
+# Datapoint results memoized across profiles (mostly the shared parents)
+
+DATAPOINT_RESULT_CACHE_SIZE = 50_000
+
+# Populated designs are cached by (design, version, geoid, timeframe, data)
+# in their own cache, since one build writes hundreds of them and would
+# evict the template version, locks and sections from the default cache.
+# Set the timeout to 0 to turn the fragment cache off.
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "fragments": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "smartcharts-fragments",
+        "OPTIONS": {"MAX_ENTRIES": 20_000},
+    },
+}
+
+FRAGMENT_CACHE = "fragments"
+FRAGMENT_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Sections served on their own by the section endpoint are cached by
+# (geoid, timeframe, section, version). Set to 0 to turn this off.
+
+SECTION_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Populate the sections of large templates in a pool of worker processes.
+# 0, the default, keeps population serial: where it has been measured the
+# pool never beat the serial path. Run the benchmark_populate command on
+# the real hardware to see whether it pays for itself before turning it on.
+
+PARALLEL_POPULATE_WORKERS = 0
+PARALLEL_POPULATE_MIN_SECTIONS = 20
+
 
 
 # Application definition
@@ -1,15 +1,51 @@
 import json
+import logging
+
+import requests
+from django.conf import settings
 from smartcharts.models import DataPoint
+from smartcharts.api_client import ApiClient, HipApiError
 
 
 def add_preppred_datapoints():
+    points = []
     with open("prepared_datapoints.jsonl") as f:
         for line in f.readlines():
             obj = json.loads(line)
 
-            DataPoint.objects.create(
+            point = DataPoint(
                 identifier=obj["display_name"],
                 display_name=obj["title"],
                 lesp_code=obj["lesp_code"],
             )
 
+            # Validates the lesp_code and fills the stored tables / variables / cost
+            point.full_clean()
+            points.append(point)
+
+    try:
+        missing = set(
+            ApiClient(settings.API_URL).missing_tables(
+                [table for point in points for table in point.tables]
+            )
+        )
+    except (requests.exceptions.RequestException, HipApiError):
+        logging.warning("Skipped the catalog check", exc_info=True)
+        missing = set()
+    if missing:
+        raise ValueError(
+            "These datapoints read tables missing from the metadata catalog: "
+            + ", ".join(
+                f"{point.identifier} ({', '.join(sorted(missing & set(point.tables)))})"
+                for point in points
+                if missing & set(point.tables)
+            )
+        )
+
+    for point in points:
+        point.save()
+
+    print(
+        f"Loaded {len(points)} datapoints "
+        f"with a total cost of {sum(point.cost for point in points)} operations."
+    )
@@ -1,5 +1,12 @@
+import logging
+
+import requests
+from django import forms
+from django.conf import settings
 from django.contrib import admin
+from django.core.exceptions import ValidationError
 from adminsortable2.admin import SortableTabularInline, SortableAdminBase
+from .api_client import ApiClient, HipApiError
 from .models import (
     DataPoint,
     StatList,
@@ -13,9 +20,51 @@ from .models import (
 )
 
 
+logger = logging.getLogger(__name__)
+
+
+def check_tables_in_catalog(tables: list[str]):
+    # An api outage says nothing about the tables, so it shouldn't block
+    # the save; the check is skipped instead.
+    try:
+        missing = ApiClient(settings.API_URL).missing_tables(tables)
+    except (requests.exceptions.RequestException, HipApiError):
+        logger.warning(
+            "Skipped the catalog check for %s", tables, exc_info=True
+        )
+        return
+
+    if missing:
+        raise ValidationError(
+            {
+                "lesp_code": "These tables aren't in the metadata catalog: "
+                + ", ".join(missing)
+            }
+        )
+
+
+class DataPointForm(forms.ModelForm):
+    class Meta:
+        model = DataPoint
+        fields = ("identifier", "display_name", "lesp_code")
+
+    def _post_clean(self):
+        # Model.clean parses the program and fills tables / cost first
+        super()._post_clean()
+
+        if "lesp_code" not in self.errors:
+            try:
+                check_tables_in_catalog(self.instance.tables)
+            except ValidationError as e:
+                self._update_errors(e)
+
+
 @admin.register(DataPoint)
 class DataPointAdmin(admin.ModelAdmin):
-    pass
+    form = DataPointForm
+    list_display = ("identifier", "display_name", "tables", "cost")
+    readonly_fields = ("tables", "variables", "cost")
+    search_fields = ("identifier", "display_name", "table_dependencies__table_name")
 
 
 @admin.register(StatList)
@@ -72,5 +121,11 @@ class SectionInline(SortableTabularInline):
 
 @admin.register(Profile)
 class ProfileAdmin(SortableAdminBase, admin.ModelAdmin):
+    list_display = ("title", "estimated_cost")
+    readonly_fields = ("estimated_cost",)
     inlines = [SectionInline]
 
+    @admin.display(description="Estimated cost (lesp operations per geography)")
+    def estimated_cost(self, obj):
+        return obj.estimated_cost() if obj.pk else 0
+
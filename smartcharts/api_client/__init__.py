@@ -15,7 +15,7 @@ from ..metadata import (
     build_metadata_from_response,
 )
 from .geography import Geography, build_geo_response, build_geo_tree
-from .dispatch import request_manager
+from .dispatch import NotFound, request_manager
 from .reducer import collapse_several_responses
 
 
@@ -64,9 +64,12 @@ class ApiClient(object):
                 return Success(data)
             time.sleep(0.05)
         try:
-            return Failure(r.json().get("error"))
+            message = r.json().get("error")
         except requests.exceptions.JSONDecodeError:
-            return Failure(r.content)
+            message = r.content
+        if r.status_code == 404:
+            return Failure(NotFound(message))
+        return Failure(message)
 
     def get_parent_geoids(self, geoid):
         match self._get(
@@ -85,6 +88,26 @@ class ApiClient(object):
             case Failure(message):
                 raise HipApiError("Failed to get data for geoid: " + str(message))
 
+    def get_child_geoids(self, sumlevel: str, parent_geoid: str) -> list[str]:
+        """
+        Every geoid at the summary level inside the parent, like every
+        tract (140) in Michigan (04000US26).
+        """
+        match self._get(
+            f"/1.0/geo/show/tiger{settings.ACS_YEAR_NUMERIC}",
+            params={"geo_ids": f"{sumlevel}|{parent_geoid}"},
+        ):
+            case Success({"features": features}):
+                return [feature["properties"]["geoid"] for feature in features]
+
+            case Success(payload):
+                raise HipApiError(f"Unexpected geography listing: {payload}")
+
+            case Failure(message):
+                raise HipApiError(
+                    f"Failed to list {sumlevel} geographies in {parent_geoid}: {message}"
+                )
+
     def get_data(
         self,
         table_ids: list[str],
@@ -115,7 +138,7 @@ class ApiClient(object):
                     if str(message).startswith(
                         "(psycopg2.errors.UndefinedTable)"
                     ):
-                        _, error_table, _ = message.split('"')
+                        _, error_table, _ = str(message).split('"')
 
                         to_remove = error_table.split("_")[0]
                         problem_tables.append(to_remove.upper())
@@ -152,6 +175,39 @@ class ApiClient(object):
             f"Tried to remove {to_remove}, failed on attempt {i}: {str(message)}"
         )
 
+    def missing_tables(self, table_ids: list[str]) -> list[str]:
+        """
+        Checks each table against the D3 metadata catalog and then the
+        census table listing, returning the ones neither of them knows.
+        Only a 404 counts as unknown; any other failure raises HipApiError
+        because the api couldn't answer.
+        """
+        missing = []
+        for table_id in sorted(set(table_ids)):
+            match self._get(f"/metadata/tables/{table_id.lower()}", max_repairs=1):
+                case Success({"tables": tables}) if tables:
+                    continue
+                case Success(_) | Failure(NotFound()):
+                    pass
+                case Failure(message):
+                    raise HipApiError(
+                        f"Failed to look up {table_id} in the metadata catalog: "
+                        + str(message)
+                    )
+
+            match self._get(f"/1.0/table/{table_id.upper()}", max_repairs=1):
+                case Success(_):
+                    continue
+                case Failure(NotFound()):
+                    missing.append(table_id)
+                case Failure(message):
+                    raise HipApiError(
+                        f"Failed to look up {table_id} in the table listing: "
+                        + str(message)
+                    )
+
+        return missing
+
     def get_full_geography_object(self, geoid) -> Geography:
         """
         This is very awkward and needs a refactor.
@@ -186,7 +242,7 @@ class ApiClient(object):
                         root=True,
                     )
                 case _:
-                    raise TypeError("Something went wrong in the return from the geography call.")
+                    raise HipApiError("Something went wrong in the return from the geography call.")
 
         geography.parents = parents_tree
 
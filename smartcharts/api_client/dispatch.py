@@ -16,6 +16,19 @@ from aiohttp.http import HttpProcessingError
 from returns.result import Result, Success, Failure
 
 
+class NotFound(ValueError):
+    """
+    The api has nothing at this url (a 404), so there's no point retrying.
+    """
+
+
+class RetriesExhausted(ValueError):
+    """
+    The api kept failing, or kept answering with something that isn't
+    JSON, for every attempt at a url.
+    """
+
+
 """
 A request manager that is adapted from real python async io example.
 """
@@ -27,6 +40,9 @@ async def fetch_json(url: str, params: dict, session: ClientSession) -> Result[s
         params=params,
     )
 
+    if response.status == 404:
+        return Failure(NotFound(f"Nothing found at URL: {url}"))
+
     try:
         response.raise_for_status()
 
@@ -73,6 +89,9 @@ async def workflow(
         
         json_response = await fetch_json(url, params, session)
         match json_response:
+            case Failure(NotFound() as not_found):
+                raise not_found
+
             case Failure(_): # Can we use these messages more effectively?
                 attempts+=1
                 continue
@@ -88,7 +107,7 @@ async def workflow(
                     case Success(result):
                         return result
     
-    raise ValueError(json_response)
+    raise RetriesExhausted(json_response)
 
 
 async def worker(
@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class SmartchartsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "smartcharts"
+
+    def ready(self):
+        from .signals import connect_template_signals
+
+        connect_template_signals()
@@ -0,0 +1,88 @@
+"""
+Background Work
+
+A small pool of threads in this process for work a request shouldn't
+wait on, like rebuilding a stale profile after it's been served (see
+GeoProfileBuilder.serve_stale). Jobs are keyed, and a key that's already
+queued or running isn't queued again, so a burst of requests for the same
+stale profile schedules one rebuild.
+
+Nothing here survives a restart; a lost rebuild just happens again on
+the next request that finds the profile stale.
+"""
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from typing import Callable, Hashable
+import logging
+
+from django.conf import settings
+from django.db import close_old_connections
+
+
+logger = logging.getLogger(__name__)
+
+_pool: ThreadPoolExecutor | None = None
+_pending: set[Hashable] = set()
+_lock = Lock()
+
+
+def get_pool() -> ThreadPoolExecutor:
+    global _pool
+
+    with _lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(
+                max_workers=settings.BACKGROUND_WORKERS,
+                thread_name_prefix="smartcharts-background",
+            )
+        return _pool
+
+
+def shutdown_pool(wait: bool = True):
+    global _pool
+
+    with _lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=wait)
+
+
+def _run(key: Hashable, func: Callable, args, kwargs):
+    try:
+        return func(*args, **kwargs)
+    except Exception:
+        logger.exception(f"Background job {key} failed.")
+        raise
+    finally:
+        # Threads outside the request cycle have to tidy their own
+        close_old_connections()
+        with _lock:
+            _pending.discard(key)
+
+
+def schedule(key: Hashable, func: Callable, *args, **kwargs) -> Future | None:
+    """
+    Runs func in the background unless a job with this key is already
+    queued or running. Returns the job's future, or None if it was
+    skipped.
+    """
+    pool = get_pool()
+
+    with _lock:
+        if key in _pending:
+            return None
+        _pending.add(key)
+
+    try:
+        return pool.submit(_run, key, func, args, kwargs)
+    except RuntimeError:
+        # The pool is shutting down
+        with _lock:
+            _pending.discard(key)
+        return None
+
+
+def pending() -> int:
+    with _lock:
+        return len(_pending)
@@ -1,12 +1,28 @@
-from typing import Callable
+from typing import Callable, Collection
 import json
 
-from returns.result import Success, Failure
+from returns.result import Result, Success, Failure
 from django.utils.safestring import SafeString
 
 from .utils import LazyEncoder
-from .s3handler import CacheHandler
-from .profile import ProfileRequest
+from .s3handler import CacheHandler, StaleProfile
+from .profile import ProfileRequest, ProfileFailureModes
+from .negative_cache import NegativeCache
+from .popularity import PopularityTracker
+from .locks import BuildLock
+from . import background, metrics
+
+
+class ProfileUnavailable(Exception):
+    """
+    The profile can't be built for this geoid, for the given reason. If it
+    was remembered by the negative cache, retry_after is how long for.
+    """
+
+    def __init__(self, reason: ProfileFailureModes, retry_after: int = 0):
+        super().__init__(reason.name)
+        self.reason = reason
+        self.retry_after = retry_after
 
 
 class GeoProfileBuilder:
@@ -16,28 +32,215 @@ class GeoProfileBuilder:
         builder: Callable[[str], dict],
         enhancer: Callable[[dict], dict],
         logger,
+        partial_builder: Callable[[ProfileRequest, Collection[str]], Result] | None = None,
+        line_items: Callable[[ProfileRequest], dict | None] | None = None,
+        serve_stale: bool = False,
+        negative_cache: NegativeCache | None = None,
+        popularity: PopularityTracker | None = None,
+        profile_version: Callable[[ProfileRequest], str] | None = None,
     ):
+        """
+        With a partial_builder and line_items, cached profiles are brought up
+        to date by building only the designs that changed.
+
+        With serve_stale, an out of date profile is served as it is, marked
+        with "profile_stale", and brought up to date in the background.
+        """
         self.cache_handler = cache_handler
         self.builder = builder
         self.enhancer = enhancer
         self.logger = logger
+        self.partial_builder = partial_builder
+        self.line_items = line_items
+        self.serve_stale = serve_stale
+        self.negative_cache = negative_cache
+        self.popularity = popularity
+        self.profile_version = profile_version
 
     def build_geoid(self, request: ProfileRequest):
+        if (self.negative_cache is not None) and (
+            reason := self.negative_cache.check(request)
+        ):
+            raise ProfileUnavailable(reason, self.negative_cache.timeout_for(reason))
+
         result = self.cache_handler.check_cache(request)
+        self.track(request, hit=isinstance(result, Success))
 
         match result:
             case Success(profile):
-                return profile
+                # The template may have changed under the same version.
+                # Profiles that can't be patched are served as they are.
+                order = self.check_line_items(request, profile)
+                if not order:
+                    return profile
+
+                if (completed := self.complete_order(request, profile, order)) is not None:
+                    self.cache_handler.cache_profile(request, completed)
+                    return completed
+
+            case Failure(StaleProfile() as stale):
+                self.logger.warning(stale.message)
+
+                if self.serve_stale:
+                    return self.serve_stale_profile(request, stale)
+
+                return self.build_once(request, stale)
 
             case Failure(message):
                 self.logger.warning(message)
-                profile = self.run_builder(request)
-                self.cache_handler.cache_profile(request, profile)
 
-                return profile
-            
+        return self.build_once(request)
+
+    def build_once(self, request: ProfileRequest, stale: StaleProfile | None = None) -> dict:
+        """
+        Brings the profile up to date under a build lock, so concurrent
+        misses for one geoid (in any process) build it once. Requests that
+        waited take the profile the holder just cached. A request that
+        times out gets the stale profile if there is one, and otherwise
+        builds without the lock.
+        """
+        lock = BuildLock(f"{request.geoid.upper()}:{request.timeframe.value}")
+
+        with lock as acquired:
+            if acquired:
+                if lock.waited:
+                    match self.cache_handler.check_cache(request):
+                        case Success(profile):
+                            metrics.increment("build_lock.built_elsewhere")
+                            return profile
+                        case Failure(StaleProfile() as found):
+                            stale = found
+                return self.update_stale(request, stale)
+
+        self.logger.warning(f"Timed out waiting on the build of {request.geoid}.")
+        if stale is not None:
+            return {**stale.profile, "profile_stale": True}
+        return self.update_stale(request, None)
+
+    def update_stale(self, request: ProfileRequest, stale: StaleProfile | None) -> dict:
+        if (stale is not None) and (
+            (completed := self.complete_stale(request, stale)) is not None
+        ):
+            return completed
+        return self.rebuild(request)
+
+    def track(self, request: ProfileRequest, hit: bool):
+        if self.popularity is None:
+            return
+
+        key = (request.geoid.upper(), request.timeframe)
+        self.popularity.record(key)
+        self.popularity.measure(request.timeframe, key, hit)
+
+        if (self.profile_version is not None) and self.popularity.version_changed(
+            request.timeframe, self.profile_version(request)
+        ):
+            self.schedule_prewarm(request.timeframe)
+
+    def schedule_prewarm(self, timeframe) -> list[tuple]:
+        """
+        Queues background rebuilds of the most requested profiles in the
+        timeframe.
+        """
+        top = self.popularity.top(where=lambda key: key[1] == timeframe)
+        self.popularity.start_measuring(timeframe, top)
+        self.logger.info(f"Prewarming {len(top)} {timeframe.value} profiles.")
+
+        for geoid, _ in top:
+            # Keyed like revalidate, so a profile isn't queued by both
+            if background.schedule(
+                ("revalidate", geoid, timeframe),
+                self.prewarm,
+                ProfileRequest(geoid, timeframe),
+            ):
+                metrics.increment("prewarm.scheduled")
+
+        return top
+
+    def prewarm(self, request: ProfileRequest):
+        match self.cache_handler.check_cache(request):
+            case Success(_):
+                return
+            case Failure(StaleProfile() as stale):
+                pass
+            case Failure(_):
+                stale = None
+
+        try:
+            with metrics.timed("prewarm.build"):
+                self.build_once(request, stale)
+        except ProfileUnavailable as unavailable:
+            self.logger.warning(f"Couldn't prewarm {request.geoid}: {unavailable}")
+
+    def rebuild(self, request: ProfileRequest) -> dict:
+        profile = self.run_builder(request)
+        self.cache_handler.cache_profile(request, profile)
+
+        return profile
+
+    def complete_stale(self, request: ProfileRequest, stale: StaleProfile) -> dict | None:
+        """
+        Patches and caches a stale profile, or returns None if it has to be
+        built from scratch.
+        """
+        # Only download the stale profile if it can be patched
+        if self.partial_builder is None:
+            return None
+
+        order = self.check_line_items(request, stale.profile)
+        if order and (
+            (completed := self.complete_order(request, stale.profile, order))
+            is not None
+        ):
+            self.cache_handler.cache_profile(request, completed)
+            return completed
+
+        return None
+
+    def serve_stale_profile(self, request: ProfileRequest, stale: StaleProfile) -> dict:
+        profile = {**stale.profile, "profile_stale": True}
+        metrics.increment("profiles.served_stale")
+
+        background.schedule(
+            ("revalidate", request.geoid.upper(), request.timeframe),
+            self.revalidate,
+            request,
+            stale,
+        )
+
+        return profile
+
+    def revalidate(self, request: ProfileRequest, stale: StaleProfile) -> dict:
+        with metrics.timed("profiles.revalidate"):
+            return self.build_once(request, stale)
+
+
+    def check_cache_gzip(self, request: ProfileRequest) -> Result:
+        """
+        The cached profile as stored, for sending to the client untouched.
+        On a miss the caller falls back to build_geoid, which caches the
+        profile for next time.
+        """
+        return self.cache_handler.check_cache_gzip(request)
+
     def run_builder(self, request: ProfileRequest):
-        profile = self.builder(request)
+        match self.builder(request):
+            case Success(profile):
+                pass
+            case Failure(reason):
+                self.logger.warning(f"Couldn't build {request.geoid}: {reason}")
+                if not isinstance(reason, ProfileFailureModes):
+                    reason = ProfileFailureModes.NO_PROFILE_AVAILABLE
+
+                retry_after = 0
+                if (self.negative_cache is not None) and self.negative_cache.record(
+                    request, reason
+                ):
+                    retry_after = self.negative_cache.timeout_for(reason)
+                raise ProfileUnavailable(reason, retry_after)
+            case profile:
+                # Builders may also hand back the profile itself
+                pass
         
         ### THIS LOGIC SHOULD BE REFACTORED OUT TO THE PASSED BUILDER
         # handle this after combining sdc profile.py refactor
@@ -54,15 +257,94 @@ class GeoProfileBuilder:
         return profile
 
 
-    def check_line_items(self, profile_response):
+    def check_line_items(
+        self, request: ProfileRequest, profile_response: dict
+    ) -> list[str] | None:
         """
-        This will check the response from s3, look at the
-        structure and identify what's missing.
+        Compares a cached profile with the current template and returns
+        the paths of the designs that are missing or out of date. None
+        means the profile can't be patched (it predates line items, or
+        it's from another release or profile format) and has to be built
+        from scratch.
+
+        The whole profile_version isn't compared because it includes the
+        template version, which differs on every profile with something
+        to patch. Its other parts, the release and settings.PROFILE_VERSION,
+        are checked one by one instead.
         """
+        if (self.partial_builder is None) or (self.line_items is None):
+            return []
+
+        current = self.line_items(request)
+        if current is None:
+            return []
 
-    def complete_order(self, profile_response, order):
+        cached_items = profile_response.get("line_items")
+        if (
+            (cached_items is None)
+            or (profile_response.get("release_id") != current["release_id"])
+            or (profile_response.get("profile_format") != current["profile_format"])
+        ):
+            return None
+
+        return [
+            path
+            for path, version in current["line_items"].items()
+            if cached_items.get(path) != version
+        ]
+
+    def complete_order(
+        self, request: ProfileRequest, profile_response: dict, order: list[str]
+    ) -> dict | None:
         """
-        This will send a partial list of calculations to create
-        at create_profile, and then it will.
+        Builds the designs in the order and merges them into the cached
+        profile in template order, dropping designs the template no longer
+        has. Returns None if the partial build fails or doesn't line up
+        with the cached profile.
         """
+        match self.partial_builder(request, order):
+            case Success(partial):
+                pass
+            case Failure(reason):
+                self.logger.warning(reason)
+                return None
+
+        ordered = set(order)
+        cached_items = profile_response["line_items"]
+        cached_sections = profile_response["sections"]
+        sections = {}
+
+        for section_key, section in partial["sections"].items():
+            rows = {}
+            for row_key, row in section["rows"].items():
+                designs = {}
+                for design_key, design in row["designs"].items():
+                    path = f"{section_key}/{row_key}/{design_key}"
+                    if path not in ordered:
+                        if cached_items.get(path) != partial["line_items"][path]:
+                            # The template changed again since the check
+                            return None
+                        design = cached_sections[section_key]["rows"][row_key][
+                            "designs"
+                        ][design_key]
+                    designs[design_key] = design
+                rows[row_key] = {**row, "designs": designs}
+            sections[section_key] = {**section, "rows": rows}
 
+        profile = {
+            key: value
+            for key, value in profile_response.items()
+            if key != "profile_data_json"
+        }
+        # Take the release, versions and line items from the partial build
+        profile.update(partial, sections=sections)
+        profile["profile_data_json"] = SafeString(
+            json.dumps(profile, cls=LazyEncoder)
+        )
+
+        self.logger.info(
+            f"Completed {len(order)} of {len(partial['line_items'])} designs "
+            f"for {request.geoid}."
+        )
+
+        return profile
@@ -0,0 +1,279 @@
+"""
+Profile Compression
+
+Cached profiles used to be written as one json.dumps string, then a bytes
+copy of it, then a gzipped copy in memory. CompressedJSONStream instead
+encodes the profile a piece at a time and feeds the pieces through an
+incremental compressor as the upload reads from it, so only a piece of
+each exists at a time.
+
+gzip is always available. zstd is used if the optional zstandard package
+is installed; it compresses faster at a similar size, but browsers can't
+all inflate it, so gzip pass-through (see views.timeseries_passthrough)
+only works for gzip objects.
+"""
+
+from dataclasses import dataclass
+from io import RawIOBase
+from typing import Any, Callable
+import gzip
+import json
+import struct
+import zlib
+
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+@dataclass(frozen=True)
+class Codec:
+    # Also the Content-Encoding stored with the object
+    name: str
+    default_level: int
+    compressor: Callable[[int], Any]
+    decompress: Callable[[bytes], bytes]
+
+
+class GzipCompressor:
+    """
+    A gzip compressobj whose deflate data ends on a byte boundary, with an
+    empty sync block before the final one, so join_gzip can splice stored
+    objects together without inflating them. It costs five bytes.
+    """
+
+    def __init__(self, level: int):
+        # wbits=31 writes a gzip header and trailer around the deflate stream
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH) + self._compressor.flush()
+
+
+def gzip_compressor(level: int):
+    return GzipCompressor(level)
+
+
+def zstd_compressor(level: int):
+    return zstandard.ZstdCompressor(level=level).compressobj()
+
+
+def zstd_decompress(data: bytes) -> bytes:
+    # Streamed frames don't record their size, so decompress incrementally
+    return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+CODECS = {
+    "gzip": Codec("gzip", 6, gzip_compressor, gzip.decompress),
+    "zstd": Codec("zstd", 3, zstd_compressor, zstd_decompress),
+}
+
+
+def get_codec(name: str) -> Codec:
+    if name not in CODECS:
+        raise ImproperlyConfigured(
+            f"{name} isn't a profile cache codec, use one of {', '.join(CODECS)}."
+        )
+    if (name == "zstd") and (zstandard is None):
+        raise ImproperlyConfigured(
+            "The zstd codec needs the zstandard package installed."
+        )
+
+    return CODECS[name]
+
+
+def available_codecs() -> list[Codec]:
+    return [
+        codec
+        for name, codec in CODECS.items()
+        if (name != "zstd") or (zstandard is not None)
+    ]
+
+
+# Magic, deflate, no optional fields; then mtime, extra flags and OS
+# (unknown), which clients ignore
+GZIP_HEADER = b"\x1f\x8b\x08\x00" + b"\x00\x00\x00\x00\x00\xff"
+# The empty sync block GzipCompressor ends with, then the final empty block
+SYNC_END = b"\x00\x00\xff\xff"
+FINAL_BLOCK = b"\x03\x00"
+
+
+def _gf2_times(matrix: list[int], vector: int) -> int:
+    total = 0
+    for row in matrix:
+        if not vector:
+            break
+        if vector & 1:
+            total ^= row
+        vector >>= 1
+    return total
+
+
+def _gf2_square(matrix: list[int]) -> list[int]:
+    return [_gf2_times(matrix, row) for row in matrix]
+
+
+def crc32_combine(crc1: int, crc2: int, length2: int) -> int:
+    """
+    The CRC-32 of a + b from the CRC-32s of a and b and the length of b,
+    without reading either (zlib's crc32_combine, which Python doesn't
+    expose).
+    """
+    if length2 == 0:
+        return crc1
+
+    # The operator for one zero bit, then squared up to one zero byte
+    odd = [0xEDB88320] + [1 << n for n in range(31)]
+    even = _gf2_square(odd)
+    odd = _gf2_square(even)
+
+    # Apply length2 zero bytes to crc1, a power of two at a time
+    while length2:
+        even = _gf2_square(odd)
+        if length2 & 1:
+            crc1 = _gf2_times(even, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+
+        odd = _gf2_square(even)
+        if length2 & 1:
+            crc1 = _gf2_times(odd, crc1)
+        length2 >>= 1
+
+    return crc1 ^ crc2
+
+
+def splice_parts(member: bytes) -> tuple[bytes, int, int] | None:
+    """
+    The deflate blocks of a gzip object written by GzipCompressor, without
+    the final block, and its CRC and length. None for any other gzip.
+    """
+    if (len(member) < 24) or (member[:4] != GZIP_HEADER[:4]):
+        return None
+
+    blocks = member[10:-8]
+    if not blocks.endswith(SYNC_END + FINAL_BLOCK):
+        return None
+
+    crc, length = struct.unpack("<II", member[-8:])
+    return blocks[: -len(FINAL_BLOCK)], crc, length
+
+
+def join_gzip(*parts: str | bytes, level: int | None = None) -> bytes | None:
+    """
+    One gzip stream of the parts in order: str parts are literal text,
+    bytes parts are stored gzip objects, spliced in as they are. Returns
+    None if a stored object wasn't written by GzipCompressor and can't be
+    spliced.
+    """
+    level = CODECS["gzip"].default_level if level is None else level
+    blocks = [GZIP_HEADER]
+    crc = 0
+    length = 0
+
+    for part in parts:
+        if isinstance(part, str):
+            data = part.encode()
+            # A compressor per literal, so nothing refers back across objects
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            blocks.append(
+                compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            )
+            part_crc, part_length = zlib.crc32(data), len(data)
+        elif (spliced := splice_parts(part)) is not None:
+            part_blocks, part_crc, part_length = spliced
+            blocks.append(part_blocks)
+        else:
+            return None
+
+        crc = crc32_combine(crc, part_crc, part_length)
+        length += part_length
+
+    blocks.append(FINAL_BLOCK)
+    blocks.append(struct.pack("<II", crc, length & 0xFFFFFFFF))
+    return b"".join(blocks)
+
+
+def iter_json_chunks(obj, encoder: json.JSONEncoder, depth: int = 3):
+    """
+    The same text as encoder.encode(obj), in pieces. Dicts are split into
+    their items down to the given depth and everything below is encoded in
+    one go, which keeps the C encoder (iterencode alone is pure Python)
+    while only holding one section or row of JSON at a time.
+    """
+    if (depth == 0) or not isinstance(obj, dict) or not obj:
+        yield encoder.encode(obj)
+        return
+
+    separator = "{"
+    for key, value in obj.items():
+        # Encoding a one item dict keeps the encoder's handling of keys
+        (item_key,) = json.loads(encoder.encode({key: None}))
+        yield separator + encoder.encode(item_key) + ": "
+        yield from iter_json_chunks(value, encoder, depth - 1)
+        separator = ", "
+    yield "}"
+
+
+class CompressedJSONStream(RawIOBase):
+    """
+    A read-only file object of the compressed JSON for obj, encoded and
+    compressed as it's read.
+    """
+
+    def __init__(
+        self,
+        obj,
+        codec: Codec,
+        level: int | None = None,
+        encoder: type[json.JSONEncoder] = json.JSONEncoder,
+    ):
+        self._chunks = iter_json_chunks(obj, encoder())
+        self._compressor = codec.compressor(
+            codec.default_level if level is None else level
+        )
+        self._buffer = bytearray()
+        self._finished = False
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, target) -> int:
+        while (len(self._buffer) < len(target)) and not self._finished:
+            self._fill()
+
+        size = min(len(target), len(self._buffer))
+        target[:size] = self._buffer[:size]
+        del self._buffer[:size]
+
+        return size
+
+    def _fill(self):
+        # Batch small chunks up so the compressor sees decent blocks
+        batch = []
+        batch_size = 0
+        for chunk in self._chunks:
+            batch.append(chunk)
+            batch_size += len(chunk)
+            if batch_size >= 64 * 1024:
+                break
+
+        if batch:
+            data = "".join(batch).encode()
+            self.raw_bytes += len(data)
+            compressed = self._compressor.compress(data)
+        else:
+            compressed = self._compressor.flush()
+            self._finished = True
+
+        self.compressed_bytes += len(compressed)
+        self._buffer += compressed
@@ -0,0 +1,122 @@
+"""
+Build Locks
+
+When a popular profile misses the cache, every request for it would build
+it and write the same object. BuildLock makes the build single-flight:
+threads in a process queue on a threading.Lock, and processes on a key
+added to the shared cache (cache.add only succeeds for one of them).
+
+Whoever gets the lock after waiting should check the cache again before
+building, since the holder it waited on has usually just filled it. A
+waiter that times out gets False back and decides for itself what to do.
+The cache key expires after BUILD_LOCK_TTL, so a process that dies mid
+build can't hold it forever.
+"""
+
+from threading import Lock
+from typing import Hashable
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+from . import metrics
+
+
+# key -> [lock, number of threads holding or waiting on it]
+_local_locks: dict[Hashable, list] = {}
+_registry_lock = Lock()
+
+
+def _checkout(key: Hashable) -> Lock:
+    with _registry_lock:
+        entry = _local_locks.setdefault(key, [Lock(), 0])
+        entry[1] += 1
+        return entry[0]
+
+
+def _checkin(key: Hashable):
+    with _registry_lock:
+        entry = _local_locks[key]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _local_locks[key]
+
+
+class BuildLock:
+    def __init__(
+        self,
+        key: str,
+        timeout: float | None = None,
+        poll_interval: float = 0.05,
+    ):
+        self.key = key
+        self.cache_key = f"build-lock:{key}"
+        self.timeout = settings.BUILD_LOCK_TIMEOUT if timeout is None else timeout
+        self.poll_interval = poll_interval
+        self.token = uuid.uuid4().hex
+        # Whether acquiring had to wait for another build
+        self.waited = False
+        # The thread lock, while it's held
+        self._local: Lock | None = None
+
+    @property
+    def cache(self):
+        return caches[settings.BUILD_LOCK_CACHE]
+
+    def acquire(self) -> bool:
+        start = time.monotonic()
+        deadline = start + self.timeout
+        local = _checkout(self.key)
+
+        try:
+            if not local.acquire(blocking=False):
+                self.waited = True
+                if not local.acquire(timeout=self.timeout):
+                    return self._give_up(start)
+
+            try:
+                while not self.cache.add(
+                    self.cache_key, self.token, timeout=settings.BUILD_LOCK_TTL
+                ):
+                    self.waited = True
+                    if time.monotonic() >= deadline:
+                        local.release()
+                        return self._give_up(start)
+                    time.sleep(self.poll_interval)
+            except BaseException:
+                local.release()
+                raise
+
+        except BaseException:
+            _checkin(self.key)
+            raise
+
+        if self.waited:
+            metrics.record("build_lock.wait", time.monotonic() - start)
+        self._local = local
+        return True
+
+    def _give_up(self, start: float) -> bool:
+        _checkin(self.key)
+        metrics.record("build_lock.wait", time.monotonic() - start)
+        metrics.increment("build_lock.timeouts")
+        return False
+
+    def release(self):
+        if self._local is None:
+            return
+
+        # Don't free a lock that expired and was taken by someone else
+        if self.cache.get(self.cache_key) == self.token:
+            self.cache.delete(self.cache_key)
+        self._local.release()
+        self._local = None
+        _checkin(self.key)
+
+    def __enter__(self) -> bool:
+        return self.acquire()
+
+    def __exit__(self, *_):
+        self.release()
@@ -0,0 +1,154 @@
+import gzip
+import json
+import time
+import tracemalloc
+from io import BytesIO
+
+from django.core.management.base import BaseCommand
+
+from smartcharts.compression import CompressedJSONStream, available_codecs
+
+
+LEVELS = {
+    "gzip": [1, 6, 9],
+    "zstd": [1, 3, 10, 19],
+}
+
+
+def synthetic_profile(num_sections: int) -> dict:
+    """
+    Roughly the shape of a populated profile: sections of rows of designs,
+    each with a handful of terraced estimates.
+    """
+    estimate = {
+        "values": {"this": 1234.5, "county": 2345.6, "state": 3456.7},
+        "error": {"this": 12.3, "county": 23.4, "state": 34.5},
+        "numerators": {"this": 100.0, "county": 200.0, "state": 300.0},
+        "index": {"this": 100, "county": 52, "state": 36},
+        "error_ratio": {"this": 1.0, "county": 1.0, "state": 1.0},
+    }
+    return {
+        "sections": {
+            f"section_{i}": {
+                "title": f"Section {i}",
+                "rows": {
+                    f"row_{j}": {
+                        "title": f"Row {j}",
+                        "designs": {
+                            f"design_{k}": {
+                                "name": f"Design {k}",
+                                **{f"column_{c}": estimate for c in range(6)},
+                                "metadata": {
+                                    "chart_type": "chart-column",
+                                    "column_width": "column-half",
+                                    "table_id": f"B{i:05d}",
+                                },
+                            }
+                            for k in range(4)
+                        },
+                    }
+                    for j in range(3)
+                },
+            }
+            for i in range(num_sections)
+        }
+    }
+
+
+def measure(func) -> tuple[bytes, float, int]:
+    tracemalloc.start()
+    start = time.process_time()
+    result = func()
+    elapsed = time.process_time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, elapsed, peak
+
+
+def in_memory_gzip(profile: dict) -> bytes:
+    # What S3Handler.cache_profile used to do
+    data_as_bytes = str.encode(json.dumps(profile))
+    memfile = BytesIO()
+    with gzip.GzipFile(mode="wb", fileobj=memfile) as gzip_data:
+        gzip_data.write(data_as_bytes)
+    return memfile.getvalue()
+
+
+def with_profile_json(profile: dict) -> dict:
+    # Built and cached profiles carry their own JSON as profile_data_json
+    return {**profile, "profile_data_json": json.dumps(profile)}
+
+
+def streamed(profile: dict, codec, level: int) -> int:
+    # What S3Handler.cache_profile does, leaving out profile_data_json
+    stored = {
+        key: value for key, value in profile.items() if key != "profile_data_json"
+    }
+    stream = CompressedJSONStream(stored, codec, level)
+    # Keep only the size. A real upload also buffers one multipart part
+    # (8 MiB by default) on top of this.
+    size = 0
+    while chunk := stream.read(64 * 1024):
+        size += len(chunk)
+    return size
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare compressed size, CPU time and peak memory for each profile "
+        "cache codec and level against the old in-memory gzip."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sections",
+            type=int,
+            default=40,
+            help="Number of sections in the synthetic profile.",
+        )
+        parser.add_argument(
+            "--profile",
+            help="Benchmark a real profile from this JSON file instead.",
+        )
+        parser.add_argument(
+            "--without-profile-json",
+            action="store_true",
+            help="Leave profile_data_json out of the profile, as the old "
+            "in-memory gzip never saw it.",
+        )
+
+    def handle(self, *args, **options):
+        if options["profile"]:
+            with open(options["profile"]) as f:
+                profile = json.load(f)
+        else:
+            profile = synthetic_profile(options["sections"])
+        if not options["without_profile_json"]:
+            profile = with_profile_json(profile)
+
+        raw_size = len(json.dumps(profile).encode())
+        self.stdout.write(f"Profile is {raw_size / 1024:.1f} KiB of JSON")
+        if "profile_data_json" in profile:
+            self.stdout.write(
+                f"{len(profile['profile_data_json'].encode()) / 1024:.1f} KiB of "
+                "that is profile_data_json, which the streams leave out"
+            )
+
+        compressed, elapsed, peak = measure(lambda: in_memory_gzip(profile))
+        self.stdout.write(
+            f"{'in-memory gzip 9':<18} {len(compressed) / 1024:>9.1f} KiB "
+            f"{raw_size / len(compressed):>6.2f}x {elapsed:.4f}s cpu "
+            f"{peak / 1024:>9.1f} KiB peak"
+        )
+
+        for codec in available_codecs():
+            for level in LEVELS[codec.name]:
+                size, elapsed, peak = measure(
+                    lambda: streamed(profile, codec, level)
+                )
+                self.stdout.write(
+                    f"{f'{codec.name} {level}':<18} {size / 1024:>9.1f} KiB "
+                    f"{raw_size / size:>6.2f}x {elapsed:.4f}s cpu "
+                    f"{peak / 1024:>9.1f} KiB peak"
+                )
@@ -0,0 +1,118 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test.utils import override_settings
+
+from smartcharts.metadata import TimeFrame
+from smartcharts.models import load_profile_plan
+from smartcharts.parallel import get_pool, shutdown_pool
+from smartcharts.plan import datapoint_results
+from smartcharts.tests.fixtures import (
+    build_synthetic_template,
+    detroit,
+    populate_inputs,
+)
+
+from .check_profile_queries import Rollback
+
+
+def time_populate(plan, geography, api_response, metadata_pool, workers: int):
+    # Nothing cached may carry over between the runs being compared
+    datapoint_results.clear()
+
+    with override_settings(
+        PARALLEL_POPULATE_WORKERS=workers,
+        PARALLEL_POPULATE_MIN_SECTIONS=1,
+        FRAGMENT_CACHE_TIMEOUT=0,
+    ):
+        if workers:
+            # Start the workers first; a real server keeps its pool around
+            list(get_pool().map(abs, range(workers)))
+
+        start = time.monotonic()
+        profile = plan.populate(
+            geography, api_response, metadata_pool, TimeFrame.PRESENT
+        )
+        elapsed = time.monotonic() - start
+        shutdown_pool()
+
+    return profile, elapsed
+
+
+def benchmark_template(num_sections: int, workers: int) -> tuple[float, float]:
+    """
+    Populates a synthetic template serially and in parallel inside a
+    transaction that is rolled back, checking the two agree.
+    """
+    try:
+        with transaction.atomic():
+            plan = load_profile_plan(build_synthetic_template(num_sections).pk)
+            geography = detroit()
+            api_response, metadata_pool = populate_inputs(plan, geography)
+
+            serial, serial_time = time_populate(
+                plan, geography, api_response, metadata_pool, 0
+            )
+            parallel, parallel_time = time_populate(
+                plan, geography, api_response, metadata_pool, workers
+            )
+            raise Rollback()
+
+    except Rollback:
+        pass
+
+    if serial != parallel:
+        raise CommandError(
+            f"The parallel profile for {num_sections} section(s) doesn't "
+            "match the serial one."
+        )
+
+    return serial_time, parallel_time
+
+
+class Command(BaseCommand):
+    help = (
+        "Time serial against parallel population on synthetic templates of "
+        "increasing size, to find where the process pool starts to pay off."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            nargs="+",
+            type=int,
+            default=[1, 10, 50, 200, 800],
+            help="Number of sections in each synthetic template.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Number of worker processes for the parallel runs.",
+        )
+
+    def handle(self, *args, **options):
+        crossover = None
+
+        for size in sorted(options["sizes"]):
+            serial_time, parallel_time = benchmark_template(
+                size, options["workers"]
+            )
+            self.stdout.write(
+                f"{size:>5} section(s): {serial_time:.4f}s serial "
+                f"{parallel_time:.4f}s parallel "
+                f"({serial_time / parallel_time:.2f}x)"
+            )
+            if (crossover is None) and (parallel_time < serial_time):
+                crossover = size
+
+        if crossover is None:
+            self.stdout.write("The pool never beat the serial path.")
+        else:
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"The pool first wins at {crossover} section(s); set "
+                    "PARALLEL_POPULATE_MIN_SECTIONS around there."
+                )
+            )
@@ -0,0 +1,71 @@
+import time
+
+import boto3
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from smartcharts import metrics
+from smartcharts.s3handler import AWS_REGION, reset_s3_clients
+from smartcharts.views import build_s3_handler
+
+
+def session_per_handler():
+    # What S3Handler used to do for every request
+    session = boto3.Session(
+        aws_access_key_id=settings.AWS_KEY,
+        aws_secret_access_key=settings.AWS_SECRET,
+        region_name=AWS_REGION,
+    )
+    return session.resource("s3")
+
+
+def time_builds(build, count: int) -> tuple[float, float]:
+    start = time.perf_counter()
+    build()
+    first = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(count):
+        build()
+    rest = (time.perf_counter() - start) / count
+
+    return first, rest
+
+
+class Command(BaseCommand):
+    help = (
+        "Time building the S3 handler per request with a new session each "
+        "time against the shared client. Nothing is sent to S3."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--requests",
+            type=int,
+            default=50,
+            help="Number of handlers to build after the first.",
+        )
+
+    def handle(self, *args, **options):
+        count = options["requests"]
+
+        first, rest = time_builds(session_per_handler, count)
+        self.stdout.write(
+            f"{'session per handler':<20} first {first * 1000:>8.2f}ms "
+            f"then {rest * 1000:>8.2f}ms per request"
+        )
+
+        reset_s3_clients()
+        metrics.reset()
+        with override_settings(DONT_CHECK_CACHE=False, DONT_CACHE=False):
+            first, rest = time_builds(build_s3_handler, count)
+        self.stdout.write(
+            f"{'shared client':<20} first {first * 1000:>8.2f}ms "
+            f"then {rest * 1000:>8.2f}ms per request"
+        )
+
+        startup = metrics.snapshot()["timings"]["s3.client_startup"]
+        self.stdout.write(
+            f"The shared client took {startup.total * 1000:.2f}ms to start."
+        )
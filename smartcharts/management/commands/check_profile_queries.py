@@ -1,13 +1,129 @@
-from django.core.management.base import BaseCommand
-from django.db import connection
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
 from smartcharts.profile import geo_profile, ProfileRequest
 from smartcharts.metadata import TimeFrame
+from smartcharts.models import load_profile_plan
+from smartcharts.tests.fixtures import (
+    build_synthetic_template,
+    detroit,
+    placeholder_pool,
+    synthetic_data,
+)
+
+
+STAGES = ["template load", "shopping list", "populate"]
+
+
+class Rollback(Exception):
+    pass
+
+
+def measure(stage: str, results: dict, func):
+    start = time.monotonic()
+    with CaptureQueriesContext(connection) as queries:
+        value = func()
+
+    results[stage] = {
+        "queries": len(queries),
+        "db_time": sum(float(query["time"]) for query in queries.captured_queries),
+        "wall_time": time.monotonic() - start,
+    }
+
+    return value
+
+
+def measure_template(num_sections: int) -> dict:
+    """
+    Builds a synthetic template of the given size inside a transaction that
+    is rolled back, measuring each stage of a profile build against it.
+    """
+    results = {}
+
+    try:
+        with transaction.atomic():
+            profile = build_synthetic_template(num_sections)
+            geography = detroit()
+
+            plan = measure(
+                "template load", results, lambda: load_profile_plan(profile.pk)
+            )
+            shopping_list = measure(
+                "shopping list", results, plan.collect_shopping_list
+            )
+
+            tables = {table.name for table in shopping_list}
+            api_response = synthetic_data(tables, geography)
+            metadata_pool = placeholder_pool(tables)
+            measure(
+                "populate",
+                results,
+                lambda: plan.populate(
+                    geography, api_response, metadata_pool, TimeFrame.PRESENT
+                ),
+            )
+            raise Rollback()
+
+    except Rollback:
+        pass
+
+    return results
+
 
 class Command(BaseCommand):
-    help = "Count the number of queries to build the geo profile template."
+    help = (
+        "Count the queries and DB time for each stage of a profile build on "
+        "synthetic templates of increasing size, failing if the count grows "
+        "with the template."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            nargs="+",
+            type=int,
+            default=[1, 5, 25],
+            help="Number of sections in each synthetic template.",
+        )
+        parser.add_argument(
+            "--geoid",
+            help="Also run geo_profile for this geoid (needs the api).",
+        )
 
     def handle(self, *args, **options):
-        request = ProfileRequest("06000US2616322000", TimeFrame.PRESENT)
-        _ = geo_profile(request) 
-        print(f"The geo_profile function created {len(connection.queries)} queries")
+        sizes = sorted(options["sizes"])
+        measurements = {size: measure_template(size) for size in sizes}
+
+        for size, results in measurements.items():
+            self.stdout.write(f"{size} section(s):")
+            for stage in STAGES:
+                result = results[stage]
+                self.stdout.write(
+                    f"    {stage:<14} {result['queries']:>4} queries "
+                    f"{result['db_time']:.4f}s db "
+                    f"{result['wall_time']:.4f}s total"
+                )
+
+        growing = [
+            stage
+            for stage in STAGES
+            if len({measurements[size][stage]["queries"] for size in sizes}) > 1
+        ]
+
+        if options["geoid"]:
+            with CaptureQueriesContext(connection) as queries:
+                geo_profile(ProfileRequest(options["geoid"], TimeFrame.PRESENT))
+            self.stdout.write(
+                f"The geo_profile function created {len(queries)} queries"
+            )
+
+        if growing:
+            raise CommandError(
+                "Query counts grow with the template size for: "
+                + ", ".join(growing)
+            )
 
+        self.stdout.write(self.style.SUCCESS("Query counts are constant."))
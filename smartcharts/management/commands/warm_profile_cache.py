@@ -0,0 +1,324 @@
+"""
+Pre-builds profiles into S3, for example every county, place and tract in
+Michigan:
+
+    manage.py warm_profile_cache --within 04000US26 --sumlevels 050 160 140
+
+Profiles are built by a pool of worker processes (the api calls inside a
+build are already concurrent) and uploaded by a pool of threads, so the
+next builds don't wait on S3. Profiles that are already current are
+skipped, and every finished geoid is appended to the checkpoint file, so
+an interrupted run picks up where it left off. Checkpoint entries carry
+the profile version, so after a template edit or a new release the same
+file no longer skips anything.
+"""
+
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from pathlib import Path
+import logging
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from smartcharts import metrics
+from smartcharts.api_client import ApiClient
+from smartcharts.build_manager import GeoProfileBuilder, ProfileUnavailable
+from smartcharts.metadata import TimeFrame
+from smartcharts.parallel import init_worker
+from smartcharts.profile import (
+    ProfileRequest,
+    current_profile_version,
+    enhance_api_data,
+    geo_profile,
+)
+from smartcharts.s3handler import CacheHandler, S3Handler
+
+
+logger = logging.getLogger(__name__)
+
+# Worker side: one handler per process
+_handler: S3Handler | None = None
+
+
+def build_handler() -> S3Handler:
+    # Always checks and writes S3, whatever DONT_CHECK_CACHE and DONT_CACHE say
+    return S3Handler(
+        settings.AWS_KEY,
+        settings.AWS_SECRET,
+        settings.AWS_SERVER_NAME,
+        settings.AWS_FILE_ROOT,
+        current_profile_version,
+        codec=settings.PROFILE_CACHE_CODEC,
+        compression_level=settings.PROFILE_CACHE_COMPRESSION_LEVEL,
+    )
+
+
+def worker_handler() -> S3Handler:
+    global _handler
+
+    if _handler is None:
+        _handler = build_handler()
+    return _handler
+
+
+def build_profile(geoid: str, timeframe: str, force: bool) -> tuple[str, dict | str]:
+    """
+    Returns ("current", None) if S3 already has this version, ("built",
+    profile), or ("failed", reason).
+    """
+    request = ProfileRequest(geoid, TimeFrame(timeframe))
+    builder = GeoProfileBuilder(
+        # Only run_builder is used; the parent process does the caching
+        cache_handler=CacheHandler(),
+        builder=geo_profile,
+        enhancer=enhance_api_data,
+        logger=logger,
+    )
+
+    try:
+        if (not force) and worker_handler().is_current(request):
+            return ("current", None)
+        return ("built", builder.run_builder(request))
+    except ProfileUnavailable as unavailable:
+        return ("failed", unavailable.reason.name)
+    except Exception as error:
+        # One bad geoid shouldn't end the run
+        logger.exception(f"Building {geoid} ({timeframe}) failed.")
+        return ("failed", repr(error))
+
+
+def read_geoids(path: str) -> list[str]:
+    # One geoid per line; blank lines and # comments are ignored
+    with open(path) as f:
+        lines = (line.split("#")[0].strip() for line in f)
+        return [line.upper() for line in lines if line]
+
+
+def checkpoint_key(geoid: str, timeframe: str, version: str) -> str:
+    return f"{timeframe}:{version}:{geoid.upper()}"
+
+
+def load_checkpoint(path: Path | None) -> set[str]:
+    if (path is None) or not path.exists():
+        return set()
+    return set(path.read_text().split())
+
+
+class Command(BaseCommand):
+    help = (
+        "Build profiles ahead of time and upload them to S3, from a file of "
+        "geoids or every geography at some summary levels within a parent."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--file",
+            help="A file of geoids, one per line.",
+        )
+        parser.add_argument(
+            "--within",
+            help="A parent geoid to expand --sumlevels within, like 04000US26.",
+        )
+        parser.add_argument(
+            "--sumlevels",
+            nargs="+",
+            default=[],
+            help="Summary levels to warm within the parent, like 050 160 140.",
+        )
+        parser.add_argument(
+            "--timeframes",
+            nargs="+",
+            default=[TimeFrame.PRESENT.value],
+            choices=[timeframe.value for timeframe in TimeFrame],
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Worker processes building profiles; 0 builds in this process.",
+        )
+        parser.add_argument(
+            "--uploads",
+            type=int,
+            default=8,
+            help="Profiles uploaded to S3 at once.",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            help="Finished geoids are appended here and skipped next time.",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Rebuild profiles even if S3 has the current version.",
+        )
+        parser.add_argument(
+            "--report-every",
+            type=int,
+            default=100,
+            help="Print progress after this many geoids.",
+        )
+
+    def collect_geoids(self, options) -> list[str]:
+        geoids = []
+        if options["file"]:
+            geoids.extend(read_geoids(options["file"]))
+
+        if options["sumlevels"]:
+            if not options["within"]:
+                raise CommandError("--sumlevels needs a --within parent geoid.")
+            api_client = ApiClient(settings.API_URL)
+            for sumlevel in options["sumlevels"]:
+                geoids.extend(
+                    geoid.upper()
+                    for geoid in api_client.get_child_geoids(
+                        sumlevel, options["within"]
+                    )
+                )
+
+        if not geoids:
+            raise CommandError("Give a --file of geoids or --within and --sumlevels.")
+
+        # Without repeats, in the order given
+        return list(dict.fromkeys(geoids))
+
+    def handle(self, *args, **options):
+        checkpoint = Path(options["checkpoint"]) if options["checkpoint"] else None
+        finished = load_checkpoint(checkpoint)
+
+        geoids = self.collect_geoids(options)
+        # The version only depends on the timeframe, so it's found once
+        self.versions = {
+            timeframe: current_profile_version(
+                ProfileRequest(geoids[0], TimeFrame(timeframe))
+            )
+            for timeframe in options["timeframes"]
+        }
+        todo = [
+            (geoid, timeframe)
+            for timeframe in options["timeframes"]
+            for geoid in geoids
+            if checkpoint_key(geoid, timeframe, self.versions[timeframe])
+            not in finished
+        ]
+        self.stdout.write(
+            f"Warming {len(todo)} profile(s), {len(finished)} already checkpointed."
+        )
+
+        self.counts = {"built": 0, "current": 0, "failed": 0}
+        self.total = len(todo)
+        self.report_every = options["report_every"]
+        self.start = time.monotonic()
+
+        if options["workers"]:
+            builds = ProcessPoolExecutor(
+                max_workers=options["workers"], initializer=init_worker
+            )
+        else:
+            builds = ThreadPoolExecutor(max_workers=1)
+        uploads = ThreadPoolExecutor(max_workers=options["uploads"])
+        handler = build_handler()
+
+        try:
+            with open(checkpoint or os.devnull, "a") as log:
+                self.run(
+                    todo,
+                    builds,
+                    max(options["workers"], 1),
+                    uploads,
+                    options["uploads"],
+                    handler,
+                    options["force"],
+                    log,
+                )
+        finally:
+            builds.shutdown(cancel_futures=True)
+            uploads.shutdown()
+
+        self.report(final=True)
+
+    def run(self, todo, builds, build_slots, uploads, upload_slots, handler, force, log):
+        todo = iter(todo)
+        pending_builds: dict[Future, tuple[str, str]] = {}
+        pending_uploads: dict[Future, tuple[str, str]] = {}
+        exhausted = False
+
+        while True:
+            # Keep every worker busy, unless the uploads are falling behind
+            while (
+                (not exhausted)
+                and (len(pending_builds) < build_slots * 2)
+                and (len(pending_uploads) < upload_slots * 2)
+            ):
+                if (item := next(todo, None)) is None:
+                    exhausted = True
+                    break
+                pending_builds[builds.submit(build_profile, *item, force)] = item
+
+            if not (pending_builds or pending_uploads):
+                break
+
+            done, _ = wait([*pending_builds, *pending_uploads], return_when=FIRST_COMPLETED)
+
+            for future in done:
+                if future in pending_builds:
+                    geoid, timeframe = pending_builds.pop(future)
+                    # Errors build_profile can't catch, like a worker dying
+                    if (error := future.exception()) is not None:
+                        result = ("failed", repr(error))
+                    else:
+                        result = future.result()
+
+                    match result:
+                        case ("built", profile):
+                            request = ProfileRequest(geoid, TimeFrame(timeframe))
+                            upload = uploads.submit(handler.cache_profile, request, profile)
+                            pending_uploads[upload] = (geoid, timeframe)
+                        case ("current", _):
+                            self.finish(geoid, timeframe, "current", log)
+                        case ("failed", reason):
+                            self.stderr.write(f"{geoid} ({timeframe}) failed: {reason}")
+                            self.finish(geoid, timeframe, "failed", log)
+                else:
+                    geoid, timeframe = pending_uploads.pop(future)
+                    if (error := future.exception()) is not None:
+                        self.stderr.write(f"{geoid} ({timeframe}) didn't upload: {error}")
+                        self.finish(geoid, timeframe, "failed", log)
+                    else:
+                        self.finish(geoid, timeframe, "built", log)
+
+    def finish(self, geoid: str, timeframe: str, outcome: str, log):
+        self.counts[outcome] += 1
+        if outcome != "failed":
+            # Failures are tried again next run
+            log.write(
+                checkpoint_key(geoid, timeframe, self.versions[timeframe]) + "\n"
+            )
+            log.flush()
+
+        if sum(self.counts.values()) % self.report_every == 0:
+            self.report()
+
+    def report(self, final: bool = False):
+        elapsed = time.monotonic() - self.start
+        done = sum(self.counts.values())
+        self.stdout.write(
+            f"{done}/{self.total}: {self.counts['built']} built, "
+            f"{self.counts['current']} already current, "
+            f"{self.counts['failed']} failed in {elapsed:.1f}s "
+            f"({done / elapsed if elapsed else 0:.2f} profiles/s)"
+        )
+
+        if final and (put := metrics.snapshot()["timings"].get("s3.put")):
+            self.stdout.write(
+                f"Uploads took {put.mean:.3f}s on average, {put.max:.3f}s at most."
+            )
+
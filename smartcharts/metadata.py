@@ -27,6 +27,25 @@ class ChoiceEnum(Enum):
         return zip(cls.__members__.keys(), cls.__members__.keys())
 
 
+class ColumnWidth(float, ChoiceEnum):
+    """
+    This is how you set the column width on the DataDesign that you're building.
+    It will help avoid over filling the row, or giving the js incorrect column
+    widths.
+    """
+
+    QUARTER = 1 / 4
+    THIRD = 1 / 3
+    HALF = 1 / 2
+    TWO_THIRDS = 2 / 3
+    THREE_QUARTERS = 3 / 4
+    FULL = 1
+
+
+def hyphenated_name(column_width: ColumnWidth) -> str:
+    return "column-" + column_width.name.replace("_", "-").lower()
+
+
 class TimeFrame(ChoiceEnum):
     # Client & Server
     PAST = "past"
@@ -46,6 +65,16 @@ class DataParadigm(ChoiceEnum):
     D3 = auto()
 
 
+def release_for_timeframe(timeframe: TimeFrame) -> str:
+    """
+    Identifies the data release a timeframe reads from (the census schema
+    and the D3 timeframe), used to key anything cached across profiles.
+    """
+    if timeframe == TimeFrame.PAST:
+        return f"{settings.ACS_PAST_YEAR}:d3_past"
+    return f"{settings.ACS_YEAR}:d3_present"
+
+
 @dataclass(frozen=True, eq=True, slots=True)
 class TableMetadataRequest:
     # Client-side
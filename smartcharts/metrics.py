@@ -0,0 +1,70 @@
+"""
+Metrics
+
+Timings and counters kept in memory per process, cheap enough to leave on
+in production. Nothing is exported anywhere; read them with snapshot()
+(or from a shell or management command) and log what's useful.
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass
+from threading import Lock
+import time
+
+
+@dataclass
+class Timing:
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+
+_lock = Lock()
+_timings: dict[str, Timing] = {}
+_counters: Counter = Counter()
+
+
+def record(name: str, seconds: float):
+    with _lock:
+        _timings.setdefault(name, Timing()).add(seconds)
+
+
+@contextmanager
+def timed(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def increment(name: str, by: int = 1):
+    with _lock:
+        _counters[name] += by
+
+
+def snapshot() -> dict:
+    with _lock:
+        return {
+            "timings": {
+                name: Timing(timing.count, timing.total, timing.max)
+                for name, timing in _timings.items()
+            },
+            "counters": dict(_counters),
+        }
+
+
+def reset():
+    with _lock:
+        _timings.clear()
+        _counters.clear()
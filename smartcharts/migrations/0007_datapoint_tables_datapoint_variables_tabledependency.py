@@ -0,0 +1,80 @@
+# Generated by Django 4.2.5 on 2026-10-19 09:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from lesp.analyze import extract_variables
+
+
+def backfill_dependencies(apps, schema_editor):
+    DataPoint = apps.get_model("smartcharts", "DataPoint")
+    TableDependency = apps.get_model("smartcharts", "TableDependency")
+
+    for point in DataPoint.objects.all():
+        try:
+            variables = sorted(set(extract_variables(point.lesp_code)))
+        except Exception:
+            # Broken programs are left empty and will be flagged when
+            # they are next saved.
+            continue
+
+        point.variables = variables
+        point.tables = sorted({var[:-3] for var in variables})
+        point.save(update_fields=["tables", "variables"])
+
+        TableDependency.objects.bulk_create(
+            [
+                TableDependency(table_name=table_name, datapoint=point)
+                for table_name in sorted(
+                    {table_name.upper() for table_name in point.tables}
+                )
+            ]
+        )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("smartcharts", "0006_rename_title_datapoint_identifier_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="datapoint",
+            name="tables",
+            field=models.JSONField(default=list, editable=False),
+        ),
+        migrations.AddField(
+            model_name="datapoint",
+            name="variables",
+            field=models.JSONField(default=list, editable=False),
+        ),
+        migrations.CreateModel(
+            name="TableDependency",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("table_name", models.CharField(db_index=True, max_length=32)),
+                (
+                    "datapoint",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="table_dependencies",
+                        to="smartcharts.datapoint",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("table_name", "datapoint")},
+            },
+        ),
+        migrations.RunPython(
+            backfill_dependencies, migrations.RunPython.noop
+        ),
+    ]
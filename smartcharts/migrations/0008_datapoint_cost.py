@@ -0,0 +1,33 @@
+# Generated by Django 4.2.5 on 2026-10-19 10:03
+
+from django.db import migrations, models
+
+from smartcharts.saturate.analysis import analyze_program, LespAnalysisError
+
+
+def backfill_cost(apps, schema_editor):
+    DataPoint = apps.get_model("smartcharts", "DataPoint")
+
+    for point in DataPoint.objects.all():
+        try:
+            point.cost = analyze_program(point.lesp_code).cost
+        except LespAnalysisError:
+            # Flagged when the datapoint is next saved.
+            continue
+
+        point.save(update_fields=["cost"])
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("smartcharts", "0007_datapoint_tables_datapoint_variables_tabledependency"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="datapoint",
+            name="cost",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_cost, migrations.RunPython.noop),
+    ]
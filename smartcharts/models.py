@@ -8,145 +8,166 @@ be collected, dispatched to the various apis, the results of witch can be return
 to the recalling datapoints automatically.
 """
 
-from functools import reduce
+from collections import defaultdict
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Sum
 from django.conf import settings
-from django.core.cache import cache
+from django.core.exceptions import ValidationError
 from polymorphic.models import PolymorphicModel, PolymorphicManager
 
-from lesp.analyze import extract_variables
-
 from .metadata import (
-    ChoiceEnum,
+    ColumnWidth,
     TimeFrame,
     ComparisonType,
     DataParadigm,
-    TableMetadata,
-    EditionMetadata,
-    VariableMetadata,
-    TableMetadataPlaceholder,
     TableMetadataRequest,
-    ComparisonEditions,
+    hyphenated_name,
+)
+from .plan import (
+    PlannedDataPoint,
+    PlannedDesign,
+    PlannedStatList,
+    PlannedColumnChart,
+    PlannedDoughnutChart,
+    PlannedGroupedColumnChart,
+    PlannedRow,
+    PlannedSection,
+    ProfilePlan,
+    build_section_plan,
+    build_profile_plan,
+    fill_metadata_from_response,
+    populate_year,
 )
-from .saturate import saturate_datapoint
+from .saturate.analysis import ProgramAnalysis, analyze_program, LespAnalysisError
 from .utils import make_snake
 
 
-class ColumnWidth(float, ChoiceEnum):
+def analyze_lesp(lesp_code: str) -> ProgramAnalysis:
     """
-    This is how you set the column width on the DataDesign that you're building.
-    It will help avoid over filling the row, or giving the js incorrect column
-    widths.
+    Parses the lesp program once for the tables and variables it reads
+    and its cost. Raises a ValidationError if the program can't be read,
+    would fail whatever the data, or a token doesn't look like a table
+    variable.
     """
+    try:
+        analysis = analyze_program(lesp_code)
+    except LespAnalysisError as e:
+        raise ValidationError({"lesp_code": str(e)})
+
+    malformed = [var for var in analysis.variables if len(var) <= 3]
+    if malformed:
+        raise ValidationError(
+            {
+                "lesp_code": "These tokens aren't table variables: "
+                + ", ".join(malformed)
+            }
+        )
 
-    QUARTER = 1 / 4
-    THIRD = 1 / 3
-    HALF = 1 / 2
-    TWO_THIRDS = 2 / 3
-    THREE_QUARTERS = 3 / 4
-    FULL = 1
-
-
-def hyphenated_name(column_width: ColumnWidth) -> str:
-    return "column-" + column_width.name.replace("_", "-").lower()
+    return analysis
 
 
 class DataPoint(models.Model):
     """
     This is the container for a recipe that takes the Census or D3 variables
     and produces an aggregated datapoint.
+
+    The tables and variables the recipe reads (and its operation cost)
+    are worked out once when the datapoint is saved, so nothing on the
+    request path has to read lesp.
     """
 
     identifier = models.CharField(max_length=128) # This name is used to id in the system
     display_name = models.CharField(max_length=256) # This name is what is shown on the page
     lesp_code = models.TextField()
+    tables = models.JSONField(default=list, editable=False)
+    variables = models.JSONField(default=list, editable=False)
+    cost = models.PositiveIntegerField(default=0, editable=False)
 
     @property
-    def shopping_list(self):
+    def shopping_list(self) -> set[str]:
         """
-        Returns every token that is not an operator, bracket, or number from
-        the program string.
+        Returns every table the program string reads from.
         """
-        return {var[:-3] for var in extract_variables(self.lesp_code)}
+        return set(self.tables)
+
+    def analyze(self):
+        analysis = analyze_lesp(self.lesp_code)
+        self.tables = list(analysis.tables)
+        self.variables = list(analysis.variables)
+        self.cost = analysis.cost
+
+    def clean(self):
+        self.analyze()
+
+    def save(self, *args, **kwargs):
+        self.analyze()
 
-    def evaluate(self, geography, api_response):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            self.refresh_table_index()
+
+    def refresh_table_index(self):
         """
-        This will return a filled datapoint.
+        Keeps the table -> datapoint reverse index in step with the
+        stored dependencies.
         """
-        return saturate_datapoint(
-            self.display_name,
-            api_response,
-            geography.show_detailed_lineage(),
-            self.lesp_code,
+        indexed = {table_name.upper() for table_name in self.tables}
+
+        self.table_dependencies.exclude(table_name__in=indexed).delete()
+        existing = set(
+            self.table_dependencies.values_list("table_name", flat=True)
+        )
+        TableDependency.objects.bulk_create(
+            [
+                TableDependency(table_name=table_name, datapoint=self)
+                for table_name in sorted(indexed - existing)
+            ]
+        )
+
+    def to_plan(self) -> PlannedDataPoint:
+        return PlannedDataPoint(
+            id=self.pk,
+            identifier=self.identifier,
+            display_name=self.display_name,
+            key=make_snake(self.display_name),
+            lesp_code=self.lesp_code,
+            tables=tuple(self.tables),
         )
 
+    def evaluate(
+        self, geography, api_response, timeframe: TimeFrame = TimeFrame.PRESENT
+    ):
+        """
+        This will return a filled datapoint.
+        """
+        return self.to_plan().evaluate(geography, api_response, timeframe)
+
     def __str__(self):
         return self.identifier
 
 
-def fill_metadata_from_response(
-    data_point: DataPoint, api_response, metadata_response
-):
-    # MOVE THIS INTO ANOTHER FILE
-    # This will just pull the first table of the list if there
-    # is several, define metadata for more complicated lesp_codes.
-    table_id = data_point.shopping_list.pop() # This is a little breaky
-    table_metadata = metadata_response.tables.get(table_id.lower())
-    match table_metadata:
-        case TableMetadata():
-            return table_metadata
-        case TableMetadataPlaceholder():
-            return TableMetadata(
-                table_name=table_id,
-                category="",
-                description=api_response["tables"][table_id]["title"],
-                description_simple=api_response["tables"][table_id]["title"],
-                table_topics="",
-                universe=api_response["tables"][table_id]["universe"],
-                subject_area="",
-                source=api_response["release"]["name"],
-                documentation="",
-                variables={
-                    var_id: VariableMetadata(
-                        variable_name=var_id,
-                        description=var["name"],
-                        indentation=var["indent"],
-                        documentation="",
-                    )
-                    for var_id, var in api_response["tables"][table_id][
-                        "columns"
-                    ].items()
-                },
-                all_editions=[],
-                comparison_editions=ComparisonEditions(
-                    present=EditionMetadata(
-                        edition=str(settings.ACS_YEAR_NUMERIC)
-                    ),
-                    past=EditionMetadata(
-                        edition=str(settings.ACS_PAST_YEAR_NUMERIC)
-                    ),
-                ),
-            )
-        case _:
-            raise TypeError(
-                f"table_metadata must be of type TableMetadata or TableMetadataPlaceholder, recieved {type(table_metadata)} for {table_id}."
-            )
+class TableDependency(models.Model):
+    """
+    Reverse index from a table to every datapoint that reads it.
+    """
 
+    table_name = models.CharField(max_length=32, db_index=True)
+    datapoint = models.ForeignKey(
+        DataPoint, on_delete=models.CASCADE, related_name="table_dependencies"
+    )
 
-def populate_year(
-    table: TableMetadata, timeframe: TimeFrame
-) -> int | str | None:
-    try:
-        if timeframe == TimeFrame.PRESENT:
-            return table.comparison_editions.present.edition
-        elif timeframe == TimeFrame.PAST:
-            return table.comparison_editions.past.edition
-
-    except AttributeError:
-        raise AttributeError(
-            f"For the table {table.table_name}, no edition is defined for {timeframe.value}."
-        )
+    class Meta:
+        unique_together = [("table_name", "datapoint")]
+
+    def __str__(self):
+        return f"{self.table_name} -> {self.datapoint}"
+
+
+def datapoints_for_table(table_name: str):
+    return DataPoint.objects.filter(
+        table_dependencies__table_name=table_name.upper()
+    )
 
 
 class DataDesign(PolymorphicModel):
@@ -187,23 +208,44 @@ class DataDesign(PolymorphicModel):
     def paradigm(self):
         return DataParadigm[self._paradigm]
 
-    def collect_shopping_list(self) -> set[TableMetadataRequest]:
+    def plan_fields(self) -> dict:
         """
-        This will return all the variables required to fill this
-        design.
+        The fields every planned design shares.
         """
+        return dict(
+            id=self.pk,
+            identifier=self.identifier,
+            title=self.title,
+            key=make_snake(self.title),
+            width=self.width,
+            comparison_type=self.comparison_type,
+            paradigm=self.paradigm,
+        )
+
+    def to_plan(self) -> PlannedDesign:
         raise NotImplementedError(
             "Cannot call this method on abstract or test class"
         )
 
+    def collect_shopping_list(self) -> set[TableMetadataRequest]:
+        """
+        This will return all the variables required to fill this
+        design.
+        """
+        return self.to_plan().collect_shopping_list()
+
     def populate(
-        self, geography, api_response, metadata_response, timeframe: TimeFrame
+        self,
+        geography,
+        api_response,
+        metadata_response,
+        timeframe: TimeFrame = TimeFrame.PRESENT,
     ):
         """
         Fills all datapoints in the design with calculations and metadata.
         """
-        raise NotImplementedError(
-            "Cannot call this method on abstract or test class"
+        return self.to_plan().populate(
+            geography, api_response, metadata_response, timeframe
         )
 
     def __str__(self):
@@ -231,45 +273,17 @@ class StatList(DataDesign):
     stat_type = models.CharField(max_length=3, choices=STAT_TYPES)
     objects = StatListManager()
 
-    def collect_shopping_list(self) -> set[TableMetadataRequest]:
-        return {
-            TableMetadataRequest(
-                name=table_name,
-                comparison_type=self.comparison_type,
-                paradigm=self.paradigm,
-            )
-            for table_name in self.stat.shopping_list
-        }
-
-    def populate(
-        self,
-        geography,
-        api_response,
-        metadata_response,
-        _: TimeFrame = TimeFrame.PRESENT, # Stat lists have no over-time
-    ):
-        metadata = fill_metadata_from_response(
-            self.stat, api_response, metadata_response
+    def to_plan(self) -> PlannedStatList:
+        return PlannedStatList(
+            **self.plan_fields(),
+            datapoints=(self.stat.to_plan(),),
+            stat_type=self.stat_type,
         )
 
-        stat = self.stat.evaluate(geography, api_response)
-        metadata = {
-            "chart_type": "stat_list",
-            "stat_type": "count",
-            **metadata.to_dict(),
-            "column_width": hyphenated_name(self.width),
-        }
-
-        stat["metadata"] = metadata
-        return {
-            "stat": stat,
-            "metadata": metadata,
-        }
-
 
 class ColumnChartManager(PolymorphicManager):
     def get_queryset(self):
-        return super().get_queryset().select_related("columns")
+        return super().get_queryset().prefetch_related("columns")
 
 
 class ColumnChart(DataDesign):
@@ -280,71 +294,23 @@ class ColumnChart(DataDesign):
     columns = models.ManyToManyField(DataPoint)
     objects = ColumnChartManager()
 
-    def collect_shopping_list(self) -> set[TableMetadataRequest]:
-        return {
-            TableMetadataRequest(
-                name=table_name,
-                comparison_type=self.comparison_type,
-                paradigm=self.paradigm,
-            )
-            for column in self.columns.all() 
-            for table_name in column.shopping_list
-        }
-    
-    def sub_populate(
-        self,
-        geography,
-        api_response,
-        metadata_response,
-        timeframe: TimeFrame = TimeFrame.PRESENT,
-    ):
-        metadata = fill_metadata_from_response(
-            self.columns.first(), api_response, metadata_response
+    def to_plan(self) -> PlannedColumnChart:
+        return PlannedColumnChart(
+            **self.plan_fields(),
+            datapoints=tuple(column.to_plan() for column in self.columns.all()),
         )
 
-        return {
-            "name": self.title,
-            **{
-                make_snake(column.display_name): column.evaluate(
-                    geography, api_response
-                )
-                for column in self.columns.all()
-            },
-            "metadata": {
-                "name": f"{self.title}",
-            },
-        }
-
-    def populate(
+    def sub_populate(
         self,
         geography,
         api_response,
         metadata_response,
         timeframe: TimeFrame = TimeFrame.PRESENT,
     ):
-        metadata = fill_metadata_from_response(
-            self.columns.first(), api_response, metadata_response
+        return self.to_plan().sub_populate(
+            geography, api_response, metadata_response, timeframe
         )
 
-        return {
-            "name": self.title,
-            **{
-                make_snake(column.display_name): column.evaluate(
-                    geography, api_response
-                )
-                for column in self.columns.all()
-            },
-            "metadata": {
-                "name": f"{self.title} ({populate_year(metadata, timeframe)})",
-                "chart_type": "chart-column",
-                "column_width": hyphenated_name(self.width),
-                "table_id": metadata.table_name,
-                "universe": metadata.universe,
-                "acs_release": populate_year(metadata, timeframe),
-                "year": populate_year(metadata, timeframe),
-            },
-        }
-
 
 class DoughnutChart(DataDesign):
     """
@@ -353,45 +319,12 @@ class DoughnutChart(DataDesign):
 
     slices = models.ManyToManyField(DataPoint)
 
-    def collect_shopping_list(self) -> set[TableMetadataRequest]:
-        return {
-                    TableMetadataRequest(
-                        name=table_name,
-                        comparison_type=self.comparison_type,
-                        paradigm=self.paradigm,
-                    )
-                    for slice in self.slices.all() 
-                    for table_name in slice.shopping_list
-                }
-
-    def populate(
-        self,
-        geography,
-        api_response,
-        metadata_response,
-        timeframe: TimeFrame = TimeFrame.PRESENT,
-    ):
-        metadata = fill_metadata_from_response(
-            self.slices.first(), api_response, metadata_response
+    def to_plan(self) -> PlannedDoughnutChart:
+        return PlannedDoughnutChart(
+            **self.plan_fields(),
+            datapoints=tuple(slice.to_plan() for slice in self.slices.all()),
         )
 
-        return {
-            "name": f"{self.title} ({populate_year(metadata, timeframe)})",
-            "metadata": {
-                "name": f"{self.title} ({populate_year(metadata, timeframe)})",
-                "chart_type": "chart-pie",
-                "column_width": hyphenated_name(self.width),
-                "table_id": metadata.table_name,
-                "universe": metadata.universe,
-                "acs_release": populate_year(metadata, timeframe),
-                "year": populate_year(metadata, timeframe),
-            },
-            **{
-                make_snake(slice.display_name): slice.evaluate(geography, api_response)
-                for slice in self.slices.all()
-            },
-        }
-
 
 class GroupedColumnChart(DataDesign):
     """
@@ -399,44 +332,14 @@ class GroupedColumnChart(DataDesign):
     """
 
     sub_charts = models.ManyToManyField(ColumnChart)
-    
-    def collect_shopping_list(self) -> set[TableMetadataRequest]:
-        return reduce(
-            lambda a, b: a | b,
-            (chart.collect_shopping_list() for chart in self.sub_charts.all()),
-            set(),
-        )
 
-    def populate(
-        self,
-        geography,
-        api_response,
-        metadata_response,
-        timeframe: TimeFrame = TimeFrame.PRESENT,
-    ):
-        metadata = fill_metadata_from_response(
-            self.sub_charts.first().columns.first(), api_response, metadata_response
+    def to_plan(self) -> PlannedGroupedColumnChart:
+        return PlannedGroupedColumnChart(
+            **self.plan_fields(),
+            datapoints=(),
+            sub_charts=tuple(chart.to_plan() for chart in self.sub_charts.all()),
         )
 
-        return {
-            "name": self.title,
-            "metadata": {
-                "name": self.title,
-                "chart_type": "chart-grouped_column",
-                "column_width": hyphenated_name(self.width),
-                "table_id": metadata.table_name,
-                "universe": metadata.universe,
-                "acs_release": populate_year(metadata, timeframe),
-                "year": populate_year(metadata, timeframe),
-                "chart_type": "chart-grouped_column",
-            },
-            **{
-                make_snake(chart.title): chart.sub_populate(
-                    geography, api_response, metadata_response
-                )
-                for chart in self.sub_charts.all()
-            },
-        }
 
 class Row(models.Model):
     """
@@ -459,13 +362,26 @@ class Row(models.Model):
     def __str__(self):
         return f"Row: {self.title}"
 
-    def collect_shopping_list(self):
-        return reduce(
-            lambda a, b: a | b,
-            (item.collect_shopping_list() for item in self.items.all()),
-            set(),
+    def plan_fields(self) -> dict:
+        return dict(
+            id=self.pk,
+            title=self.title,
+            key=make_snake(self.title or ""),
+            grouped=self.grouped,
         )
 
+    def to_plan(self) -> PlannedRow:
+        return PlannedRow(
+            **self.plan_fields(),
+            designs=tuple(
+                design.to_plan()
+                for design in self.items.order_by("rowitem__order")
+            ),
+        )
+
+    def collect_shopping_list(self):
+        return self.to_plan().collect_shopping_list()
+
     def populate(
         self,
         geography,
@@ -477,15 +393,9 @@ class Row(models.Model):
         This will call populate on all the designs, but what should it
         return?
         """
-        return {
-            "title": self.title,
-            "designs": {
-                make_snake(design.title): design.populate(
-                    geography, api_response, metadata_response, timeframe
-                )
-                for design in self.items.order_by("rowitem__order")
-            },
-        }
+        return self.to_plan().populate(
+            geography, api_response, metadata_response, timeframe
+        )
 
 
 class RowItem(models.Model):
@@ -521,15 +431,21 @@ class Section(models.Model):
     def __str__(self):
         return self.title
 
-    def collect_shopping_list(self):
-        return reduce(
-            lambda a, b: a | b,
-            (row.collect_shopping_list() for row in self.rows.all()),
-            set(),
+    def plan_fields(self) -> dict:
+        return dict(
+            id=self.pk,
+            title=self.title,
+            key=make_snake(self.title),
         )
 
-    def fill_factoids(self, *args, **kwargs):
-        return dict()
+    def to_plan(self) -> PlannedSection:
+        return build_section_plan(
+            **self.plan_fields(),
+            rows=tuple(row.to_plan() for row in self.rows.order_by("order")),
+        )
+
+    def collect_shopping_list(self):
+        return self.to_plan().collect_shopping_list()
 
     def populate(
         self,
@@ -542,18 +458,9 @@ class Section(models.Model):
         Same as row. Not sure what to call here, maybe return a dictionary
         matching what is expected by CR?
         """
-        return {
-            "title": self.title,
-            "rows": {
-                make_snake(row.title): row.populate(
-                    geography, api_response, metadata_response
-                )
-                for row in self.rows.order_by("order")
-            },
-            **self.fill_factoids(
-                geography, api_response, metadata_response, timeframe
-            ),
-        }
+        return self.to_plan().populate(
+            geography, api_response, metadata_response, timeframe
+        )
 
 
 class Profile(models.Model):
@@ -562,16 +469,30 @@ class Profile(models.Model):
     def __str__(self):
         return self.title
 
-    def collect_shopping_list(self):
-        return reduce(
-            lambda a, b: a | b,
-            (
-                section.collect_shopping_list()
-                for section in self.sections.all()
-            ),
-            set(),
+    def estimated_cost(self) -> int:
+        """
+        The lesp operations needed to fill the whole profile for a single
+        geography, summed over every datapoint each design evaluates.
+        """
+        return sum(
+            DataPoint.objects.filter(
+                **{f"{design}__row__section__profile": self}
+            ).aggregate(cost=Sum("cost"))["cost"]
+            or 0
+            for design in [
+                "statlist",
+                "columnchart",
+                "doughnutchart",
+                "columnchart__groupedcolumnchart",
+            ]
         )
 
+    def to_plan(self) -> ProfilePlan:
+        return load_profile_plan(self.pk)
+
+    def collect_shopping_list(self):
+        return self.to_plan().collect_shopping_list()
+
     def populate(
         self,
         geography,
@@ -579,32 +500,151 @@ class Profile(models.Model):
         metadata_response,
         timeframe: TimeFrame = TimeFrame.PRESENT,
     ):
-        return {
-            "geography": geography.wrap_up(),
-            "sections": {
-                make_snake(section.title): section.populate(
-                    geography, api_response, metadata_response, timeframe
-                )
-                for section in self.sections.order_by("order")
-            },
-            "release": "ACS 2019 5-year",
-        }
-
-
-def get_profile_template():
+        return self.to_plan().populate(
+            geography, api_response, metadata_response, timeframe
+        )
 
-    if (profile := cache.get("profile")):
-        return profile
 
-    profile =  Profile.objects.prefetch_related(
-        "sections",
-        "sections__rows",
-        "sections__rows__items",
-    ).first()
+def load_profile_plan(profile_id: int | None = None) -> ProfilePlan | None:
+    """
+    Compiles the whole template tree into a ProfilePlan with a fixed number
+    of queries, no matter how many sections, rows or designs it has. With
+    no profile_id, the first profile is used.
+    """
+    profiles = Profile.objects.order_by("pk")
+    if profile_id is not None:
+        profiles = profiles.filter(pk=profile_id)
+
+    if (profile := profiles.first()) is None:
+        return None
+
+    sections = list(Section.objects.filter(profile=profile).order_by("order"))
+    section_rows = defaultdict(list)
+    for row in Row.objects.filter(section__profile=profile).order_by("order"):
+        section_rows[row.section_id].append(row)
+
+    row_items = list(
+        RowItem.objects.filter(row__section__profile=profile)
+        .order_by("order")
+        .values_list("row_id", "item_id")
+    )
+    row_design_ids = {item_id for _, item_id in row_items}
 
-    cache.set("profile", profile, 10)
+    grouped_links = list(
+        GroupedColumnChart.sub_charts.through.objects.filter(
+            groupedcolumnchart_id__in=row_design_ids
+        )
+        .order_by("pk")
+        .values_list("groupedcolumnchart_id", "columnchart_id")
+    )
+    design_ids = row_design_ids | {chart_id for _, chart_id in grouped_links}
+
+    designs = {
+        design.pk: design
+        for design in DataDesign.objects.non_polymorphic()
+        .select_related("polymorphic_ctype")
+        .filter(pk__in=design_ids)
+    }
+    stat_lists = {
+        pk: (stat_id, stat_type)
+        for pk, stat_id, stat_type in StatList.objects.non_polymorphic()
+        .filter(pk__in=design_ids)
+        .values_list("pk", "stat_id", "stat_type")
+    }
+    column_links = list(
+        ColumnChart.columns.through.objects.filter(columnchart_id__in=design_ids)
+        .order_by("pk")
+        .values_list("columnchart_id", "datapoint_id")
+    )
+    slice_links = list(
+        DoughnutChart.slices.through.objects.filter(
+            doughnutchart_id__in=design_ids
+        )
+        .order_by("pk")
+        .values_list("doughnutchart_id", "datapoint_id")
+    )
 
-    return profile
+    datapoint_ids = (
+        {stat_id for stat_id, _ in stat_lists.values() if stat_id is not None}
+        | {point_id for _, point_id in column_links}
+        | {point_id for _, point_id in slice_links}
+    )
+    datapoints = {
+        point.pk: point.to_plan()
+        for point in DataPoint.objects.filter(pk__in=datapoint_ids)
+    }
+
+    def group_links(links) -> dict[int, list[int]]:
+        grouped = defaultdict(list)
+        for parent_id, child_id in links:
+            grouped[parent_id].append(child_id)
+        return grouped
+
+    row_children = group_links(row_items)
+    grouped_children = group_links(grouped_links)
+    column_children = group_links(column_links)
+    slice_children = group_links(slice_links)
+
+    def plan_design(design_id: int) -> PlannedDesign:
+        design = designs[design_id]
+        fields = design.plan_fields()
+
+        match design.polymorphic_ctype.model:
+            case "statlist":
+                stat_id, stat_type = stat_lists[design_id]
+                return PlannedStatList(
+                    **fields,
+                    datapoints=(datapoints[stat_id],),
+                    stat_type=stat_type,
+                )
+            case "columnchart":
+                return PlannedColumnChart(
+                    **fields,
+                    datapoints=tuple(
+                        datapoints[point_id]
+                        for point_id in column_children[design_id]
+                    ),
+                )
+            case "doughnutchart":
+                return PlannedDoughnutChart(
+                    **fields,
+                    datapoints=tuple(
+                        datapoints[point_id]
+                        for point_id in slice_children[design_id]
+                    ),
+                )
+            case "groupedcolumnchart":
+                return PlannedGroupedColumnChart(
+                    **fields,
+                    datapoints=(),
+                    sub_charts=tuple(
+                        plan_design(chart_id)
+                        for chart_id in grouped_children[design_id]
+                    ),
+                )
+            case model_name:
+                raise TypeError(f"There is no plan for designs of type {model_name}.")
+
+    return build_profile_plan(
+        id=profile.pk,
+        title=profile.title,
+        sections=tuple(
+            build_section_plan(
+                **section.plan_fields(),
+                rows=tuple(
+                    PlannedRow(
+                        **row.plan_fields(),
+                        designs=tuple(
+                            plan_design(item_id)
+                            for item_id in row_children[row.pk]
+                        ),
+                    )
+                    for row in section_rows[section.pk]
+                ),
+            )
+            for section in sections
+        ),
+    )
 
 
 # Zoom levels -- when to show parcels.
@@ -0,0 +1,67 @@
+"""
+Negative Cache
+
+A geoid that can't be built (it doesn't exist, the api has no data for
+it, or the api is down) used to go through the whole build again on every
+request, failing the same way each time. NegativeCache remembers why a
+geoid failed, for a time that depends on the reason, so build_geoid can
+turn it away before doing any work.
+
+Entries live in the shared cache, so every process sees them. Upstream
+failures should expire quickly, since the api usually comes back; a
+geoid that doesn't exist isn't going to start existing soon.
+"""
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .profile import ProfileRequest, ProfileFailureModes
+from . import metrics
+
+
+class NegativeCache:
+    def __init__(
+        self,
+        timeouts: dict[str, int] | None = None,
+        cache_alias: str = "default",
+    ):
+        """
+        timeouts maps ProfileFailureModes names to seconds. Reasons
+        without a timeout (or with 0) aren't remembered.
+        """
+        self.timeouts = (
+            settings.NEGATIVE_CACHE_TIMEOUTS if timeouts is None else timeouts
+        )
+        self.cache_alias = cache_alias
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def key(self, request: ProfileRequest) -> str:
+        return (
+            f"negative-profile:{request.timeframe.value.lower()}:"
+            f"{request.geoid.upper()}"
+        )
+
+    def check(self, request: ProfileRequest) -> ProfileFailureModes | None:
+        reason = self.cache.get(self.key(request))
+        if reason is None:
+            return None
+
+        metrics.increment(f"negative_cache.hits.{reason}")
+        return ProfileFailureModes[reason]
+
+    def record(self, request: ProfileRequest, reason: ProfileFailureModes) -> bool:
+        if not (timeout := self.timeouts.get(reason.name)):
+            return False
+
+        self.cache.set(self.key(request), reason.name, timeout=timeout)
+        metrics.increment(f"negative_cache.records.{reason.name}")
+        return True
+
+    def forget(self, request: ProfileRequest):
+        self.cache.delete(self.key(request))
+
+    def timeout_for(self, reason: ProfileFailureModes) -> int:
+        return self.timeouts.get(reason.name, 0)
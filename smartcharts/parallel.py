@@ -0,0 +1,136 @@
+"""
+Parallel Population
+
+Populating a very large template is CPU-bound Python on a single core.
+When PARALLEL_POPULATE_WORKERS is set, ProfilePlan.populate hands its
+sections to a pool of worker processes instead.
+
+The api response is pickled once into shared memory and every worker
+unpickles it from there, so the (often large) namespace isn't copied into
+each task. The sections come back in template order, and the output is
+the same as the serial path.
+
+It's off by default. On the machines it has been measured on, pickling
+the response and sending the sections costs more than the pool saves, so
+run the benchmark_populate command on the real hardware before turning it
+on.
+
+If a worker dies, the pool is broken for good, so it's dropped and the
+next build starts a new one. An exception raised while populating a
+section is raised to the caller, just as on the serial path.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import repeat
+from multiprocessing import shared_memory, resource_tracker
+from threading import Lock
+import pickle
+
+from django.conf import settings
+
+from .metadata import TimeFrame
+
+
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = Lock()
+
+# Worker side: the last namespace read from shared memory, by block name
+_namespace: tuple[str, dict] | None = None
+
+
+def init_worker():
+    import django
+    from django.apps import apps
+
+    if not apps.ready:
+        django.setup()
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            # Workers must share the parent's tracker, or each one starts
+            # its own and "cleans up" the blocks the parent already freed.
+            resource_tracker.ensure_running()
+            _pool = ProcessPoolExecutor(
+                max_workers=settings.PARALLEL_POPULATE_WORKERS,
+                initializer=init_worker,
+            )
+        return _pool
+
+
+def shutdown_pool():
+    global _pool
+
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
+
+
+def should_populate_in_parallel(plan) -> bool:
+    return bool(settings.PARALLEL_POPULATE_WORKERS) and (
+        len(plan.sections) >= settings.PARALLEL_POPULATE_MIN_SECTIONS
+    )
+
+
+def _shared_namespace(name: str, size: int) -> dict:
+    global _namespace
+
+    if (_namespace is None) or (_namespace[0] != name):
+        block = shared_memory.SharedMemory(name=name)
+        view = block.buf[:size]
+        try:
+            _namespace = (name, pickle.loads(view))
+        finally:
+            view.release()
+            block.close()
+
+    return _namespace[1]
+
+
+def _populate_section(
+    section, geography, shared_name, size, metadata_response, timeframe
+):
+    api_response = _shared_namespace(shared_name, size)
+    return section.populate(geography, api_response, metadata_response, timeframe)
+
+
+def populate_sections(
+    sections,
+    geography,
+    api_response,
+    metadata_response,
+    timeframe: TimeFrame = TimeFrame.PRESENT,
+) -> dict:
+    payload = pickle.dumps(api_response, protocol=pickle.HIGHEST_PROTOCOL)
+    block = shared_memory.SharedMemory(create=True, size=len(payload))
+
+    try:
+        block.buf[: len(payload)] = payload
+        # The block may be rounded up to a page, so pass the real size
+        populated = get_pool().map(
+            _populate_section,
+            sections,
+            repeat(geography),
+            repeat(block.name),
+            repeat(len(payload)),
+            repeat(metadata_response),
+            repeat(timeframe),
+        )
+
+        return {
+            section.key: result
+            for section, result in zip(sections, populated)
+        }
+
+    except BrokenProcessPool:
+        shutdown_pool()
+        raise
+
+    finally:
+        block.close()
+        block.unlink()
@@ -0,0 +1,789 @@
+"""
+Profile Plan
+
+A compiled, immutable copy of a profile template. The models in models.py
+are how a template is designed and stored, but walking them touches the
+database at almost every level. The plan holds the same tree (ordered
+sections, rows, designs and datapoints, with their snake-cased keys) as
+plain frozen dataclasses, so collecting the shopping list and populating
+a profile never go back to the database.
+
+Plans are built by the loaders in models.py.
+"""
+
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from functools import reduce
+from hashlib import sha1
+from typing import ClassVar, Collection
+import json
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .metadata import (
+    MetadataPool,
+    ColumnWidth,
+    TimeFrame,
+    ComparisonType,
+    DataParadigm,
+    TableMetadata,
+    EditionMetadata,
+    VariableMetadata,
+    TableMetadataPlaceholder,
+    TableMetadataRequest,
+    ComparisonEditions,
+    hyphenated_name,
+    release_for_timeframe,
+)
+from .saturate import saturate_datapoint, select_comparatives
+from .saturate.memo import ResultCache
+from .parallel import should_populate_in_parallel, populate_sections
+from . import metrics
+
+
+# Shared across every profile built by this process
+datapoint_results = ResultCache(maxsize=settings.DATAPOINT_RESULT_CACHE_SIZE)
+
+
+class TableDigests:
+    """
+    Hashes of each table's part of one api response, for the fragment
+    keys. Every design sharing a table in a build reuses its hash instead
+    of encoding the table's data again.
+    """
+
+    def __init__(self, geography, api_response, metadata_response):
+        self.api_response = api_response
+        self.metadata_response = metadata_response
+        self.geoids = [
+            parent["geoid"]
+            for parent in select_comparatives(geography.show_detailed_lineage())
+        ]
+        self._digests: dict[str, str] = {}
+
+    def digest(self, table: str) -> str:
+        if (digest := self._digests.get(table)) is None:
+            data = json.dumps(
+                [
+                    self.api_response.get("release"),
+                    self.api_response["tables"].get(table),
+                    [
+                        self.api_response["data"][geoid].get(table)
+                        for geoid in self.geoids
+                    ],
+                    repr(self.metadata_response.tables.get(table.lower())),
+                ],
+                sort_keys=True,
+                default=str,
+            )
+            digest = sha1(data.encode()).hexdigest()
+            self._digests[table] = digest
+
+        return digest
+
+
+@dataclass(frozen=True, slots=True)
+class PlannedDataPoint:
+    id: int
+    identifier: str
+    display_name: str
+    key: str
+    lesp_code: str
+    tables: tuple[str, ...]
+
+    def evaluate(
+        self, geography, api_response, timeframe: TimeFrame = TimeFrame.PRESENT
+    ):
+        return saturate_datapoint(
+            self.display_name,
+            api_response,
+            geography.show_detailed_lineage(),
+            self.lesp_code,
+            release=release_for_timeframe(timeframe),
+            cache=datapoint_results,
+        )
+
+
+def fill_metadata_from_response(
+    data_point: PlannedDataPoint, api_response, metadata_response
+):
+    # This will just pull the first table of the list if there
+    # is several, define metadata for more complicated lesp_codes.
+    table_id = data_point.tables[0]
+    table_metadata = metadata_response.tables.get(table_id.lower())
+    match table_metadata:
+        case TableMetadata():
+            return table_metadata
+        case TableMetadataPlaceholder():
+            return TableMetadata(
+                table_name=table_id,
+                category="",
+                description=api_response["tables"][table_id]["title"],
+                description_simple=api_response["tables"][table_id]["title"],
+                table_topics="",
+                universe=api_response["tables"][table_id]["universe"],
+                subject_area="",
+                source=api_response["release"]["name"],
+                documentation="",
+                variables={
+                    var_id: VariableMetadata(
+                        variable_name=var_id,
+                        description=var["name"],
+                        indentation=var["indent"],
+                        documentation="",
+                    )
+                    for var_id, var in api_response["tables"][table_id][
+                        "columns"
+                    ].items()
+                },
+                all_editions=[],
+                comparison_editions=ComparisonEditions(
+                    present=EditionMetadata(
+                        edition=str(settings.ACS_YEAR_NUMERIC)
+                    ),
+                    past=EditionMetadata(
+                        edition=str(settings.ACS_PAST_YEAR_NUMERIC)
+                    ),
+                ),
+            )
+        case _:
+            raise TypeError(
+                f"table_metadata must be of type TableMetadata or TableMetadataPlaceholder, recieved {type(table_metadata)} for {table_id}."
+            )
+
+
+def populate_year(
+    table: TableMetadata, timeframe: TimeFrame
+) -> int | str | None:
+    try:
+        if timeframe == TimeFrame.PRESENT:
+            return table.comparison_editions.present.edition
+        elif timeframe == TimeFrame.PAST:
+            return table.comparison_editions.past.edition
+
+    except AttributeError:
+        raise AttributeError(
+            f"For the table {table.table_name}, no edition is defined for {timeframe.value}."
+        )
+
+
+@dataclass(frozen=True, slots=True)
+class PlannedDesign:
+    """
+    The data-independent parts of a DataDesign. Subclasses mirror the
+    DataDesign subclasses and know how to fill themselves.
+    """
+
+    id: int
+    identifier: str
+    title: str
+    key: str
+    width: ColumnWidth
+    comparison_type: ComparisonType
+    paradigm: DataParadigm
+    datapoints: tuple[PlannedDataPoint, ...]
+    # A hash of everything above (and of any sub charts), so editing
+    # the design or one of its datapoints gives it a new version.
+    version: str = field(default="", kw_only=True)
+    # The output metadata that doesn't depend on the data, worked out once
+    # when the plan is compiled and copied into every populated design.
+    skeleton: dict[str, str] = field(
+        default_factory=dict, kw_only=True, repr=False, compare=False
+    )
+
+    chart_type: ClassVar[str] = ""
+
+    def __post_init__(self):
+        if not self.version:
+            object.__setattr__(
+                self, "version", sha1(repr(self).encode()).hexdigest()[:16]
+            )
+        object.__setattr__(
+            self,
+            "skeleton",
+            {
+                "chart_type": self.chart_type,
+                "column_width": hyphenated_name(self.width),
+            },
+        )
+
+    def collect_shopping_list(self) -> set[TableMetadataRequest]:
+        return {
+            TableMetadataRequest(
+                name=table_name,
+                comparison_type=self.comparison_type,
+                paradigm=self.paradigm,
+            )
+            for datapoint in self.datapoints
+            for table_name in datapoint.tables
+        }
+
+    def fragment_key(
+        self,
+        geography,
+        api_response,
+        metadata_response,
+        timeframe: TimeFrame,
+        digests: TableDigests | None = None,
+    ) -> str:
+        """
+        A design's output only depends on its definition, the geographies
+        it's compared across, the timeframe and the data in its tables.
+        """
+        if digests is None:
+            digests = TableDigests(geography, api_response, metadata_response)
+
+        tables = sorted({table.name for table in self.collect_shopping_list()})
+        data_hash = sha1(
+            ":".join(digests.digest(table) for table in tables).encode()
+        ).hexdigest()
+
+        return (
+            f"smartcharts:fragment:{self.id}:{self.version}:"
+            f"{geography.full_geoid}:{timeframe.value}:{data_hash}"
+        )
+
+    def populate(
+        self,
+        geography,
+        api_response,
+        metadata_response,
+        timeframe: TimeFrame = TimeFrame.PRESENT,
+        digests: TableDigests | None = None,
+    ):
+        """
+        Fills the design, reusing a cached fragment when neither the design
+        nor its data have changed. Pass the build's digests to share the
+        table hashes between designs.
+        """
+        if not settings.FRAGMENT_CACHE_TIMEOUT:
+            return self.fill(geography, api_response, metadata_response, timeframe)
+
+        fragments = caches[settings.FRAGMENT_CACHE]
+        key = self.fragment_key(
+            geography, api_response, metadata_response, timeframe, digests
+        )
+        if (fragment := fragments.get(key)) is not None:
+            return fragment
+
+        fragment = self.fill(geography, api_response, metadata_response, timeframe)
+        fragments.set(key, fragment, settings.FRAGMENT_CACHE_TIMEOUT)
+
+        return fragment
+
+    def fill(
+        self, geography, api_response, metadata_response, timeframe: TimeFrame
+    ):
+        raise NotImplementedError(
+            "Cannot call this method on abstract or test class"
+        )
+
+
+@dataclass(frozen=True, slots=True)
+class PlannedStatList(PlannedDesign):
+    stat_type: str
+
+    chart_type: ClassVar[str] = "stat_list"
+
+    def fill(
+        self,
+        geography,
+        api_response,
+        metadata_response,
+        timeframe: TimeFrame = TimeFrame.PRESENT, # Stat lists have no over-time
+    ):
+        (point,) = self.datapoints
+        metadata = fill_metadata_from_response(
+            point, api_response, metadata_response
+        )
+
+        stat = point.evaluate(geography, api_response, timeframe)
+        metadata = {
+            "stat_type": "count",
+            **metadata.to_dict(),
+            **self.skeleton,
+        }
+
+        stat["metadata"] = metadata
+        return {
+            "stat": stat,
+            "metadata": metadata,
+        }
+
+
+@dataclass(frozen=True, slots=True)
+class PlannedColumnChart(PlannedDesign):
+    chart_type: ClassVar[str] = "chart-column"
+
+    def evaluate_columns(self, geography, api_response, timeframe: TimeFrame):
+        return {
+            column.key: column.evaluate(geography, api_response, timeframe)
+            for column in self.datapoints
+        }
+
+    def sub_populate(
+        self,
+        geography,
+        api_response,
+        metadata_response,
+        timeframe: TimeFrame = TimeFrame.PRESENT,
+    ):
+        return {
+            "name": self.title,
+            **self.evaluate_columns(geography, api_response, timeframe),
+            "metadata": {
+                "name": f"{self.title}",
+            },
+        }
+
+    def fill(
+        self,
+        geography,
+        api_response,
+        metadata_response,
+        timeframe: TimeFrame = TimeFrame.PRESENT,
+    ):
+        metadata = fill_metadata_from_response(
+            self.datapoints[0], api_response, metadata_response
+        )
+        year = populate_year(metadata, timeframe)
+
+        return {
+            "name": self.title,
+            **self.evaluate_columns(geography, api_response, timeframe),
+            "metadata": {
+                "name": f"{self.title} ({year})",
+                **self.skeleton,
+                "table_id": metadata.table_name,
+                "universe": metadata.universe,
+                "acs_release": year,
+                "year": year,
+            },
+        }
+
+
+@dataclass(frozen=True, slots=True)
+class PlannedDoughnutChart(PlannedDesign):
+    chart_type: ClassVar[str] = "chart-pie"
+
+    def fill(
+        self,
+        geography,
+        api_response,
+        metadata_response,
+        timeframe: TimeFrame = TimeFrame.PRESENT,
+    ):
+        metadata = fill_metadata_from_response(
+            self.datapoints[0], api_response, metadata_response
+        )
+        year = populate_year(metadata, timeframe)
+
+        return {
+            "name": f"{self.title} ({year})",
+            "metadata": {
+                "name": f"{self.title} ({year})",
+                **self.skeleton,
+                "table_id": metadata.table_name,
+                "universe": metadata.universe,
+                "acs_release": year,
+                "year": year,
+            },
+            **{
+                slice.key: slice.evaluate(geography, api_response, timeframe)
+                for slice in self.datapoints
+            },
+        }
+
+
+@dataclass(frozen=True, slots=True)
+class PlannedGroupedColumnChart(PlannedDesign):
+    sub_charts: tuple[PlannedColumnChart, ...]
+
+    chart_type: ClassVar[str] = "chart-grouped_column"
+
+    def collect_shopping_list(self) -> set[TableMetadataRequest]:
+        return reduce(
+            lambda a, b: a | b,
+            (chart.collect_shopping_list() for chart in self.sub_charts),
+            set(),
+        )
+
+    def fill(
+        self,
+        geography,
+        api_response,
+        metadata_response,
+        timeframe: TimeFrame = TimeFrame.PRESENT,
+    ):
+        metadata = fill_metadata_from_response(
+            self.sub_charts[0].datapoints[0], api_response, metadata_response
+        )
+        year = populate_year(metadata, timeframe)
+
+        return {
+            "name": self.title,
+            "metadata": {
+                "name": self.title,
+                **self.skeleton,
+                "table_id": metadata.table_name,
+                "universe": metadata.universe,
+                "acs_release": year,
+                "year": year,
+            },
+            **{
+                chart.key: chart.sub_populate(
+                    geography, api_response, metadata_response, timeframe
+                )
+                for chart in self.sub_charts
+            },
+        }
+
+
+@dataclass(frozen=True, slots=True)
+class PlannedRow:
+    id: int
+    title: str | None
+    key: str
+    grouped: bool
+    designs: tuple[PlannedDesign, ...]
+
+    def collect_shopping_list(self) -> set[TableMetadataRequest]:
+        return reduce(
+            lambda a, b: a | b,
+            (design.collect_shopping_list() for design in self.designs),
+            set(),
+        )
+
+    def populate(
+        self,
+        geography,
+        api_response,
+        metadata_response,
+        timeframe: TimeFrame = TimeFrame.PRESENT,
+        digests: TableDigests | None = None,
+    ):
+        if digests is None:
+            digests = TableDigests(geography, api_response, metadata_response)
+
+        return {
+            "title": self.title,
+            "designs": {
+                design.key: design.populate(
+                    geography, api_response, metadata_response, timeframe, digests
+                )
+                for design in self.designs
+            },
+        }
+
+
+@dataclass(frozen=True, slots=True)
+class PlannedSection:
+    id: int
+    title: str
+    key: str
+    rows: tuple[PlannedRow, ...]
+    # Sets repr in hash order, which changes with every process, so this is
+    # left out of the repr and the version
+    shopping_list: frozenset[TableMetadataRequest] = field(repr=False)
+    # Like PlannedDesign.version, but for the whole section. Every process
+    # must agree on it, so it's hashed from plain values in template order.
+    version: str = field(default="", kw_only=True)
+
+    def __post_init__(self):
+        if not self.version:
+            content = (
+                self.title,
+                self.key,
+                [
+                    (
+                        row.title,
+                        row.key,
+                        row.grouped,
+                        [design.version for design in row.designs],
+                    )
+                    for row in self.rows
+                ],
+            )
+            object.__setattr__(
+                self, "version", sha1(repr(content).encode()).hexdigest()[:16]
+            )
+
+    def collect_shopping_list(self) -> set[TableMetadataRequest]:
+        return set(self.shopping_list)
+
+    def fill_factoids(self, *args, **kwargs):
+        return dict()
+
+    def populate(
+        self,
+        geography,
+        api_response,
+        metadata_response,
+        timeframe: TimeFrame = TimeFrame.PRESENT,
+        digests: TableDigests | None = None,
+    ):
+        if digests is None:
+            digests = TableDigests(geography, api_response, metadata_response)
+
+        return {
+            "title": self.title,
+            "rows": {
+                row.key: row.populate(
+                    geography, api_response, metadata_response, timeframe, digests
+                )
+                for row in self.rows
+            },
+            **self.fill_factoids(
+                geography, api_response, metadata_response, timeframe
+            ),
+        }
+
+
+def line_item_path(
+    section: PlannedSection, row: PlannedRow, design: PlannedDesign
+) -> str:
+    return f"{section.key}/{row.key}/{design.key}"
+
+
+@dataclass(frozen=True, slots=True)
+class ProfilePlan:
+    """
+    The shopping lists are worked out once when the plan is compiled.
+    """
+
+    id: int
+    title: str
+    sections: tuple[PlannedSection, ...]
+    shopping_list: frozenset[TableMetadataRequest] = field(repr=False)
+    # A hash of the section versions, which cover every design and lesp
+    # program in the template.
+    version: str = field(default="", kw_only=True)
+
+    def __post_init__(self):
+        if not self.version:
+            object.__setattr__(
+                self,
+                "version",
+                sha1(
+                    repr(
+                        (self.title, [section.version for section in self.sections])
+                    ).encode()
+                ).hexdigest()[:16],
+            )
+
+    def collect_shopping_list(self) -> set[TableMetadataRequest]:
+        return set(self.shopping_list)
+
+    def profile_version(self, timeframe: TimeFrame) -> str:
+        """
+        The version stamped on cached profiles. It changes with the
+        template, the release and settings.PROFILE_VERSION, which is only
+        bumped by hand now for changes to the code that builds profiles.
+        """
+        return sha1(
+            f"{self.version}:{release_for_timeframe(timeframe)}:"
+            f"{settings.PROFILE_VERSION}".encode()
+        ).hexdigest()[:16]
+
+    def section_versions(self) -> dict[str, str]:
+        return {section.key: section.version for section in self.sections}
+
+    def line_items(self) -> dict[str, str]:
+        """
+        Every design in template order, by its path in the populated
+        profile, with its version.
+        """
+        return {
+            line_item_path(section, row, design): design.version
+            for section in self.sections
+            for row in section.rows
+            for design in row.designs
+        }
+
+    def shopping_list_for(self, paths: Collection[str]) -> set[TableMetadataRequest]:
+        return reduce(
+            lambda a, b: a | b,
+            (
+                design.collect_shopping_list()
+                for section in self.sections
+                for row in section.rows
+                for design in row.designs
+                if line_item_path(section, row, design) in paths
+            ),
+            set(),
+        )
+
+    def section(self, key: str) -> PlannedSection | None:
+        return next(
+            (section for section in self.sections if section.key == key), None
+        )
+
+    def populate(
+        self,
+        geography,
+        api_response,
+        metadata_response,
+        timeframe: TimeFrame = TimeFrame.PRESENT,
+    ):
+        return {
+            "geography": {
+                **geography.wrap_up(),
+                "comparatives": [
+                    parent["relation"]
+                    for parent in select_comparatives(
+                        geography.show_detailed_lineage()
+                    )
+                    if parent["relation"] != "this"
+                ],
+            },
+            "sections": self.populate_sections(
+                geography, api_response, metadata_response, timeframe
+            ),
+            "release": "ACS 2019 5-year",
+            "release_id": release_for_timeframe(timeframe),
+            "profile_format": settings.PROFILE_VERSION,
+            "section_versions": self.section_versions(),
+            "line_items": self.line_items(),
+        }
+
+    def populate_line_items(
+        self,
+        paths: Collection[str],
+        geography,
+        api_response,
+        metadata_response,
+        timeframe: TimeFrame = TimeFrame.PRESENT,
+    ):
+        """
+        The sections as populate would fill them, but only the designs in
+        paths are filled and every other design is left as None, so the
+        result can be merged into a cached profile in template order.
+        """
+        digests = TableDigests(geography, api_response, metadata_response)
+
+        return {
+            section.key: {
+                "title": section.title,
+                "rows": {
+                    row.key: {
+                        "title": row.title,
+                        "designs": {
+                            design.key: (
+                                design.populate(
+                                    geography,
+                                    api_response,
+                                    metadata_response,
+                                    timeframe,
+                                    digests,
+                                )
+                                if line_item_path(section, row, design) in paths
+                                else None
+                            )
+                            for design in row.designs
+                        },
+                    }
+                    for row in section.rows
+                },
+                **section.fill_factoids(
+                    geography, api_response, metadata_response, timeframe
+                ),
+            }
+            for section in self.sections
+        }
+
+    def populate_sections(
+        self,
+        geography,
+        api_response,
+        metadata_response,
+        timeframe: TimeFrame = TimeFrame.PRESENT,
+    ):
+        if should_populate_in_parallel(self):
+            try:
+                return populate_sections(
+                    self.sections,
+                    geography,
+                    api_response,
+                    metadata_response,
+                    timeframe,
+                )
+            except BrokenProcessPool:
+                # A worker died (killed for memory, say), so this build
+                # runs here and the next one gets a new pool
+                metrics.increment("populate.pool_broken")
+
+        digests = TableDigests(geography, api_response, metadata_response)
+
+        return {
+            section.key: section.populate(
+                geography, api_response, metadata_response, timeframe, digests
+            )
+            for section in self.sections
+        }
+
+
+@dataclass(frozen=True, slots=True)
+class RequestPlan:
+    """
+    Everything needed to ask the api for a profile's data in one
+    timeframe. It only depends on the template, so it is built once per
+    compiled template and reused for every geoid.
+    """
+
+    template: ProfilePlan
+    timeframe: TimeFrame
+    metadata_pool: MetadataPool
+    data_request: dict
+
+    def section_request(self, section: PlannedSection) -> dict:
+        """
+        The part of the data request that a single section needs.
+        """
+        return self.request_for(section.shopping_list)
+
+    def request_for(self, shopping_list: Collection[TableMetadataRequest]) -> dict:
+        tables = {table.name.upper() for table in shopping_list}
+
+        return {
+            schema: split
+            for schema, table_list in self.data_request.items()
+            if (
+                split := [
+                    table
+                    for table in table_list
+                    if table.table_name.upper() in tables
+                ]
+            )
+        }
+
+
+def build_section_plan(
+    id: int, title: str, key: str, rows: tuple[PlannedRow, ...]
+) -> PlannedSection:
+    return PlannedSection(
+        id=id,
+        title=title,
+        key=key,
+        rows=rows,
+        shopping_list=frozenset(
+            reduce(
+                lambda a, b: a | b,
+                (row.collect_shopping_list() for row in rows),
+                set(),
+            )
+        ),
+    )
+
+
+def build_profile_plan(
+    id: int, title: str, sections: tuple[PlannedSection, ...]
+) -> ProfilePlan:
+    return ProfilePlan(
+        id=id,
+        title=title,
+        sections=sections,
+        shopping_list=frozenset().union(
+            *(section.shopping_list for section in sections)
+        ),
+    )
@@ -0,0 +1,180 @@
+"""
+Popularity
+
+After a release or a template change every cached profile is stale, and
+the most visited geographies are the first to be rebuilt on a user's
+time. PopularityTracker counts requests per (geoid, timeframe) so the
+builder can rebuild the most popular ones in the background as soon as it
+sees the version change (see GeoProfileBuilder.track).
+
+Counts are kept in a count-min sketch, so memory doesn't grow with the
+number of geoids, and every counter is halved after a while, so what was
+popular last month fades out. Alongside it a small set of candidates
+holds the keys with the highest estimates.
+
+It also measures whether that works: of the first request for each
+prewarmed geoid after a version change, how many found the profile
+already built.
+"""
+
+from itertools import count
+from threading import Lock
+from typing import Hashable
+import heapq
+
+from . import metrics
+
+
+class CountMinSketch:
+    def __init__(self, width: int, depth: int, decay_after: int):
+        """
+        Counters are halved after every decay_after additions.
+        """
+        self.width = width
+        self.depth = depth
+        self.decay_after = decay_after
+        self.rows = [[0] * width for _ in range(depth)]
+        self.additions = 0
+        self.decays = 0
+
+    def _cells(self, key: Hashable):
+        for row in range(self.depth):
+            yield row, hash((row, key)) % self.width
+
+    def add(self, key: Hashable) -> int:
+        estimate = None
+        for row, cell in self._cells(key):
+            self.rows[row][cell] += 1
+            count = self.rows[row][cell]
+            estimate = count if estimate is None else min(estimate, count)
+
+        self.additions += 1
+        if self.additions >= self.decay_after:
+            self.decay()
+
+        return estimate
+
+    def estimate(self, key: Hashable) -> int:
+        return min(self.rows[row][cell] for row, cell in self._cells(key))
+
+    def decay(self):
+        for counters in self.rows:
+            for i, count in enumerate(counters):
+                counters[i] = count >> 1
+        self.additions = 0
+        self.decays += 1
+
+
+class PopularityTracker:
+    def __init__(
+        self,
+        top_n: int,
+        width: int = 4096,
+        depth: int = 4,
+        decay_after: int | None = None,
+    ):
+        self.top_n = top_n
+        self.sketch = CountMinSketch(width, depth, decay_after or width * 10)
+        # Room for more than top_n, so newcomers can climb past old favorites
+        self.capacity = max(top_n * 4, 1)
+        # Used as an ordered set, so ties rank in the order keys arrived
+        self.candidates: dict[Hashable, None] = {}
+        # (estimate when last looked at, arrival, key) for every candidate.
+        # Estimates only grow between decays, so each entry is a lower
+        # bound and the least candidate is found by refreshing the top of
+        # the heap until its estimate is current.
+        self._heap: list[tuple[int, int, Hashable]] = []
+        self._arrivals = count()
+        self._decays_seen = 0
+        self.versions: dict[Hashable, str] = {}
+        # Geoids not yet requested since the last version change
+        self._unseen_since_change: dict[Hashable, set] = {}
+        self._lock = Lock()
+
+    def record(self, key: Hashable):
+        with self._lock:
+            estimate = self.sketch.add(key)
+            if self._decays_seen != self.sketch.decays:
+                self._decay_heap()
+                estimate = self.sketch.estimate(key)
+
+            if key in self.candidates:
+                return
+
+            if len(self.candidates) < self.capacity:
+                self.candidates[key] = None
+                heapq.heappush(self._heap, (estimate, next(self._arrivals), key))
+                return
+
+            least, least_estimate = self._least()
+            if estimate > least_estimate:
+                del self.candidates[least]
+                self.candidates[key] = None
+                heapq.heapreplace(
+                    self._heap, (estimate, next(self._arrivals), key)
+                )
+
+    def _decay_heap(self):
+        # Halving can tie estimates that were apart, and ties go to the
+        # older arrival, so the heap is rebuilt (once per decay)
+        shift = self.sketch.decays - self._decays_seen
+        self._heap = [
+            (estimate >> shift, arrival, key)
+            for estimate, arrival, key in self._heap
+        ]
+        heapq.heapify(self._heap)
+        self._decays_seen = self.sketch.decays
+
+    def _least(self) -> tuple[Hashable, int]:
+        while True:
+            estimate, arrival, key = self._heap[0]
+            current = self.sketch.estimate(key)
+            if current == estimate:
+                return key, current
+            heapq.heapreplace(self._heap, (current, arrival, key))
+
+    def top(self, n: int | None = None, where=None) -> list[Hashable]:
+        with self._lock:
+            ranked = sorted(
+                (key for key in self.candidates if (where is None) or where(key)),
+                key=self.sketch.estimate,
+                reverse=True,
+            )
+        return ranked[: self.top_n if n is None else n]
+
+    def version_changed(self, scope: Hashable, version: str) -> bool:
+        """
+        Notes the current version for the scope (a timeframe). True the
+        first time a new version is seen, not when the process starts.
+        """
+        with self._lock:
+            previous = self.versions.get(scope)
+            self.versions[scope] = version
+            return (previous is not None) and (previous != version)
+
+    def start_measuring(self, scope: Hashable, keys: list[Hashable]):
+        with self._lock:
+            self._unseen_since_change[scope] = set(keys)
+
+    def measure(self, scope: Hashable, key: Hashable, hit: bool):
+        """
+        Counts the first request for a prewarmed key since the version
+        changed, and whether the cache already had it.
+        """
+        with self._lock:
+            unseen = self._unseen_since_change.get(scope)
+            if (unseen is None) or (key not in unseen):
+                return
+            unseen.discard(key)
+
+        metrics.increment("prewarm.first_requests")
+        if hit:
+            metrics.increment("prewarm.first_hits")
+
+    @staticmethod
+    def hit_rate() -> float | None:
+        counters = metrics.snapshot()["counters"]
+        requests = counters.get("prewarm.first_requests", 0)
+        if not requests:
+            return None
+        return counters.get("prewarm.first_hits", 0) / requests
@@ -1,13 +1,20 @@
+import re
 import time
 from enum import Enum, auto
 from dataclasses import dataclass
+from typing import Collection
 from django.conf import settings
+from django.core.cache import cache
 from returns.result import Result, Success, Failure
+import aiohttp
+import requests
 
-from .models import get_profile_template
-from .metadata import TimeFrame
-from .api_client import ApiClient
-from .utils import get_ratio, SUMMARY_LEVEL_DICT
+from .template_cache import get_request_plan, get_profile_template
+from .metadata import TimeFrame, release_for_timeframe
+from .plan import PlannedSection
+from .api_client import ApiClient, HipApiError
+from .api_client.dispatch import NotFound, RetriesExhausted
+from .utils import SUMMARY_LEVEL_DICT
 
 
 @dataclass
@@ -19,6 +26,59 @@ class ProfileRequest:
 
 class ProfileFailureModes(Enum):
     NO_PROFILE_AVAILABLE = auto()
+    NO_SECTION_AVAILABLE = auto()
+    # Failures for one geoid, remembered for a while (see NegativeCache)
+    UNKNOWN_GEOID = auto()
+    UPSTREAM_FAILURE = auto()
+    EMPTY_DATA = auto()
+
+
+# What the api client raises when the api is down or answers nonsense.
+# Anything else is a bug here, and isn't blamed on the api.
+UPSTREAM_ERRORS = (
+    HipApiError,
+    RetriesExhausted,
+    aiohttp.ClientError,
+    requests.RequestException,
+)
+
+GEOID_PATTERN = re.compile(r"(\d{3})\d{2}US[0-9A-Z]*")
+
+
+def valid_geoid(geoid: str) -> bool:
+    """
+    Whether the geoid could exist, from its shape and summary level,
+    without asking the api.
+    """
+    match = GEOID_PATTERN.fullmatch(geoid.upper())
+    return (match is not None) and (match.group(1) in SUMMARY_LEVEL_DICT)
+
+
+def fetch_geography_data(api_client: ApiClient, request: ProfileRequest, data_request) -> Result:
+    """
+    The geography and the data asked for, or the failure mode for whatever
+    went wrong getting them.
+    """
+    try:
+        geography = api_client.get_full_geography_object(request.geoid)
+    except NotFound:
+        return Failure(ProfileFailureModes.UNKNOWN_GEOID)
+    except UPSTREAM_ERRORS:
+        return Failure(ProfileFailureModes.UPSTREAM_FAILURE)
+
+    try:
+        namespace = api_client.get_data_dispatched(
+            data_request,
+            geography.show_lineage(),
+        )
+    except (NotFound, *UPSTREAM_ERRORS):
+        # The geography exists, so a missing table or chunk is the api's
+        return Failure(ProfileFailureModes.UPSTREAM_FAILURE)
+
+    if data_request and not namespace.get("data", {}).get(geography.full_geoid):
+        return Failure(ProfileFailureModes.EMPTY_DATA)
+
+    return Success((geography, namespace))
 
 
 def geo_profile(request: ProfileRequest) -> Result:
@@ -31,34 +91,38 @@ def geo_profile(request: ProfileRequest) -> Result:
     print("geoprofile started")
     start = time.monotonic()
 
+    if not valid_geoid(request.geoid):
+        return Failure(ProfileFailureModes.UNKNOWN_GEOID)
+
     api_client = ApiClient(settings.API_URL)
-    profile_template = get_profile_template()
-    if profile_template is None:
+
+    # The template, its metadata and the data request are planned once per
+    # template version and reused for every geoid.
+    request_plan = get_request_plan(request.timeframe, api_client)
+    if request_plan is None:
         return Failure(ProfileFailureModes.NO_PROFILE_AVAILABLE)
-    
-    print(f"template loaded at {round(time.monotonic() - start, 4)}s")
-    
-    # Check the design and metadata to prepare accurate data request
-    shopping_list = profile_template.collect_shopping_list()
-    metadata_pool = api_client.fill_metadata_pool(shopping_list)
-    year_data_request = metadata_pool.prepare_data_request(request.timeframe)
+
+    profile_template = request_plan.template
+    metadata_pool = request_plan.metadata_pool
+    year_data_request = request_plan.data_request
     
     print(f"data request prepared at {round(time.monotonic() - start, 4)}s")
 
     # Pull the data as designed
-    geography = api_client.get_full_geography_object(request.geoid)
-    namespace = api_client.get_data_dispatched(
-       year_data_request, 
-       geography.show_lineage(), 
-    )
+    match fetch_geography_data(api_client, request, year_data_request):
+        case Success((geography, namespace)):
+            pass
+        case failure:
+            return failure
 
     print(f"api call returned at {round(time.monotonic() - start, 4)}s")
     
     # Fill the tree with the returned data
-    profile = get_profile_template().populate(
+    profile = profile_template.populate(
         geography,
         namespace,
         metadata_pool,
+        request.timeframe,
     )
     
     print(f"profile filled at {round(time.monotonic() - start, 4)}s")
@@ -66,88 +130,146 @@ def geo_profile(request: ProfileRequest) -> Result:
     return Success(profile)
 
 
-"""
-Past this point is OG Census Reporter and could use a thoughtful refactor.
-"""
-
-
-def find_dicts_with_key(dictionary, searchkey):
-    stack = [dictionary]
-    dict_list = []
-    while stack:
-        d = stack.pop()
-        if searchkey in d:
-            dict_list.append(d)
-        for value in d.values():
-            if isinstance(value, dict):
-                stack.append(value)
+def section_cache_key(request: ProfileRequest, section: PlannedSection) -> str:
+    return (
+        f"smartcharts:section:{request.geoid.upper()}:"
+        f"{request.timeframe.value}:{release_for_timeframe(request.timeframe)}:"
+        f"{section.key}:{section.version}"
+    )
 
-    return dict_list
 
+def geo_section(request: ProfileRequest, section_key: str) -> Result:
+    """
+    Builds one section of the profile, so a page can load its sections
+    one at a time. Only the tables the section uses are requested, and
+    each section is cached on its own by its version and release.
+    """
+    if not valid_geoid(request.geoid):
+        return Failure(ProfileFailureModes.UNKNOWN_GEOID)
 
-def enhance_api_data(api_data):
-    dict_list = find_dicts_with_key(api_data, 'values')
+    api_client = ApiClient(settings.API_URL)
 
-    for d in dict_list:
-        raw = {}
-        enhanced = {}
-        try:
-            geo_value = d['values']['this']
-        except Exception:
-            geo_value = None
+    request_plan = get_request_plan(request.timeframe, api_client)
+    if request_plan is None:
+        return Failure(ProfileFailureModes.NO_PROFILE_AVAILABLE)
 
-        num_comparatives = 2
+    section = request_plan.template.section(section_key)
+    if section is None:
+        return Failure(ProfileFailureModes.NO_SECTION_AVAILABLE)
+
+    cache_key = section_cache_key(request, section)
+    if settings.SECTION_CACHE_TIMEOUT and (
+        (populated := cache.get(cache_key)) is not None
+    ):
+        return Success(populated)
+
+    match fetch_geography_data(
+        api_client, request, request_plan.section_request(section)
+    ):
+        case Success((geography, namespace)):
+            pass
+        case failure:
+            return failure
+
+    populated = {
+        "key": section.key,
+        **section.populate(
+            geography,
+            namespace,
+            request_plan.metadata_pool,
+            request.timeframe,
+        ),
+    }
+
+    if settings.SECTION_CACHE_TIMEOUT:
+        cache.set(cache_key, populated, settings.SECTION_CACHE_TIMEOUT)
+
+    return Success(populated)
+
+
+def current_profile_version(request: ProfileRequest) -> str:
+    """
+    Cached profiles are checked against this, so editing the template or
+    moving to a new release makes them stale without a manual bump.
+    """
+    template = get_profile_template()
+    if template is None:
+        return settings.PROFILE_VERSION
 
-        # create our containers for transformation
-        for obj in ['values', 'error', 'numerators', 'numerator_errors']:
-            raw[obj] = d[obj]
-            enhanced[obj] = {}
-        enhanced['index'] = {}
-        enhanced['error_ratio'] = {}
-        comparative_sumlevs = []
+    return template.profile_version(request.timeframe)
 
-        # enhance
-        for sumlevel in ['this', 'place', 'CBSA', 'county', 'state', 'nation']:
 
-            # favor CBSA over county, but we don't want both
-            if sumlevel == 'county' and 'CBSA' in enhanced['values']:
-                continue
+def current_line_items(request: ProfileRequest) -> dict | None:
+    """
+    What a profile built now would record about its designs, to compare
+    against a cached one.
+    """
+    template = get_profile_template()
+    if template is None:
+        return None
 
-            # add the index value for comparatives
-            if sumlevel in raw['values']:
-                enhanced['values'][sumlevel] = raw['values'][sumlevel]
-                if geo_value:
-                    enhanced['index'][sumlevel] = get_ratio(geo_value, raw['values'][sumlevel])
-                else:
-                    enhanced['index'][sumlevel] = 0
+    return {
+        "release_id": release_for_timeframe(request.timeframe),
+        "profile_format": settings.PROFILE_VERSION,
+        "line_items": template.line_items(),
+    }
 
 
-                # add to our list of comparatives for the template to use
-                if sumlevel != 'this':
-                    comparative_sumlevs.append(sumlevel)
+def geo_partial_profile(request: ProfileRequest, paths: Collection[str]) -> Result:
+    """
+    Fills only the designs at the given paths, asking the api for just
+    their tables. The rest of the profile is expected to come from the
+    cache (see GeoProfileBuilder.complete_order).
+    """
+    if not valid_geoid(request.geoid):
+        return Failure(ProfileFailureModes.UNKNOWN_GEOID)
 
-            # add the moe ratios
-            if (sumlevel in raw['values']) and (sumlevel in raw['error']):
-                enhanced['error'][sumlevel] = raw['error'][sumlevel]
-                enhanced['error_ratio'][sumlevel] = get_ratio(raw['error'][sumlevel], raw['values'][sumlevel], 3)
+    api_client = ApiClient(settings.API_URL)
 
-            # add the numerators and numerator_errors
-            if sumlevel in raw['numerators']:
-                enhanced['numerators'][sumlevel] = raw['numerators'][sumlevel]
+    request_plan = get_request_plan(request.timeframe, api_client)
+    if request_plan is None:
+        return Failure(ProfileFailureModes.NO_PROFILE_AVAILABLE)
 
-            if (sumlevel in raw['numerators']) and (sumlevel in raw['numerator_errors']):
-                enhanced['numerator_errors'][sumlevel] = raw['numerator_errors'][sumlevel]
+    template = request_plan.template
+    match fetch_geography_data(
+        api_client,
+        request,
+        request_plan.request_for(template.shopping_list_for(paths)),
+    ):
+        case Success((geography, namespace)):
+            pass
+        case failure:
+            return failure
+
+    return Success(
+        {
+            "sections": template.populate_line_items(
+                paths,
+                geography,
+                namespace,
+                request_plan.metadata_pool,
+                request.timeframe,
+            ),
+            "release_id": release_for_timeframe(request.timeframe),
+            "profile_format": settings.PROFILE_VERSION,
+            "section_versions": template.section_versions(),
+            "line_items": template.line_items(),
+        }
+    )
 
-            if len(enhanced['values']) >= (num_comparatives + 1):
-                break
 
-        # replace data with enhanced version
-        for obj in ['values', 'index', 'error', 'error_ratio', 'numerators', 'numerator_errors']:
-            d[obj] = enhanced[obj]
+"""
+Past this point is OG Census Reporter and could use a thoughtful refactor.
+"""
 
-        api_data['geography']['comparatives'] = comparative_sumlevs
 
-    # Put this down here to make sure geoid is valid before using it
+def enhance_api_data(api_data):
+    """
+    The stat-level index / error_ratio / comparative selection that Census
+    Reporter did here now happens once in saturate, so this only fills in
+    the geography details the template expects.
+    """
+    # Make sure geoid is valid before using it
     sumlevel = api_data['geography']['this']['sumlevel']
     api_data['geography']['this']['sumlevel_name'] = SUMMARY_LEVEL_DICT[sumlevel]['name']
     api_data['geography']['this']['short_geoid'] = api_data['geography']['this']['full_geoid'].split('US')[1]
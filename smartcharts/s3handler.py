@@ -1,16 +1,56 @@
 from abc import ABC
+from dataclasses import dataclass
+from typing import Callable
 
 from io import BytesIO
+from threading import Lock
 import json
-import gzip
+import os
 
+from django.conf import settings
 from django.utils.safestring import SafeString
 
 import boto3
 import botocore
+from botocore.config import Config
 
 from returns.result import Result, Success, Failure
 from .profile import ProfileRequest
+from .compression import CompressedJSONStream, get_codec
+from . import metrics
+
+
+@dataclass
+class StaleProfile:
+    """
+    A cache miss that still carries the out of date profile, so the
+    builder can bring it up to date instead of starting over. The profile
+    can be given as a loader, so it's only downloaded if it's used.
+    """
+
+    message: str
+    _profile: dict | Callable[[], dict]
+
+    @property
+    def profile(self) -> dict:
+        if callable(self._profile):
+            self._profile = self._profile()
+        return self._profile
+
+    def __str__(self):
+        return self.message
+
+
+def resolve_version(
+    profile_version: str | Callable[[ProfileRequest], str], request: ProfileRequest
+) -> str:
+    """
+    The version can be fixed, or worked out per request (see
+    profile.current_profile_version).
+    """
+    if callable(profile_version):
+        return profile_version(request)
+    return profile_version
 
 
 class CacheHandler(ABC):
@@ -23,10 +63,69 @@ class CacheHandler(ABC):
     def check_cache(self, *args, **kwargs):
         pass
 
+    def cache_profile(self, *args, **kwargs):
+        pass
+
+    def check_cache_gzip(self, request: ProfileRequest) -> Result:
+        """
+        The current profile exactly as stored, gzipped JSON, for handing
+        straight to a client. Caches that don't store it that way miss.
+        """
+        return Failure("This cache doesn't store gzipped profiles.")
+
     def write_profile_json(self, *args, **kwargs):
         pass
 
 
+# Stored as x-amz-meta-profile-version on every profile object
+VERSION_METADATA_KEY = "profile-version"
+
+AWS_REGION = "us-east-2"
+
+# One client per process and set of credentials. boto3 clients are safe to
+# share between threads (sessions and resources aren't), and each keeps a
+# pool of open connections, so handlers built per request reuse both.
+_clients: dict[tuple, object] = {}
+_clients_lock = Lock()
+
+
+def s3_config() -> Config:
+    return Config(
+        max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS,
+        connect_timeout=settings.S3_CONNECT_TIMEOUT,
+        read_timeout=settings.S3_READ_TIMEOUT,
+        retries={"max_attempts": settings.S3_MAX_ATTEMPTS, "mode": "standard"},
+    )
+
+
+def get_s3_client(aws_key: str, aws_secret: str):
+    # Keyed by pid too, a forked worker mustn't share its parent's sockets
+    key = (os.getpid(), aws_key, aws_secret, settings.S3_ENDPOINT_URL)
+
+    if (client := _clients.get(key)) is not None:
+        return client
+
+    with _clients_lock:
+        if key not in _clients:
+            with metrics.timed("s3.client_startup"):
+                session = boto3.Session(
+                    aws_access_key_id=aws_key,
+                    aws_secret_access_key=aws_secret,
+                    region_name=AWS_REGION,
+                )
+                _clients[key] = session.client(
+                    "s3",
+                    config=s3_config(),
+                    endpoint_url=settings.S3_ENDPOINT_URL,
+                )
+        return _clients[key]
+
+
+def reset_s3_clients():
+    with _clients_lock:
+        _clients.clear()
+
+
 class S3Handler(CacheHandler):
     def __init__(
         self,
@@ -34,28 +133,31 @@ class S3Handler(CacheHandler):
         aws_secret: str,
         servername: str,
         root_file: str,
-        profile_version: str,
+        profile_version: str | Callable[[ProfileRequest], str],
         dont_check: bool = False,
         dont_update: bool = False,
+        codec: str = "gzip",
+        compression_level: int | None = None,
     ):
         self.servername = servername
         self.root_file = root_file
         self.profile_version = profile_version
+        self.codec = get_codec(codec)
+        self.compression_level = compression_level
 
         if (not dont_check) | (not dont_update):
-            session = boto3.Session(
-                aws_access_key_id=aws_key,
-                aws_secret_access_key=aws_secret,
-                region_name="us-east-2",
-            )
-            self.s3 = session.resource("s3")
+            self.s3 = get_s3_client(aws_key, aws_secret)
 
         if dont_check:
             self.check_cache = self.dont_check_cache
+            self.check_cache_gzip = self.dont_check_cache
 
         if dont_update:
             self.cache_profile = self.dont_cache_profile
 
+    def current_version(self, request: ProfileRequest) -> str:
+        return resolve_version(self.profile_version, request)
+
     def to_keyname(self, request: ProfileRequest):
         return f"1.0/data/{self.root_file}/{request.timeframe.value.lower()}/{request.geoid.upper()}"
 
@@ -63,31 +165,115 @@ class S3Handler(CacheHandler):
         return Failure("This S3 handler is configured to skip checking the cache.")
 
     def check_cache(self, request: ProfileRequest) -> Result:
-        s3_object = self.s3.Object(self.servername, self.to_keyname(request))
+        """
+        One GET per check. The version comes back in the object metadata
+        with the headers, so a stale profile is only downloaded if the
+        builder asks for it.
+        """
+        match self.get_profile_object(request):
+            case Success(response):
+                pass
+            case failure:
+                return failure
+
+        version = self.current_version(request)
+        cached_version = response.get("Metadata", {}).get(VERSION_METADATA_KEY)
+
+        encoding = response.get("ContentEncoding") or "gzip"
+
+        if cached_version is None:
+            # Written before the version was stored as metadata
+            profile_data = self.unpack_body(response["Body"], encoding)
+            cached_version = profile_data.get("profile_version", "")
+
+            if cached_version == version:
+                return Success(profile_data)
+            return Failure(
+                StaleProfile("The profile must be updated for this geoid.", profile_data)
+            )
+
+        if cached_version != version:
+            # Don't hold a connection open for a profile that may not be
+            # used; it's fetched again if the builder asks for it
+            response["Body"].close()
+            return Failure(
+                StaleProfile(
+                    "The profile must be updated for this geoid.",
+                    lambda: self.load_profile(request),
+                )
+            )
+
+        return Success(self.unpack_body(response["Body"], encoding))
 
+    def is_current(self, request: ProfileRequest) -> bool:
+        """
+        Whether the stored profile is the current version, from a HEAD
+        request, for callers that don't want the profile itself.
+        """
+        try:
+            with metrics.timed("s3.head"):
+                response = self.s3.head_object(
+                    Bucket=self.servername, Key=self.to_keyname(request)
+                )
+        except botocore.exceptions.ClientError:
+            return False
+
+        return response.get("Metadata", {}).get(
+            VERSION_METADATA_KEY
+        ) == self.current_version(request)
+
+    def check_cache_gzip(self, request: ProfileRequest) -> Result:
+        match self.get_profile_object(request):
+            case Success(response):
+                pass
+            case failure:
+                return failure
+
+        cached_version = response.get("Metadata", {}).get(VERSION_METADATA_KEY)
+        if cached_version != self.current_version(request):
+            response["Body"].close()
+            return Failure("The cached profile for this geoid isn't current.")
+
+        if (response.get("ContentEncoding") or "gzip") != "gzip":
+            response["Body"].close()
+            return Failure("The cached profile for this geoid isn't gzipped.")
+
+        return Success(response["Body"].read())
+
+    def get_profile_object(self, request: ProfileRequest) -> Result:
         try:
-            s3_object.load()
+            with metrics.timed("s3.get"):
+                return Success(
+                    self.s3.get_object(
+                        Bucket=self.servername, Key=self.to_keyname(request)
+                    )
+                )
 
         except botocore.exceptions.ClientError as e:
-            if e.response["Error"]["Code"] == "404":
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
                 return Failure("This geoid hasn't been cached for this year yet.")
             else:
                 return Failure("There is an error connecting to S3.")
-        
-        profile_data = self.unpack_response(s3_object)
 
-        if profile_data.get("profile_version", "") == self.profile_version:
-            return Success(profile_data)
-
-        return Failure("The profile must be updated for this geoid.")
-
-    def unpack_response(self, s3_object):
-        buffer = BytesIO(s3_object.get()["Body"].read())
+    def load_profile(self, request: ProfileRequest) -> dict:
+        """
+        The stored profile, whatever its version. S3 errors are raised.
+        """
+        with metrics.timed("s3.get"):
+            response = self.s3.get_object(
+                Bucket=self.servername, Key=self.to_keyname(request)
+            )
+        return self.unpack_response(response)
 
-        compressed = gzip.GzipFile(fileobj=buffer)
+    def unpack_response(self, response: dict):
+        # A GetObject response
+        return self.unpack_body(
+            response["Body"], response.get("ContentEncoding") or "gzip"
+        )
 
+    def unpack_body(self, body, encoding: str = "gzip"):
         # Read the decompressed JSON from S3
-        string_as_bytes = compressed.read()
+        string_as_bytes = get_codec(encoding).decompress(body.read())
         profile_data_json = string_as_bytes.decode()
 
         # Load it into a Python dict for the template
@@ -100,28 +286,57 @@ class S3Handler(CacheHandler):
         pass
 
     def cache_profile(self, request: ProfileRequest, profile: dict):
-        s3_object = self.s3.Object(self.servername, self.to_keyname(request))
-        profile.update({"profile_version": self.profile_version})
-        profile_json = json.dumps(profile)
-
-        self.write_profile_json(s3_object, profile_json, request)
-
-    def write_profile_json(self, s3_object, profile_json, request: ProfileRequest):
-        data_as_bytes = str.encode(profile_json)
-
-        # create gzipped version of json in memory
-        memfile = BytesIO()
+        """
+        Streams the profile to S3: the JSON is encoded and compressed a
+        chunk at a time as the upload reads it, and large profiles go up
+        as a multipart upload.
+        """
+        version = self.current_version(request)
+        profile.update({"profile_version": version})
+        # The json is rebuilt from the object on the way out
+        stored = {
+            key: value
+            for key, value in profile.items()
+            if key != "profile_data_json"
+        }
+
+        with metrics.timed("s3.put"):
+            self.s3.upload_fileobj(
+                CompressedJSONStream(stored, self.codec, self.compression_level),
+                self.servername,
+                self.to_keyname(request),
+                ExtraArgs=self.object_args(version),
+            )
 
-        with gzip.GzipFile(
-            filename=self.to_keyname(request), mode="wb", fileobj=memfile
-        ) as gzip_data:
-            gzip_data.write(data_as_bytes)
-        memfile.seek(0)
+    def write_profile_json(
+        self,
+        profile_json,
+        request: ProfileRequest,
+        version: str | None = None,
+    ):
+        """
+        For a profile that is already a JSON string.
+        """
+        compressor = self.codec.compressor(
+            self.codec.default_level
+            if self.compression_level is None
+            else self.compression_level
+        )
+        compressed = compressor.compress(str.encode(profile_json)) + compressor.flush()
 
         # store static version on S3
-        s3_object.put(
-            Body=memfile,
-            ContentType="application/json",
-            ContentEncoding="gzip",
-            StorageClass="REDUCED_REDUNDANCY",
-        )
+        with metrics.timed("s3.put"):
+            self.s3.put_object(
+                Bucket=self.servername,
+                Key=self.to_keyname(request),
+                Body=BytesIO(compressed),
+                **self.object_args(version),
+            )
+
+    def object_args(self, version: str | None) -> dict:
+        return {
+            "ContentType": "application/json",
+            "ContentEncoding": self.codec.name,
+            "StorageClass": "REDUCED_REDUNDANCY",
+            "Metadata": {VERSION_METADATA_KEY: version} if version else {},
+        }
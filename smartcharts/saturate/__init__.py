@@ -2,40 +2,84 @@
 Build item is coupled to the CR api responses, where lesp is not.
 """
 
-from dataclasses import dataclass, field, asdict
 from lesp.core import execute
 
-from .datatypes import TerracedValue, Relation, Estimate, TerracedEstimate
+from .datatypes import Relation, Estimate, TerracedEstimate
 from .namespace import Namespace
+from .memo import ResultCache, program_hash
+from ..utils import get_ratio
 
 
-def rounded_ratio(first: float | int, second: float | int) -> int:
-    return round(round(first / second, 2) * 100)
+# The order Census Reporter prefers its comparatives in.
+COMPARATIVE_PRIORITY = ("this", "place", "CBSA", "county", "state", "nation")
+MAX_COMPARATIVES = 2
 
 
-def index_to_main_geo(values: TerracedValue) -> TerracedValue:
-    root_geo_value = values["this"]
-    return {
-        key: rounded_ratio(root_geo_value, value)
-        for key, value in values.items()
-    }
+def select_comparatives(
+    parents: list[dict[str, str]]
+) -> list[dict[str, str]]:
+    """
+    Picks the geography itself and at most two comparatives from the
+    lineage, favoring CBSA over county (but never both). Only these
+    relations are evaluated and written to the profile.
+    """
+    by_relation = {geography["relation"]: geography for geography in parents}
+    selected = []
+
+    for relation in COMPARATIVE_PRIORITY:
+        if relation == "county" and "CBSA" in by_relation:
+            continue
+
+        if relation in by_relation:
+            selected.append(by_relation[relation])
+
+        if len(selected) >= (MAX_COMPARATIVES + 1):
+            break
+
+    return selected
 
 
 def transpose_estimate(
+    name: str,
     distributions: dict[Relation, Estimate]
 ) -> TerracedEstimate:
-    result = TerracedEstimate()
+    """
+    Writes the estimates straight into the terraced layout Census Reporter
+    expects, filling every per-relation dict (including the index and
+    error ratios) in a single pass.
+    """
+    values = {}
+    error = {}
+    numerators = {}
+    numerator_errors = {}
+    error_ratio = {}
+    index = {}
 
-    for relation, distribution in distributions.items():
-        result.values[relation] = distribution.value
-        result.error[relation] = distribution.error
-        result.numerators[relation] = distribution.numerator
-        result.numerator_errors[relation] = distribution.numerator_moe
-        result.error_ratio[relation] = distribution.error_ratio
+    root_geo_value = distributions["this"].value
 
-    result.index = index_to_main_geo(result.values)
+    for relation, distribution in distributions.items():
+        values[relation] = distribution.value
+        error[relation] = distribution.error
+        numerators[relation] = distribution.numerator
+        numerator_errors[relation] = distribution.numerator_moe
+        error_ratio[relation] = get_ratio(
+            distribution.error, distribution.value, 3
+        )
+        index[relation] = (
+            get_ratio(root_geo_value, distribution.value)
+            if root_geo_value
+            else 0
+        )
 
-    return result
+    return {
+        "name": name,
+        "values": values,
+        "error": error,
+        "numerators": numerators,
+        "numerator_errors": numerator_errors,
+        "error_ratio": error_ratio,
+        "index": index,
+    }
 
 
 def saturate_datapoint(
@@ -43,15 +87,30 @@ def saturate_datapoint(
     api_response: dict,
     parents: list[dict[str, str]],
     lesp_code: str,
-):
-    estimates = {
-        geography["relation"]: execute(
-            lesp_code,
-            namespace=Namespace(api_response["data"][geography["geoid"]]),
-        )
-        for geography in parents
-    }
+    release: str | None = None,
+    cache: ResultCache | None = None,
+) -> TerracedEstimate:
+    """
+    Evaluates the program for the geography and its comparatives. When a
+    cache and release are given, estimates already computed for the same
+    program, geoid and release (usually the shared parents) are reused.
+    """
+    use_cache = (cache is not None) and (release is not None)
+    program = program_hash(lesp_code) if use_cache else None
+    estimates = {}
+
+    for geography in select_comparatives(parents):
+        key = (program, geography["geoid"], release)
+        estimate = cache.get(key) if use_cache else None
+
+        if estimate is None:
+            estimate = execute(
+                lesp_code,
+                namespace=Namespace(api_response["data"][geography["geoid"]]),
+            )
+            if use_cache:
+                cache.put(key, estimate)
 
-    terraced_estimate = transpose_estimate(estimates)
+        estimates[geography["relation"]] = estimate
 
-    return {"name": name, **asdict(terraced_estimate)}
+    return transpose_estimate(name, estimates)
@@ -0,0 +1,150 @@
+"""
+Static analysis of lesp programs.
+
+This reads a program without running it so that broken or expensive
+datapoints are caught when they are saved instead of when a profile
+is built. It parses the program, folds any arithmetic on literals and
+counts how many operations are left to run for each geography.
+
+The variables (and so the tables) come from lesp's own extract_variables,
+the same reader migration 0007 backfilled with. The tree built here is
+only used to check the structure and count the cost; lesp doesn't expose
+a parse tree to walk instead.
+"""
+
+import re
+from dataclasses import dataclass
+from functools import reduce
+import operator
+
+from lesp.analyze import extract_variables
+
+
+class LespAnalysisError(ValueError):
+    """
+    The program can't be read or would fail no matter the data.
+    """
+
+
+ARITHMETIC = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "/": operator.truediv,
+}
+
+TOKEN_PATTERN = re.compile(r"[()]|[^\s()]+")
+
+Node = float | str | list
+
+
+def tokenize(lesp_code: str) -> list[str]:
+    return TOKEN_PATTERN.findall(lesp_code)
+
+
+def to_atom(token: str) -> float | str:
+    try:
+        return float(token)
+    except ValueError:
+        return token
+
+
+def parse(lesp_code: str) -> Node:
+    tokens = tokenize(lesp_code)
+    if not tokens:
+        raise LespAnalysisError("The program is empty.")
+
+    stack: list[list] = [[]]
+    for token in tokens:
+        if token == "(":
+            stack.append([])
+        elif token == ")":
+            if len(stack) == 1:
+                raise LespAnalysisError("There is an unmatched ')'.")
+            expression = stack.pop()
+            if not expression:
+                raise LespAnalysisError("There is an empty expression '()'.")
+            stack[-1].append(expression)
+        else:
+            stack[-1].append(to_atom(token))
+
+    if len(stack) > 1:
+        raise LespAnalysisError("There is an unmatched '('.")
+
+    (program, *rest) = stack[0]
+    if rest:
+        raise LespAnalysisError(
+            "The program has more than one top-level expression."
+        )
+
+    return program
+
+
+def fold_constants(node: Node) -> Node:
+    """
+    Replaces arithmetic on literals with its result, so
+    (* (/ 1 4) B01001002) becomes (* 0.25 B01001002).
+    """
+    if not isinstance(node, list):
+        return node
+
+    head, *args = node
+    args = [fold_constants(arg) for arg in args]
+
+    if (head == "/") and any(arg == 0.0 for arg in args[1:]):
+        raise LespAnalysisError(f"The program divides by zero in {node}.")
+
+    # lesp decides what a lone (- x) or (/ x) means, so those are left
+    # for it to run rather than folded to x.
+    if (head in ("-", "/")) and (len(args) == 1):
+        return [head, *args]
+
+    if (head in ARITHMETIC) and args and all(
+        isinstance(arg, float) for arg in args
+    ):
+        return float(reduce(ARITHMETIC[head], args))
+
+    return [head, *args]
+
+
+def count_operations(node: Node) -> int:
+    """
+    Each variable read and each binary arithmetic step counts as one
+    operation.
+    """
+    if isinstance(node, float):
+        return 0
+    if isinstance(node, str):
+        return 1
+
+    head, *args = node
+    return max(len(args) - 1, 1) + sum(count_operations(arg) for arg in args)
+
+
+@dataclass(frozen=True, slots=True)
+class ProgramAnalysis:
+    program: Node
+    variables: tuple[str, ...]
+    tables: tuple[str, ...]
+    cost: int
+
+
+def analyze_program(lesp_code: str) -> ProgramAnalysis:
+    program = fold_constants(parse(lesp_code))
+
+    if isinstance(program, float):
+        raise LespAnalysisError(
+            "The program is a constant and doesn't read any variables."
+        )
+
+    try:
+        variables = sorted(set(extract_variables(lesp_code)))
+    except Exception as e:
+        raise LespAnalysisError(f"lesp can't read the program: {e}")
+
+    return ProgramAnalysis(
+        program=program,
+        variables=tuple(variables),
+        tables=tuple(sorted({var[:-3] for var in variables})),
+        cost=count_operations(program),
+    )
@@ -1,5 +1,5 @@
-from typing import Union
-from dataclasses import dataclass, field
+from typing import Union, TypedDict
+from dataclasses import dataclass
 
 from .error_ops import moe_add, moe_proportion
 
@@ -109,16 +109,19 @@ Relation = str
 TerracedValue = dict[str, float | None]
 
 
-@dataclass
-class TerracedEstimate:
+class TerracedEstimate(TypedDict):
     """
-    The inexplicable way that Census Reporter would like the values
+    The inexplicable way that Census Reporter would like the values.
+
+    This is a plain dict so the saturated datapoint is already in its
+    final output shape and never has to be copied or converted.
     """
-    values: TerracedValue = field(default_factory=dict)
-    error: TerracedValue = field(default_factory=dict)
-    numerators: TerracedValue = field(default_factory=dict)
-    numerator_errors: TerracedValue = field(default_factory=dict)
-    error_ratio: TerracedValue = field(default_factory=dict)
-    index: TerracedValue = field(default_factory=dict)
+    name: str
+    values: TerracedValue
+    error: TerracedValue
+    numerators: TerracedValue
+    numerator_errors: TerracedValue
+    error_ratio: TerracedValue
+    index: TerracedValue
 
 
@@ -0,0 +1,60 @@
+"""
+The state and nation values for a datapoint are the same for every
+geography built within a release, so evaluated estimates are memoized
+across profiles keyed by (program hash, geoid, release). The compiled
+template cache clears them whenever the template changes.
+"""
+
+from collections import OrderedDict
+from functools import lru_cache
+from hashlib import sha1
+from threading import Lock
+from typing import Hashable
+
+from .datatypes import Estimate
+
+
+@lru_cache(maxsize=4096)
+def program_hash(lesp_code: str) -> str:
+    return sha1(lesp_code.encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    A bounded, thread-safe LRU of evaluated estimates.
+    """
+
+    def __init__(self, maxsize: int = 10_000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, Estimate] = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: Hashable) -> Estimate | None:
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return self._entries[key]
+
+    def put(self, key: Hashable, estimate: Estimate):
+        with self._lock:
+            self._entries[key] = estimate
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,46 @@
+"""
+Any change to a template model invalidates the compiled template, once
+the change is committed. Invalidating inside the writer's transaction
+would let another process reload the old template before the commit and
+keep it as current.
+"""
+
+from django.apps import apps
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
+
+from .template_cache import compiled_templates
+
+
+def invalidate_template(sender, **kwargs):
+    transaction.on_commit(compiled_templates.invalidate)
+
+
+def invalidate_template_on_m2m(sender, action, **kwargs):
+    if action in ("post_add", "post_remove", "post_clear"):
+        transaction.on_commit(compiled_templates.invalidate)
+
+
+def connect_template_signals():
+    through_models = set()
+
+    for model in apps.get_app_config("smartcharts").get_models():
+        post_save.connect(
+            invalidate_template,
+            sender=model,
+            dispatch_uid=f"smartcharts_save_{model.__name__}",
+        )
+        post_delete.connect(
+            invalidate_template,
+            sender=model,
+            dispatch_uid=f"smartcharts_delete_{model.__name__}",
+        )
+        for field in model._meta.local_many_to_many:
+            through_models.add(field.remote_field.through)
+
+    for through in through_models:
+        m2m_changed.connect(
+            invalidate_template_on_m2m,
+            sender=through,
+            dispatch_uid=f"smartcharts_m2m_{through.__name__}",
+        )
@@ -0,0 +1,120 @@
+"""
+Template Cache
+
+Each process keeps the compiled ProfilePlan in memory with no expiry.
+Whenever a template model changes, the signal handlers in signals.py
+replace a version token in the shared Django cache. Every worker checks
+that token before using its copy and recompiles when it has changed.
+
+Tokens are random rather than a counter, so a key that's evicted and
+started again can't come back round to a version a worker already has.
+A missing key gets a new token, and every worker recompiles once.
+
+The token only reaches other workers when CACHES points at a backend
+they share (memcached, redis, the database cache, ...). Recompiling also
+clears the process's memoized datapoint results (plan.datapoint_results).
+"""
+
+from threading import Lock
+from typing import Callable
+import uuid
+
+from django.core.cache import cache
+
+from .models import load_profile_plan
+from .metadata import TimeFrame
+from .plan import ProfilePlan, RequestPlan, datapoint_results
+
+
+TEMPLATE_VERSION_KEY = "smartcharts:profile_template_version"
+
+
+class CompiledTemplateCache:
+    def __init__(self, loader: Callable[[], ProfilePlan | None]):
+        self.loader = loader
+        self._lock = Lock()
+        self._plan: ProfilePlan | None = None
+        self._version: str | None = None
+        self._request_lock = Lock()
+        self._request_plans: dict[TimeFrame, RequestPlan] = {}
+
+    def shared_version(self) -> str:
+        if (version := cache.get(TEMPLATE_VERSION_KEY)) is None:
+            # Another process may add one first; everyone uses whichever won
+            token = uuid.uuid4().hex
+            cache.add(TEMPLATE_VERSION_KEY, token, None)
+            version = cache.get(TEMPLATE_VERSION_KEY, token)
+        return version
+
+    def get(self) -> ProfilePlan | None:
+        version = self.shared_version()
+
+        with self._lock:
+            if self._version != version:
+                # Estimates memoized for the old template's datapoints
+                # aren't kept past it
+                datapoint_results.clear()
+                # If the template changes while this loads, the stored
+                # version is already behind and the next call reloads.
+                self._plan = self.loader()
+                self._version = version
+
+            return self._plan
+
+    def get_request_plan(
+        self, timeframe: TimeFrame, api_client
+    ) -> RequestPlan | None:
+        """
+        The metadata pool and the per-timeframe grouped data request for
+        the current template, built on first use and then reused until
+        the template changes.
+        """
+        if (template := self.get()) is None:
+            return None
+
+        with self._request_lock:
+            request_plan = self._request_plans.get(timeframe)
+            if (request_plan is not None) and (request_plan.template is template):
+                return request_plan
+
+            # The metadata pool doesn't depend on the timeframe, so share it
+            metadata_pool = next(
+                (
+                    plan.metadata_pool
+                    for plan in self._request_plans.values()
+                    if plan.template is template
+                ),
+                None,
+            ) or api_client.fill_metadata_pool(template.shopping_list)
+
+            request_plan = RequestPlan(
+                template=template,
+                timeframe=timeframe,
+                metadata_pool=metadata_pool,
+                data_request=metadata_pool.prepare_data_request(timeframe),
+            )
+            self._request_plans[timeframe] = request_plan
+
+            return request_plan
+
+    def invalidate(self):
+        cache.set(TEMPLATE_VERSION_KEY, uuid.uuid4().hex, None)
+
+        with self._lock:
+            self._plan = None
+            self._version = None
+            datapoint_results.clear()
+
+        with self._request_lock:
+            self._request_plans = {}
+
+
+compiled_templates = CompiledTemplateCache(load_profile_plan)
+
+
+def get_profile_template() -> ProfilePlan | None:
+    return compiled_templates.get()
+
+
+def get_request_plan(timeframe: TimeFrame, api_client) -> RequestPlan | None:
+    return compiled_templates.get_request_plan(timeframe, api_client)
@@ -0,0 +1,173 @@
+"""
+Templates, geographies and api stand-ins shared by the tests and by the
+management commands that measure profile builds.
+"""
+
+from ..metadata import MetadataPool, TableMetadataPlaceholder
+from ..models import (
+    DataPoint,
+    StatList,
+    ColumnChart,
+    GroupedColumnChart,
+    Row,
+    Section,
+    Profile,
+)
+from ..api_client.geography import Geography
+
+
+DETROIT_GEOID = "06000US2616322000"
+
+
+def build_template(profile: Profile, num_sections: int):
+    """
+    A synthetic template with a stat list, a column chart and a grouped
+    column chart in every section, all reading B01001 and B19013.
+    """
+    for i in range(num_sections):
+        section = Section.objects.create(
+            title=f"Section {i}", order=i, profile=profile
+        )
+        row = Row.objects.create(title=f"Row {i}", section=section)
+
+        point = DataPoint.objects.create(
+            identifier=f"point_{i}",
+            display_name=f"Point {i}",
+            lesp_code="(/ B01001002 B01001001)",
+        )
+        other = DataPoint.objects.create(
+            identifier=f"other_{i}",
+            display_name=f"Other {i}",
+            lesp_code="(/ B19013002 B19013001)",
+        )
+
+        design_fields = dict(
+            _width="QUARTER", _comparison_type="BINARY", _paradigm="CR"
+        )
+        stat = StatList.objects.create(
+            title=f"Stat {i}", stat=point, **design_fields
+        )
+        chart = ColumnChart.objects.create(title=f"Chart {i}", **design_fields)
+        chart.columns.add(point, other)
+        grouped = GroupedColumnChart.objects.create(
+            title=f"Grouped {i}", **design_fields
+        )
+        grouped.sub_charts.add(chart)
+
+        row.items.add(stat, through_defaults={"order": 0})
+        row.items.add(chart, through_defaults={"order": 1})
+        row.items.add(grouped, through_defaults={"order": 2})
+
+
+def build_synthetic_template(num_sections: int) -> Profile:
+    """
+    Every section gets a row with a stat list, a column chart and a grouped
+    column chart, each reading its own table.
+    """
+    profile = Profile.objects.create(title=f"Synthetic ({num_sections})")
+    design_fields = dict(
+        _width="QUARTER", _comparison_type="BINARY", _paradigm="CR"
+    )
+
+    for i in range(num_sections):
+        table = f"B9{i:04d}"
+        section = Section.objects.create(
+            title=f"Section {i}", order=i, profile=profile
+        )
+        row = Row.objects.create(title=f"Row {i}", section=section)
+
+        share = DataPoint.objects.create(
+            identifier=f"share_{i}",
+            display_name=f"Share {i}",
+            lesp_code=f"(* 100 (/ {table}002 {table}001))",
+        )
+        total = DataPoint.objects.create(
+            identifier=f"total_{i}",
+            display_name=f"Total {i}",
+            lesp_code=f"(+ {table}001 {table}002)",
+        )
+
+        stat = StatList.objects.create(
+            title=f"Stat {i}", stat=share, stat_type="PCT", **design_fields
+        )
+        chart = ColumnChart.objects.create(title=f"Chart {i}", **design_fields)
+        chart.columns.add(share, total)
+        grouped = GroupedColumnChart.objects.create(
+            title=f"Grouped {i}", **design_fields
+        )
+        grouped.sub_charts.add(chart)
+
+        row.items.add(stat, through_defaults={"order": 0})
+        row.items.add(chart, through_defaults={"order": 1})
+        row.items.add(grouped, through_defaults={"order": 2})
+
+    return profile
+
+
+def detroit() -> Geography:
+    return Geography(
+        "Detroit City, Wayne County, Michigan",
+        DETROIT_GEOID,
+        short_name="Detroit",
+        land_area=2589988,
+        total_population=100,
+        root=True,
+    )
+
+
+def synthetic_data(tables: set[str], geography: Geography) -> dict:
+    return {
+        "release": {"name": "Synthetic release"},
+        "tables": {
+            table: {
+                "title": f"Synthetic {table}",
+                "universe": "Everyone",
+                "columns": {
+                    f"{table}001": {"name": "Total:", "indent": 0},
+                    f"{table}002": {"name": "Some:", "indent": 1},
+                },
+            }
+            for table in tables
+        },
+        "data": {
+            geoid: {
+                table: {
+                    "estimate": {f"{table}001": 1000.0, f"{table}002": 250.0},
+                    "error": {f"{table}001": 20.0, f"{table}002": 10.0},
+                }
+                for table in tables
+            }
+            for geoid in geography.show_lineage()
+        },
+    }
+
+
+def placeholder_pool(tables) -> MetadataPool:
+    return MetadataPool(
+        tables={
+            table.lower(): TableMetadataPlaceholder(table.lower())
+            for table in tables
+        }
+    )
+
+
+def populate_inputs(plan, geography: Geography) -> tuple[dict, MetadataPool]:
+    """
+    The api response and metadata for populating every table in the plan.
+    """
+    tables = {table.name for table in plan.shopping_list}
+    return synthetic_data(tables, geography), placeholder_pool(tables)
+
+
+class PlaceholderClient:
+    """
+    An ApiClient stand-in for patching into smartcharts.profile, answering
+    metadata requests with placeholders. Tests override the geography and
+    data calls.
+    """
+
+    def __init__(self, *_):
+        pass
+
+    def fill_metadata_pool(self, shopping_list):
+        return placeholder_pool(table.name for table in shopping_list)
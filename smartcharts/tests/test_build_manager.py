@@ -1,12 +1,19 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
 import logging
+import time
 from unittest.mock import Mock
 
 import pytest
 from returns.result import Result, Success, Failure
 
-from ..profile import ProfileRequest, TimeFrame
-from ..s3handler import S3Handler
-from ..build_manager import GeoProfileBuilder
+from ..profile import ProfileRequest, ProfileFailureModes, TimeFrame, valid_geoid
+from ..s3handler import S3Handler, CacheHandler, StaleProfile
+from ..build_manager import GeoProfileBuilder, ProfileUnavailable
+from ..negative_cache import NegativeCache
+from ..locks import BuildLock
+from ..tiered_cache import MemoryCache
+from .. import background, metrics
 
 
 class mock_func:
@@ -121,3 +128,317 @@ def test_build_geoid_fresh(cache_handler, mock_profile, mock_enhance_profile):
     assert profile["a"] == "an" 
     assert profile["b"] == "example"
     assert profile["c"] == "profile"
+
+
+class StaleCacheHandler(CacheHandler):
+    def __init__(self, profile: dict):
+        self.profile = profile
+        self.written = None
+
+    def check_cache(self, request: ProfileRequest) -> Result:
+        return Failure(StaleProfile("Out of date.", self.profile))
+
+    def cache_profile(self, request: ProfileRequest, profile: dict):
+        self.written = profile
+
+
+def cached_profile(
+    release_id: str = "2021:d3_present", profile_format: str = "2021-0.1.0"
+) -> dict:
+    return {
+        "geography": {"this": "Detroit"},
+        "sections": {
+            "people": {
+                "title": "People",
+                "rows": {
+                    "age": {
+                        "title": "Age",
+                        "designs": {"median": "old median", "ages": "old ages"},
+                    }
+                },
+            }
+        },
+        "release_id": release_id,
+        "profile_format": profile_format,
+        "line_items": {"people/age/median": "1", "people/age/ages": "1"},
+        "profile_data_json": "{...}",
+    }
+
+
+def current_line_items(_: ProfileRequest) -> dict:
+    return {
+        "release_id": "2021:d3_present",
+        "profile_format": "2021-0.1.0",
+        "line_items": {
+            "people/age/median": "1",
+            "people/age/ages": "2",
+            "people/age/sex": "1",
+        },
+    }
+
+
+@pytest.fixture
+def mock_partial_profile():
+    @mock_func
+    def partial_profile(_: ProfileRequest, paths):
+        partial_profile.paths = list(paths)
+        return Success(
+            {
+                "sections": {
+                    "people": {
+                        "title": "People",
+                        "rows": {
+                            "age": {
+                                "title": "Age",
+                                "designs": {
+                                    "median": None,
+                                    "ages": "new ages",
+                                    "sex": "new sex",
+                                },
+                            }
+                        },
+                    }
+                },
+                **current_line_items(_),
+            }
+        )
+
+    return partial_profile
+
+
+def test_build_geoid_completes_stale_profile(
+    mock_profile, mock_enhance_profile, mock_partial_profile
+):
+    cache_handler = StaleCacheHandler(cached_profile())
+    builder = GeoProfileBuilder(
+        cache_handler,
+        mock_profile,
+        mock_enhance_profile,
+        logger,
+        partial_builder=mock_partial_profile,
+        line_items=current_line_items,
+    )
+
+    profile = builder.build_geoid(ProfileRequest("A", TimeFrame.PRESENT))
+
+    assert not mock_profile.was_called
+    assert mock_partial_profile.paths == ["people/age/ages", "people/age/sex"]
+    assert profile["sections"]["people"]["rows"]["age"]["designs"] == {
+        "median": "old median",
+        "ages": "new ages",
+        "sex": "new sex",
+    }
+    assert list(profile["sections"]["people"]["rows"]["age"]["designs"]) == [
+        "median",
+        "ages",
+        "sex",
+    ]
+    assert profile["line_items"]["people/age/ages"] == "2"
+    assert '"new sex"' in profile["profile_data_json"]
+    assert cache_handler.written is profile
+
+
+def test_build_geoid_rebuilds_other_release(
+    mock_profile, mock_enhance_profile, mock_partial_profile
+):
+    cache_handler = StaleCacheHandler(cached_profile("2016:d3_past"))
+    builder = GeoProfileBuilder(
+        cache_handler,
+        mock_profile,
+        mock_enhance_profile,
+        logger,
+        partial_builder=mock_partial_profile,
+        line_items=current_line_items,
+    )
+
+    builder.build_geoid(ProfileRequest("A", TimeFrame.PRESENT))
+
+    assert mock_profile.was_called
+    assert not mock_partial_profile.was_called
+
+
+def test_build_geoid_rebuilds_other_profile_format(
+    mock_profile, mock_enhance_profile, mock_partial_profile
+):
+    for profile_format in ["2020-0.9.0", None]:
+        profile = cached_profile(profile_format=profile_format)
+        if profile_format is None:
+            # Cached before the format was recorded
+            del profile["profile_format"]
+        cache_handler = StaleCacheHandler(profile)
+        builder = GeoProfileBuilder(
+            cache_handler,
+            mock_profile,
+            mock_enhance_profile,
+            logger,
+            partial_builder=mock_partial_profile,
+            line_items=current_line_items,
+        )
+
+        assert builder.check_line_items(ProfileRequest("A", TimeFrame.PRESENT), profile) is None
+        builder.build_geoid(ProfileRequest("A", TimeFrame.PRESENT))
+
+        assert mock_profile.was_called
+        assert not mock_partial_profile.was_called
+
+
+def test_build_geoid_serves_stale_and_revalidates(
+    monkeypatch, mock_profile, mock_enhance_profile, mock_partial_profile
+):
+    jobs = []
+    monkeypatch.setattr(
+        background, "schedule", lambda key, *job: jobs.append((key, job))
+    )
+    cache_handler = StaleCacheHandler(cached_profile())
+    builder = GeoProfileBuilder(
+        cache_handler,
+        mock_profile,
+        mock_enhance_profile,
+        logger,
+        partial_builder=mock_partial_profile,
+        line_items=current_line_items,
+        serve_stale=True,
+    )
+    request = ProfileRequest("A", TimeFrame.PRESENT)
+
+    profile = builder.build_geoid(request)
+
+    assert profile["profile_stale"]
+    assert profile["sections"]["people"]["rows"]["age"]["designs"]["ages"] == "old ages"
+    assert not mock_partial_profile.was_called
+    assert cache_handler.written is None
+
+    [(key, (revalidate, *args))] = jobs
+    assert key == ("revalidate", "A", TimeFrame.PRESENT)
+    completed = revalidate(*args)
+
+    assert "profile_stale" not in completed
+    assert cache_handler.written is completed
+    assert not mock_profile.was_called
+
+
+def test_background_schedule_skips_queued_key(settings):
+    settings.BACKGROUND_WORKERS = 1
+    release = Event()
+    calls = []
+
+    def job(value):
+        release.wait(5)
+        calls.append(value)
+
+    try:
+        first = background.schedule("key", job, 1)
+        assert background.schedule("key", job, 2) is None
+        release.set()
+        first.result(5)
+
+        background.schedule("key", job, 3).result(5)
+    finally:
+        background.shutdown_pool()
+
+    assert calls == [1, 3]
+
+
+def test_build_geoid_single_flight(mock_enhance_profile):
+    builds = []
+
+    def slow_profile(request: ProfileRequest):
+        builds.append(request.geoid)
+        time.sleep(0.2)
+        return {"geoid": request.geoid}
+
+    builder = GeoProfileBuilder(
+        MemoryCache(10, "v1"), slow_profile, mock_enhance_profile, logger
+    )
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        profiles = list(
+            pool.map(
+                lambda _: builder.build_geoid(ProfileRequest("C", TimeFrame.PRESENT)),
+                range(4),
+            )
+        )
+
+    assert builds == ["C"]
+    assert all(profile["geoid"] == "C" for profile in profiles)
+    assert metrics.snapshot()["timings"]["build_lock.wait"].count >= 3
+
+
+def test_build_lock_times_out(settings):
+    held = BuildLock("D:present")
+    assert held.acquire()
+
+    try:
+        timeouts = metrics.snapshot()["counters"].get("build_lock.timeouts", 0)
+        waiting = BuildLock("D:present", timeout=0.1)
+
+        assert not waiting.acquire()
+        assert waiting.waited
+        assert metrics.snapshot()["counters"]["build_lock.timeouts"] == timeouts + 1
+    finally:
+        held.release()
+
+    with BuildLock("D:present", timeout=0.1) as acquired:
+        assert acquired
+
+
+@pytest.mark.parametrize(
+    "reason,timeout",
+    [
+        (ProfileFailureModes.UNKNOWN_GEOID, 600),
+        (ProfileFailureModes.UPSTREAM_FAILURE, 5),
+    ],
+)
+def test_build_geoid_negative_cache(reason, timeout, mock_enhance_profile):
+    @mock_func
+    def failing_profile(_: ProfileRequest):
+        return Failure(reason)
+
+    negative_cache = NegativeCache(
+        {"UNKNOWN_GEOID": 600, "UPSTREAM_FAILURE": 5}, cache_alias="default"
+    )
+    builder = GeoProfileBuilder(
+        MemoryCache(10, "v1"),
+        failing_profile,
+        mock_enhance_profile,
+        logger,
+        negative_cache=negative_cache,
+    )
+    request = ProfileRequest(f"E{reason.name}", TimeFrame.PRESENT)
+
+    try:
+        with pytest.raises(ProfileUnavailable) as first:
+            builder.build_geoid(request)
+        assert first.value.reason == reason
+        assert first.value.retry_after == timeout
+        assert failing_profile.was_called
+
+        failing_profile.reset()
+        with pytest.raises(ProfileUnavailable) as second:
+            builder.build_geoid(request)
+        assert second.value.reason == reason
+        assert not failing_profile.was_called
+    finally:
+        negative_cache.forget(request)
+
+
+def test_negative_cache_skips_untimed_reasons():
+    negative_cache = NegativeCache({"UNKNOWN_GEOID": 600})
+    request = ProfileRequest("F", TimeFrame.PRESENT)
+
+    assert not negative_cache.record(request, ProfileFailureModes.NO_PROFILE_AVAILABLE)
+    assert negative_cache.check(request) is None
+
+
+@pytest.mark.parametrize(
+    "geoid,valid",
+    [
+        ("06000US2616322000", True),
+        ("16000us2622000", True),
+        ("99900US26", False),
+        ("A", False),
+        ("../06000US26", False),
+    ],
+)
+def test_valid_geoid(geoid, valid):
+    assert valid_geoid(geoid) == valid
@@ -0,0 +1,131 @@
+import logging
+import random
+
+from returns.result import Success
+
+from ..build_manager import GeoProfileBuilder
+from ..metadata import TimeFrame
+from ..popularity import CountMinSketch, PopularityTracker
+from ..profile import ProfileRequest
+from ..tiered_cache import MemoryCache
+from .. import background, metrics
+
+
+logger = logging.getLogger()
+
+
+def test_sketch_estimates_and_decays():
+    sketch = CountMinSketch(width=64, depth=4, decay_after=1000)
+    for _ in range(40):
+        sketch.add("popular")
+    sketch.add("rare")
+
+    assert sketch.estimate("popular") >= 40
+    assert sketch.estimate("rare") >= 1
+    assert sketch.estimate("popular") > sketch.estimate("rare")
+
+    sketch.decay()
+    assert 20 <= sketch.estimate("popular") < 40
+
+
+def test_tracker_top_n():
+    tracker = PopularityTracker(top_n=2, width=256)
+    for geoid, hits in [("A", 5), ("B", 1), ("C", 9), ("D", 3)]:
+        for _ in range(hits):
+            tracker.record((geoid, TimeFrame.PRESENT))
+    tracker.record(("E", TimeFrame.PAST))
+
+    assert tracker.top() == [("C", TimeFrame.PRESENT), ("A", TimeFrame.PRESENT)]
+    assert tracker.top(where=lambda key: key[1] == TimeFrame.PAST) == [
+        ("E", TimeFrame.PAST)
+    ]
+
+
+def test_tracker_newcomers_replace_least_popular():
+    tracker = PopularityTracker(top_n=1, width=256)
+    for geoid in "ABCD":
+        tracker.record(geoid)
+    for _ in range(5):
+        tracker.record("E")
+
+    assert tracker.top() == ["E"]
+    assert len(tracker.candidates) == tracker.capacity
+
+
+def test_tracker_newcomers_beat_decayed_favorites():
+    tracker = PopularityTracker(top_n=1, width=256, decay_after=10**6)
+    for geoid in "ABCD":
+        for _ in range(200):
+            tracker.record(geoid)
+    for _ in range(6):
+        tracker.sketch.decay()
+    for _ in range(150):
+        tracker.record("E")
+
+    assert "E" in tracker.candidates
+    assert tracker.top() == ["E"]
+
+
+def test_tracker_least_candidate_matches_full_scan():
+    tracker = PopularityTracker(top_n=4, width=64, decay_after=500)
+    rng = random.Random(7)
+    scans = 0
+
+    for _ in range(5000):
+        key = int(rng.paretovariate(1.2)) % 200
+        tracker.record(key)
+
+        with tracker._lock:
+            if len(tracker.candidates) == tracker.capacity:
+                # The least candidate by a full scan, oldest first on ties
+                least = min(tracker.candidates, key=tracker.sketch.estimate)
+                assert tracker._least() == (least, tracker.sketch.estimate(least))
+                scans += 1
+
+    assert scans > 0
+    assert len(tracker._heap) == len(tracker.candidates)
+
+
+def test_builder_prewarms_popular_profiles(monkeypatch):
+    jobs = []
+    monkeypatch.setattr(
+        background, "schedule", lambda key, *job: jobs.append((key, job)) or True
+    )
+    version = {"current": "v1"}
+    cache_handler = MemoryCache(10, lambda _: version["current"])
+    builder = GeoProfileBuilder(
+        cache_handler,
+        lambda request: {"geoid": request.geoid},
+        lambda profile: profile,
+        logger,
+        popularity=PopularityTracker(top_n=2),
+        profile_version=lambda _: version["current"],
+    )
+
+    for geoid, hits in [("A", 3), ("B", 2), ("C", 1)]:
+        for _ in range(hits):
+            builder.build_geoid(ProfileRequest(geoid, TimeFrame.PRESENT))
+    assert jobs == []
+
+    version["current"] = "v2"
+    before = metrics.snapshot()["counters"]
+    builder.build_geoid(ProfileRequest("C", TimeFrame.PRESENT))
+
+    assert [key for key, _ in jobs] == [
+        ("revalidate", "A", TimeFrame.PRESENT),
+        ("revalidate", "B", TimeFrame.PRESENT),
+    ]
+    for _, (prewarm, *args) in jobs:
+        prewarm(*args)
+
+    assert isinstance(
+        cache_handler.check_cache(ProfileRequest("A", TimeFrame.PRESENT)), Success
+    )
+
+    builder.build_geoid(ProfileRequest("A", TimeFrame.PRESENT))
+    builder.build_geoid(ProfileRequest("A", TimeFrame.PRESENT))
+    after = metrics.snapshot()["counters"]
+
+    for counter in ("prewarm.first_requests", "prewarm.first_hits"):
+        assert after[counter] == before.get(counter, 0) + 1
+    assert PopularityTracker.hit_rate() is not None
@@ -0,0 +1,26 @@
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from ..management.commands.check_profile_queries import measure_template
+
+
+class TestQueryBudget(TestCase):
+    """
+    Guards the hot path against N+1 queries as templates grow.
+    """
+
+    def test_query_counts_constant(self):
+        out = StringIO()
+
+        # Raises CommandError if any stage grows with the template
+        call_command("check_profile_queries", sizes=[1, 4], stdout=out)
+
+        self.assertIn("Query counts are constant.", out.getvalue())
+
+    def test_shopping_list_and_populate_are_query_free(self):
+        results = measure_template(3)
+
+        self.assertEqual(results["shopping list"]["queries"], 0)
+        self.assertEqual(results["populate"]["queries"], 0)
@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from io import BytesIO
 import json
@@ -12,95 +13,80 @@ import gzip
 
 from ..profile import ProfileRequest
 from ..metadata import TimeFrame
-from ..s3handler import S3Handler
+from ..s3handler import S3Handler, StaleProfile, reset_s3_clients
+from ..compression import CompressedJSONStream, available_codecs
+from .. import metrics
 
 
 logger = logging.getLogger()
 
 
-@dataclass
-class MockGzipFile:
-    fileobj: BytesIO
-    filename: str = "default"
-    mode: str = "r"
-
-    def read(self):
-        return self.fileobj.read()
-
-    def write(self, data):
-        self.fileobj.write(data)
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, exc_type, exc_value, exc_tb):
-        pass
-
+class MockClient:
+    def __init__(self, config=None):
+        self.config = config
+        self.cache = {}
 
-class MockResource:
-    def __init__(self, initial_cache=dict(), no_internet=False):
-        self.cache = initial_cache
-
-        self.cache[
-            ("default_servername", "test_key")
-        ] = b'{ "key": "value", "profile_version": "0.1.0" }'
+        self.cache[("default_servername", "test_key")] = gzip.compress(
+            b'{ "key": "value", "profile_version": "0.1.0" }'
+        )
         self.cache[
             (
                 "default_servername",
                 "1.0/data/default_root_file/past/123US500900",
             )
-        ] = b'{ "geoid": "123US500900", "profile_version": "0.1.0" }'
-
-    def Object(self, servername, keyname):
-        try:
-            return self._Object(
-                _return_value=self.cache[(servername, keyname)],
-                servername=servername,
-                key=keyname,
-                parent_cache=self.cache,
-            )
-        except KeyError:
-            return self._FailedObject(
-                servername=servername, key=keyname, parent_cache=self.cache
-            )
+        ] = gzip.compress(b'{ "geoid": "123US500900", "profile_version": "0.1.0" }')
 
-    class _Object:
-        def __init__(self, _return_value: bytes, servername, key, parent_cache):
-            self._return_value = _return_value
-            self.servername, self.key = servername, key
-            self.parent_cache = parent_cache
-
-            class Body:
-                def __init__(self, _return_value):
-                    self._return_value = _return_value
-
-                def read(self):
-                    return self._return_value
+        self.metadata = {}
+        self.gets = 0
+        self.heads = 0
+        self.bodies = []
 
-            self.Body = Body
-
-        def get(self):
-            return {"Body": self.Body(self._return_value)}
+    class Body:
+        def __init__(self, _return_value):
+            self._return_value = _return_value
+            self.closed = False
 
-        def load(self):
-            pass
+        def read(self):
+            return self._return_value
 
-        def put(self, Body: BytesIO, *_, **__):
-            self.parent_cache[(self.servername, self.key)] = Body.read()
+        def close(self):
+            self.closed = True
 
-    class _FailedObject:
-        def __init__(self, servername, key, parent_cache):
-            self.servername, self.key = servername, key
-            self.parent_cache = parent_cache
+    def get_object(self, Bucket, Key):
+        self.gets += 1
+        if (Bucket, Key) not in self.cache:
+            raise botocore.exceptions.ClientError(
+                error_response={"Error": {"Code": "NoSuchKey"}},
+                operation_name="GetObject",
+            )
+        self.bodies.append(self.Body(self.cache[(Bucket, Key)]))
+        return {
+            "Body": self.bodies[-1],
+            **self.metadata.get((Bucket, Key), {}),
+        }
 
-        def load(self):
+    def head_object(self, Bucket, Key):
+        self.heads += 1
+        if (Bucket, Key) not in self.cache:
             raise botocore.exceptions.ClientError(
                 error_response={"Error": {"Code": "404"}},
-                operation_name="",
+                operation_name="HeadObject",
             )
+        return self.metadata.get((Bucket, Key), {})
+
+    def store(self, Bucket, Key, fileobj, object_args):
+        self.cache[(Bucket, Key)] = fileobj.read()
+        # get_object hands these back, as S3 does
+        self.metadata[(Bucket, Key)] = {
+            "ContentEncoding": object_args.get("ContentEncoding"),
+            "Metadata": object_args.get("Metadata", {}),
+        }
 
-        def put(self, Body: BytesIO, *_, **__):
-            self.parent_cache[(self.servername, self.key)] = Body.read()
+    def put_object(self, Bucket, Key, Body: BytesIO, **object_args):
+        self.store(Bucket, Key, Body, object_args)
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None):
+        self.store(Bucket, Key, Fileobj, ExtraArgs or {})
 
     def resource_check(self):
         return "SUCCESSFUL"
@@ -112,14 +98,21 @@ class MockSession:
     aws_secret_access_key: str
     region_name: str
 
-    def resource(self, _):
-        return MockResource()
+    def client(self, _, config=None, endpoint_url=None):
+        return MockClient(config)
+
+
+@pytest.fixture(autouse=True)
+def fresh_clients():
+    # The client is shared per process, so each test starts with a new one
+    reset_s3_clients()
+    yield
+    reset_s3_clients()
 
 
 @pytest.fixture
 def preloaded_handler(monkeypatch):
     monkeypatch.setattr(boto3, "Session", MockSession)
-    monkeypatch.setattr(gzip, "GzipFile", MockGzipFile)
 
     return S3Handler(
         aws_key="default_aws_key",
@@ -216,10 +209,8 @@ def test_to_keyname(input, output, preloaded_handler):
 
 
 def test_unpack_response(preloaded_handler):
-    s3_object = MockResource().Object(
-        servername="default_servername", keyname="test_key"
-    )
-    result = preloaded_handler.unpack_response(s3_object)
+    response = MockClient().get_object(Bucket="default_servername", Key="test_key")
+    result = preloaded_handler.unpack_response(response)
 
     assert result == {
         "key": "value",
@@ -253,19 +244,16 @@ def test_check_cache_failure(preloaded_handler):
 
 def test_write_profile_json(preloaded_handler):
     request = ProfileRequest("TESTGEOID", TimeFrame.PRESENT)
-    resource = MockResource()
-    s3_object = resource.Object(
-        servername="default_servername",
-        keyname=preloaded_handler.to_keyname(request),
-    )
     profile_json = json.dumps({"this profile value": "some value"})
 
-    preloaded_handler.write_profile_json(s3_object, profile_json, request)
+    preloaded_handler.write_profile_json(profile_json, request)
 
     assert (
-        resource.cache[
-            ("default_servername", preloaded_handler.to_keyname(request))
-        ]
+        gzip.decompress(
+            preloaded_handler.s3.cache[
+                ("default_servername", preloaded_handler.to_keyname(request))
+            ]
+        )
         == b'{"this profile value": "some value"}'
     )
 
@@ -279,6 +267,25 @@ def test_cache_profile(preloaded_handler):
     preloaded_handler.cache_profile(request, profile)
 
 
+def test_cache_profile_leaves_out_profile_json(preloaded_handler):
+    request = ProfileRequest("12300US4568", TimeFrame.PRESENT)
+    profile = {"a": 100, "profile_data_json": '{"a": 100}'}
+
+    preloaded_handler.cache_profile(request, profile)
+
+    stored = preloaded_handler.s3.cache[
+        ("default_servername", preloaded_handler.to_keyname(request))
+    ]
+    assert json.loads(gzip.decompress(stored)) == {
+        "a": 100,
+        "profile_version": "0.1.0",
+    }
+    assert "profile_data_json" in profile
+    assert preloaded_handler.check_cache(request).unwrap()["profile_data_json"] == (
+        '{"a": 100, "profile_version": "0.1.0"}'
+    )
+
+
 def test_cache_and_recover_simple(preloaded_handler):
     request = ProfileRequest("04000US2616322000", TimeFrame.PRESENT)
     profile = {"a": 999, "b": 9999, "c": 9999999}
@@ -305,7 +312,6 @@ def test_cache_and_recover_simple(preloaded_handler):
 def test_cache_and_recover_fuzz(geoid, a, b, c, timeframe):
     with pytest.MonkeyPatch().context() as monkeypatch:
         monkeypatch.setattr(boto3, "Session", MockSession)
-        monkeypatch.setattr(gzip, "GzipFile", MockGzipFile)
 
         handler = S3Handler(
             aws_key="default_aws_key",
@@ -327,3 +333,135 @@ def test_cache_and_recover_fuzz(geoid, a, b, c, timeframe):
         assert profile.unwrap()["a"] == a
         assert profile.unwrap()["b"] == b
         assert profile.unwrap()["c"] == c
+
+
+def test_check_cache_versioned_per_request(monkeypatch):
+    monkeypatch.setattr(boto3, "Session", MockSession)
+
+    versions = {TimeFrame.PRESENT: "template-a"}
+    handler = S3Handler(
+        aws_key="default_aws_key",
+        aws_secret="default_aws_secret",
+        servername="default_servername",
+        root_file="default_root_file",
+        profile_version=lambda request: versions[request.timeframe],
+    )
+    request = ProfileRequest("04000US26", TimeFrame.PRESENT)
+    handler.cache_profile(request, {"a": 1})
+
+    assert handler.check_cache(request).unwrap()["profile_version"] == "template-a"
+
+    versions[TimeFrame.PRESENT] = "template-b"
+    result = handler.check_cache(request)
+
+    assert isinstance(result.failure(), StaleProfile)
+    assert result.failure().profile["a"] == 1
+
+
+def test_check_cache_single_get(preloaded_handler):
+    request = ProfileRequest("26000US1", TimeFrame.PRESENT)
+    preloaded_handler.cache_profile(request, {"a": 1})
+    s3 = preloaded_handler.s3
+
+    assert s3.metadata[
+        ("default_servername", preloaded_handler.to_keyname(request))
+    ] == {"ContentEncoding": "gzip", "Metadata": {"profile-version": "0.1.0"}}
+
+    gets = s3.gets
+    assert isinstance(preloaded_handler.check_cache(request), Success)
+    assert isinstance(
+        preloaded_handler.check_cache(ProfileRequest("missing", TimeFrame.PRESENT)),
+        Failure,
+    )
+    assert s3.gets == gets + 2
+    assert s3.heads == 0
+
+
+def test_is_current(preloaded_handler):
+    request = ProfileRequest("26000US4", TimeFrame.PRESENT)
+
+    assert not preloaded_handler.is_current(request)
+
+    preloaded_handler.cache_profile(request, {"a": 1})
+    assert preloaded_handler.is_current(request)
+
+    preloaded_handler.profile_version = "0.2.0"
+    assert not preloaded_handler.is_current(request)
+
+
+def test_stale_profile_read_lazily(preloaded_handler):
+    request = ProfileRequest("26000US2", TimeFrame.PRESENT)
+    preloaded_handler.cache_profile(request, {"a": 1})
+    preloaded_handler.profile_version = "0.2.0"
+
+    stale = preloaded_handler.check_cache(request).failure()
+
+    assert callable(stale._profile)
+    # The body isn't left open in case the profile is wanted
+    assert preloaded_handler.s3.bodies[-1].closed
+    gets = preloaded_handler.s3.gets
+    assert stale.profile["a"] == 1
+    assert stale.profile["profile_version"] == "0.1.0"
+    assert preloaded_handler.s3.gets == gets + 1
+
+
+def test_check_cache_gzip(preloaded_handler):
+    request = ProfileRequest("26000US3", TimeFrame.PRESENT)
+    preloaded_handler.cache_profile(request, {"a": 1})
+
+    compressed = preloaded_handler.check_cache_gzip(request).unwrap()
+
+    assert json.loads(gzip.decompress(compressed)) == {
+        "a": 1,
+        "profile_version": "0.1.0",
+    }
+
+    preloaded_handler.profile_version = "0.2.0"
+    assert isinstance(preloaded_handler.check_cache_gzip(request), Failure)
+    assert preloaded_handler.s3.bodies[-1].closed
+
+
+def test_check_cache_gzip_closes_other_encodings(preloaded_handler):
+    request = ProfileRequest("26000US5", TimeFrame.PRESENT)
+    preloaded_handler.cache_profile(request, {"a": 1})
+    key = ("default_servername", preloaded_handler.to_keyname(request))
+    preloaded_handler.s3.metadata[key]["ContentEncoding"] = "zstd"
+
+    assert isinstance(preloaded_handler.check_cache_gzip(request), Failure)
+    assert preloaded_handler.s3.bodies[-1].closed
+
+
+@given(
+    profile=st.dictionaries(
+        st.text(), st.lists(st.floats(allow_nan=False) | st.text(), max_size=50)
+    ),
+    read_size=st.integers(min_value=1, max_value=4096),
+)
+def test_compressed_stream(profile, read_size):
+    for codec in available_codecs():
+        stream = CompressedJSONStream(profile, codec, level=1)
+        compressed = b"".join(iter(lambda: stream.read(read_size), b""))
+
+        assert codec.decompress(compressed) == json.dumps(profile).encode()
+        assert stream.compressed_bytes == len(compressed)
+
+
+def test_handlers_share_one_client(monkeypatch, settings):
+    monkeypatch.setattr(boto3, "Session", MockSession)
+    settings.S3_MAX_POOL_CONNECTIONS = 7
+
+    def build():
+        return S3Handler(
+            aws_key="default_aws_key",
+            aws_secret="default_aws_secret",
+            servername="default_servername",
+            root_file="default_root_file",
+            profile_version="0.1.0",
+        )
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        handlers = list(pool.map(lambda _: build(), range(32)))
+
+    assert len({id(handler.s3) for handler in handlers}) == 1
+    assert handlers[0].s3.config.max_pool_connections == 7
+    assert metrics.snapshot()["timings"]["s3.client_startup"].count >= 1
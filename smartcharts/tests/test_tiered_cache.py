@@ -0,0 +1,281 @@
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import json
+import os
+import time
+import zlib
+
+from django.test import RequestFactory
+from returns.result import Result, Success, Failure
+
+from ..profile import ProfileRequest, TimeFrame
+from ..s3handler import CacheHandler, StaleProfile
+from ..tiered_cache import MemoryCache, DiskCache, TieredCacheHandler
+from ..compression import crc32_combine
+from ..views import gzip_passthrough
+from .. import views
+
+
+class DictCache(CacheHandler):
+    """
+    Stands in for S3.
+    """
+
+    def __init__(self, version: str):
+        self.version = version
+        self.profiles = {}
+        self.reads = 0
+
+    def check_cache(self, request: ProfileRequest) -> Result:
+        self.reads += 1
+        profile = self.profiles.get(request.geoid)
+        if profile is None:
+            return Failure("Not here.")
+        if profile["profile_version"] != self.version:
+            return Failure(StaleProfile("Old.", profile))
+        return Success(dict(profile))
+
+    def cache_profile(self, request: ProfileRequest, profile: dict):
+        profile.update({"profile_version": self.version})
+        self.profiles[request.geoid] = dict(profile)
+
+
+def test_memory_cache_lru():
+    cache = MemoryCache(2, "1")
+    for geoid in ["A", "B", "C"]:
+        cache.cache_profile(ProfileRequest(geoid, TimeFrame.PRESENT), {"geoid": geoid})
+
+    assert len(cache) == 2
+    assert isinstance(
+        cache.check_cache(ProfileRequest("A", TimeFrame.PRESENT)), Failure
+    )
+    assert cache.check_cache(ProfileRequest("c", TimeFrame.PRESENT)).unwrap() == {
+        "geoid": "C",
+        "profile_version": "1",
+    }
+
+
+def test_memory_cache_hands_out_copies():
+    cache = MemoryCache(2, "1")
+    request = ProfileRequest("A", TimeFrame.PRESENT)
+    cache.cache_profile(request, {"geoid": "A"})
+
+    cache.check_cache(request).unwrap()["API_URL"] = "added by a view"
+
+    assert "API_URL" not in cache.check_cache(request).unwrap()
+
+
+def test_disk_cache_round_trip(tmp_path):
+    cache = DiskCache(tmp_path, 1024 * 1024, "1")
+    request = ProfileRequest("04000US26", TimeFrame.PAST)
+    cache.cache_profile(request, {"geoid": "04000US26", "profile_data_json": "{}"})
+
+    profile = cache.check_cache(request).unwrap()
+
+    assert profile["geoid"] == "04000US26"
+    assert profile["profile_data_json"] == (
+        '{"geoid": "04000US26", "profile_version": "1"}'
+    )
+    assert isinstance(
+        DiskCache(tmp_path, 1024 * 1024, "2").check_cache(request).failure(),
+        StaleProfile,
+    )
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    cache = DiskCache(tmp_path, 1024 * 1024, "1")
+    requests = [ProfileRequest(geoid, TimeFrame.PRESENT) for geoid in "ABC"]
+
+    for age, request in enumerate(requests):
+        cache.cache_profile(request, {"padding": "x" * 100})
+        written_at = time.time() - 100 + age
+        os.utime(cache.to_path(request), (written_at, written_at))
+
+    cache.check_cache(requests[0])
+    cache.max_bytes = cache.current_size() - 1
+    cache.cache_profile(requests[2], {"padding": "x" * 100})
+
+    assert isinstance(cache.check_cache(requests[0]), Success)
+    assert isinstance(cache.check_cache(requests[1]), Failure)
+
+
+def test_disk_cache_size_is_shared_between_processes(tmp_path):
+    # Each instance stands in for a worker process on the same host
+    workers = [DiskCache(tmp_path, 1024 * 1024, "1") for _ in range(3)]
+    for worker, geoid in zip(workers, "ABC"):
+        worker.cache_profile(
+            ProfileRequest(geoid, TimeFrame.PRESENT), {"padding": "x" * 100}
+        )
+
+    total = sum(path.stat().st_size for path in tmp_path.glob("*/*/*.json.gz"))
+    assert all(worker.current_size() == total for worker in workers)
+
+    workers[0].max_bytes = total - 1
+    workers[0].cache_profile(ProfileRequest("A", TimeFrame.PRESENT), {"padding": "y"})
+
+    assert sum(
+        path.stat().st_size for path in tmp_path.glob("*/*/*.json.gz")
+    ) == workers[1].current_size() <= total - 1
+
+
+def test_disk_cache_concurrent_writes(tmp_path):
+    cache = DiskCache(tmp_path, 1024 * 1024, "1")
+    request = ProfileRequest("A", TimeFrame.PRESENT)
+
+    with ThreadPoolExecutor(8) as pool:
+        list(
+            pool.map(
+                lambda i: cache.cache_profile(request, {"copy": i}), range(32)
+            )
+        )
+
+    assert cache.check_cache(request).unwrap()["copy"] in range(32)
+    assert not list(tmp_path.glob("**/*.tmp"))
+    assert cache.current_size() == cache.to_path(request).stat().st_size
+
+
+def test_tiered_cache_promotes_hits(tmp_path):
+    memory = MemoryCache(10, "1")
+    disk = DiskCache(tmp_path, 1024 * 1024, "1")
+    remote = DictCache("1")
+    tiered = TieredCacheHandler([memory, disk, remote])
+    request = ProfileRequest("A", TimeFrame.PRESENT)
+    remote.cache_profile(request, {"geoid": "A"})
+
+    assert tiered.check_cache(request).unwrap()["geoid"] == "A"
+    assert tiered.check_cache(request).unwrap()["geoid"] == "A"
+
+    assert remote.reads == 1
+    assert isinstance(memory.check_cache(request), Success)
+    assert isinstance(disk.check_cache(request), Success)
+
+
+def test_tiered_cache_writes_through(tmp_path):
+    tiers = [MemoryCache(10, "1"), DiskCache(tmp_path, 1024 * 1024, "1"), DictCache("1")]
+    request = ProfileRequest("B", TimeFrame.PAST)
+
+    TieredCacheHandler(tiers).cache_profile(request, {"geoid": "B"})
+
+    assert all(isinstance(tier.check_cache(request), Success) for tier in tiers)
+
+
+def test_tiered_cache_prefers_fresh_over_stale():
+    memory = MemoryCache(10, "1")
+    remote = DictCache("2")
+    request = ProfileRequest("A", TimeFrame.PRESENT)
+    memory.cache_profile(request, {"geoid": "A", "copy": "old"})
+    remote.cache_profile(request, {"geoid": "A", "copy": "new"})
+    memory.profile_version = "2"
+
+    result = TieredCacheHandler([memory, remote]).check_cache(request)
+
+    assert result.unwrap()["copy"] == "new"
+    assert memory.check_cache(request).unwrap()["copy"] == "new"
+
+
+def test_tiered_cache_returns_stale_profile():
+    remote = DictCache("1")
+    request = ProfileRequest("A", TimeFrame.PRESENT)
+    remote.cache_profile(request, {"geoid": "A"})
+    remote.version = "2"
+
+    result = TieredCacheHandler([MemoryCache(10, "2"), remote]).check_cache(request)
+
+    assert result.failure().profile["geoid"] == "A"
+
+
+def test_disk_cache_keeps_only_current_version(tmp_path):
+    request = ProfileRequest("A", TimeFrame.PRESENT)
+    DiskCache(tmp_path, 1024 * 1024, "1").cache_profile(request, {"copy": "old"})
+    cache = DiskCache(tmp_path, 1024 * 1024, "2")
+
+    stale = cache.check_cache(request).failure()
+    assert stale.profile["copy"] == "old"
+    assert isinstance(cache.check_cache_gzip(request), Failure)
+
+    cache.cache_profile(request, {"copy": "new"})
+
+    assert [path.name for path in cache.to_path(request).parent.iterdir()] == [
+        "2.json.gz"
+    ]
+    assert json.loads(gzip.decompress(cache.check_cache_gzip(request).unwrap())) == {
+        "copy": "new",
+        "profile_version": "2",
+    }
+
+
+def test_tiered_cache_gzip_skips_memory(tmp_path):
+    memory = MemoryCache(10, "1")
+    disk = DiskCache(tmp_path, 1024 * 1024, "1")
+    request = ProfileRequest("A", TimeFrame.PRESENT)
+    TieredCacheHandler([memory, disk]).cache_profile(request, {"geoid": "A"})
+
+    compressed = TieredCacheHandler([memory, disk]).check_cache_gzip(request)
+
+    assert json.loads(gzip.decompress(compressed.unwrap()))["geoid"] == "A"
+
+
+def test_gzip_passthrough_splices_stored_profiles(tmp_path):
+    disk = DiskCache(tmp_path, 1024 * 1024, "1")
+    present = ProfileRequest("A", TimeFrame.PRESENT)
+    past = ProfileRequest("A", TimeFrame.PAST)
+    disk.cache_profile(present, {"geoid": "A", "when": "now"})
+    disk.cache_profile(past, {"geoid": "A", "when": "then"})
+
+    response = gzip_passthrough(
+        '{"a": ',
+        disk.check_cache_gzip(present).unwrap(),
+        ', "b": ',
+        disk.check_cache_gzip(past).unwrap(),
+        "}",
+    )
+
+    assert response["Content-Encoding"] == "gzip"
+    inflater = zlib.decompressobj(31)
+    assert json.loads(inflater.decompress(response.content)) == {
+        "a": {"geoid": "A", "when": "now", "profile_version": "1"},
+        "b": {"geoid": "A", "when": "then", "profile_version": "1"},
+    }
+    # One gzip member, with a trailer that checks out
+    assert inflater.eof and (inflater.unused_data == b"")
+
+    # Objects written before they could be spliced aren't
+    assert gzip_passthrough('{"a": ', gzip.compress(b"{}"), "}") is None
+
+
+def test_crc32_combine():
+    first, second = os.urandom(1000), os.urandom(70000)
+
+    assert crc32_combine(
+        zlib.crc32(first), zlib.crc32(second), len(second)
+    ) == zlib.crc32(first + second)
+
+
+def test_timeseries_data_keys_match(tmp_path, monkeypatch):
+    disk = DiskCache(tmp_path, 1024 * 1024, "1")
+
+    class Builder:
+        check_cache_gzip = disk.check_cache_gzip
+
+        def build_geoid(self, request):
+            profile = {"geoid": request.geoid, "profile_data_json": "{...}"}
+            disk.cache_profile(request, profile)
+            return profile
+
+    monkeypatch.setattr(views, "bob_the_builder", Builder)
+    get = RequestFactory().get
+
+    built = views.timeseries_profile_data(get("/", HTTP_ACCEPT_ENCODING="gzip"))
+    passed_through = views.timeseries_profile_data(get("/", HTTP_ACCEPT_ENCODING="gzip"))
+    plain = views.timeseries_profile_data(get("/"))
+
+    assert "Content-Encoding" not in built
+    assert passed_through["Content-Encoding"] == "gzip"
+    assert passed_through["Vary"] == "Accept-Encoding"
+    expected = json.loads(built.content)
+    assert expected["profile_data_past_year"] == {
+        "geoid": "06000US2616322000",
+        "profile_version": "1",
+    }
+    assert json.loads(gzip.decompress(passed_through.content)) == expected
+    assert json.loads(plain.content) == expected
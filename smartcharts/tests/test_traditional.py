@@ -1,21 +1,90 @@
+import json
+import logging
 import math
-from django.test import TestCase
+import os
+import subprocess
+import sys
+from concurrent.futures.process import BrokenProcessPool
+from unittest.mock import Mock, patch
+
+from returns.result import Failure, Success
+from django.conf import settings
+from django.test import TestCase, override_settings
 from ..metadata import (
     TableMetadataRequest,
     TimeFrame,
     ComparisonType,
     DataParadigm,
+    release_for_timeframe,
 )
 
 from lesp.core import execute
+from lesp.analyze import extract_variables
+
+from django.core.exceptions import ValidationError
 
-from ..models import StatList, ColumnWidth, DataPoint, Row, Section, Profile
+from django.core.cache import cache, caches
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from ..models import (
+    StatList,
+    ColumnChart,
+    GroupedColumnChart,
+    ColumnWidth,
+    DataPoint,
+    Row,
+    Section,
+    Profile,
+    datapoints_for_table,
+    load_profile_plan,
+)
+from ..plan import PlannedStatList, PlannedGroupedColumnChart, datapoint_results
+from .. import parallel
+from ..parallel import populate_sections, should_populate_in_parallel, shutdown_pool
+from ..template_cache import (
+    TEMPLATE_VERSION_KEY,
+    CompiledTemplateCache,
+    compiled_templates,
+    get_profile_template,
+    get_request_plan,
+)
+from .fixtures import (
+    build_template,
+    detroit,
+    populate_inputs,
+    synthetic_data,
+    PlaceholderClient,
+)
 from ..api_client.geography import Geography
-from ..saturate import saturate_datapoint
+from ..saturate import (
+    saturate_datapoint,
+    transpose_estimate,
+    select_comparatives,
+)
 from ..saturate.namespace import Namespace
+from ..saturate.memo import ResultCache
+from ..saturate.analysis import (
+    analyze_program,
+    fold_constants,
+    parse,
+    LespAnalysisError,
+)
 from ..saturate.datatypes import Estimate
-from ..profile import geo_profile, ProfileRequest
-from ..api_client import ApiClient
+from ..profile import (
+    fetch_geography_data,
+    geo_profile,
+    geo_section,
+    geo_partial_profile,
+    current_line_items,
+    section_cache_key,
+    ProfileRequest,
+    ProfileFailureModes,
+)
+from ..api_client import ApiClient, HipApiError
+from ..api_client.dispatch import NotFound, RetriesExhausted
+from ..build_manager import GeoProfileBuilder
+from ..s3handler import CacheHandler, StaleProfile
 
 
 class TestSmartCharts(TestCase):
@@ -62,6 +131,44 @@ class TestSmartCharts(TestCase):
             point.shopping_list, {"B01001", "B01002", "B01010", "B010101"}
         )
 
+    def test_dependencies_stored_on_save(self):
+        point = DataPoint.objects.create(
+            identifier="stored_dependencies",
+            display_name="Stored dependencies",
+            lesp_code="(/ B01001002 (+ B01001001 B19013001))",
+        )
+        point.refresh_from_db()
+
+        self.assertEqual(point.tables, ["B01001", "B19013"])
+        self.assertEqual(
+            point.variables, ["B01001001", "B01001002", "B19013001"]
+        )
+
+    def test_table_reverse_index(self):
+        point = DataPoint.objects.create(
+            identifier="indexed",
+            display_name="Indexed",
+            lesp_code="(/ B01001002 B01001001)",
+        )
+
+        self.assertEqual(list(datapoints_for_table("b01001")), [point])
+
+        point.lesp_code = "(/ B19013002 B19013001)"
+        point.save()
+
+        self.assertEqual(list(datapoints_for_table("B01001")), [])
+        self.assertEqual(list(datapoints_for_table("B19013")), [point])
+
+    def test_invalid_lesp_code_rejected(self):
+        point = DataPoint(
+            identifier="broken",
+            display_name="Broken",
+            lesp_code="(+ 1 2)",
+        )
+
+        with self.assertRaises(ValidationError):
+            point.full_clean()
+
     def test_shopping_list_statlist(self):
         point = DataPoint.objects.create(
             title="Some random junk.",
@@ -138,6 +245,725 @@ class TestSmartCharts(TestCase):
         self.fail("over time geo_profile didn't error but write more tests!")
 
 
+class BrokenSection:
+    """
+    Stands in for a PlannedSection sent to the process pool.
+    """
+
+    key = "broken"
+
+    def __init__(self, fail=True):
+        self.fail = fail
+
+    def populate(self, *_):
+        if self.fail:
+            raise ValueError("The section can't be populated.")
+        return {"title": "Fine"}
+
+
+class DyingSection(BrokenSection):
+    def __init__(self):
+        self.parent = os.getpid()
+
+    def populate(self, *_):
+        if os.getpid() != self.parent:
+            os._exit(1)
+        return {"title": "Fine"}
+
+
+class TestProfilePlan(TestCase):
+    def setUp(self):
+        # Template edits only invalidate on commit, which never comes here
+        compiled_templates.invalidate()
+
+    def test_plan_structure(self):
+        profile = Profile.objects.create(title="Planned")
+        build_template(profile, 2)
+
+        plan = load_profile_plan(profile.pk)
+
+        self.assertEqual(
+            [section.key for section in plan.sections], ["section_0", "section_1"]
+        )
+        stat, chart, grouped = plan.sections[0].rows[0].designs
+        self.assertIsInstance(stat, PlannedStatList)
+        self.assertEqual(stat.datapoints[0].tables, ("B01001",))
+        self.assertEqual(
+            [column.key for column in chart.datapoints], ["point_0", "other_0"]
+        )
+        self.assertIsInstance(grouped, PlannedGroupedColumnChart)
+        self.assertEqual(grouped.sub_charts, (chart,))
+        self.assertEqual(
+            grouped.skeleton,
+            {"chart_type": "chart-grouped_column", "column_width": "column-quarter"},
+        )
+        self.assertEqual(
+            {table.name for table in plan.collect_shopping_list()},
+            {"B01001", "B19013"},
+        )
+
+    def test_plan_loads_in_constant_queries(self):
+        small = Profile.objects.create(title="Small")
+        build_template(small, 1)
+        large = Profile.objects.create(title="Large")
+        build_template(large, 6)
+
+        query_counts = []
+        for profile in [small, large]:
+            with CaptureQueriesContext(connection) as queries:
+                load_profile_plan(profile.pk)
+            query_counts.append(len(queries))
+
+        self.assertEqual(query_counts[0], query_counts[1])
+
+
+    def test_template_cache_invalidated_by_signals(self):
+        profile = Profile.objects.create(title="Cached")
+        build_template(profile, 1)
+
+        first = get_profile_template()
+        with self.assertNumQueries(0):
+            self.assertIs(get_profile_template(), first)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Section.objects.create(title="Added Section", order=9, profile=profile)
+        self.assertEqual(len(get_profile_template().sections), 2)
+
+        chart = ColumnChart.objects.get(title="Chart 0")
+        with self.captureOnCommitCallbacks(execute=True):
+            chart.columns.clear()
+        self.assertEqual(
+            get_profile_template().sections[0].rows[0].designs[1].datapoints, ()
+        )
+
+
+    def test_template_cache_survives_version_eviction(self):
+        profile = Profile.objects.create(title="Evicted")
+        build_template(profile, 1)
+        # Another process's copy of the template
+        other = CompiledTemplateCache(load_profile_plan)
+        cache.delete(TEMPLATE_VERSION_KEY)
+        get_profile_template()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Section.objects.create(title="Added 8", order=8, profile=profile)
+        self.assertEqual(len(other.get().sections), 2)
+
+        # The version key is evicted, then the template is edited again
+        cache.delete(TEMPLATE_VERSION_KEY)
+        get_profile_template()
+        with self.captureOnCommitCallbacks(execute=True):
+            Section.objects.create(title="Added 9", order=9, profile=profile)
+
+        self.assertEqual(len(other.get().sections), 3)
+
+    @override_settings(FRAGMENT_CACHE_TIMEOUT=0)
+    def test_template_change_clears_datapoint_results(self):
+        profile = Profile.objects.create(title="Memoized")
+        build_template(profile, 1)
+        # Another process's copy of the template
+        other = CompiledTemplateCache(load_profile_plan)
+        other.get()
+        geography = detroit()
+        plan = get_profile_template()
+        api_response, metadata_pool = populate_inputs(plan, geography)
+
+        plan.populate(geography, api_response, metadata_pool, TimeFrame.PRESENT)
+        self.assertGreater(len(datapoint_results), 0)
+        compiled_templates.invalidate()
+        self.assertEqual(len(datapoint_results), 0)
+
+        plan.populate(geography, api_response, metadata_pool, TimeFrame.PRESENT)
+        # The other process sees the new token and drops its results too
+        other.get()
+        self.assertEqual(len(datapoint_results), 0)
+
+    def test_template_cache_invalidated_after_commit(self):
+        profile = Profile.objects.create(title="Uncommitted")
+        build_template(profile, 1)
+        first = get_profile_template()
+
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            Section.objects.create(title="Pending Section", order=9, profile=profile)
+            self.assertIs(get_profile_template(), first)
+
+        for callback in callbacks:
+            callback()
+        self.assertEqual(len(get_profile_template().sections), 2)
+
+
+    def test_request_plan_built_once_per_template(self):
+        profile = Profile.objects.create(title="Requested")
+        build_template(profile, 2)
+
+        class CountingClient(PlaceholderClient):
+            calls = 0
+
+            def fill_metadata_pool(self, shopping_list):
+                self.calls += 1
+                return super().fill_metadata_pool(shopping_list)
+
+        client = CountingClient()
+        present = get_request_plan(TimeFrame.PRESENT, client)
+        past = get_request_plan(TimeFrame.PAST, client)
+
+        self.assertIs(get_request_plan(TimeFrame.PRESENT, client), present)
+        self.assertIs(past.metadata_pool, present.metadata_pool)
+        self.assertEqual(client.calls, 1)
+        self.assertEqual(
+            {table.table_name for tables in present.data_request.values() for table in tables},
+            {"b01001", "b19013"},
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Section.objects.create(title="Another", order=5, profile=profile)
+        get_request_plan(TimeFrame.PRESENT, client)
+        self.assertEqual(client.calls, 2)
+
+
+    def test_fragment_cache_invalidated_per_design(self):
+        profile = Profile.objects.create(title="Fragments")
+        build_template(profile, 2)
+        geography = detroit()
+        plan = load_profile_plan(profile.pk)
+        api_response, metadata_pool = populate_inputs(plan, geography)
+
+        def fragment_keys(plan):
+            return [
+                design.fragment_key(
+                    geography, api_response, metadata_pool, TimeFrame.PRESENT
+                )
+                for section in plan.sections
+                for row in section.rows
+                for design in row.designs
+            ]
+
+        populated = plan.populate(
+            geography, api_response, metadata_pool, TimeFrame.PRESENT
+        )
+        before = fragment_keys(plan)
+        self.assertTrue(all(caches["fragments"].get(key) is not None for key in before))
+        # Fragments don't crowd the template version out of the default cache
+        self.assertTrue(all(cache.get(key) is None for key in before))
+        # Every table's data is encoded once per build, not once per design
+        with patch("smartcharts.plan.json.dumps", wraps=json.dumps) as dumps:
+            self.assertEqual(
+                plan.populate(geography, api_response, metadata_pool, TimeFrame.PRESENT),
+                populated,
+            )
+        self.assertEqual(dumps.call_count, len(api_response["tables"]))
+
+        chart = ColumnChart.objects.get(title="Chart 1")
+        chart._width = "HALF"
+        chart.save()
+        after = fragment_keys(load_profile_plan(profile.pk))
+
+        # Only chart 1 and the grouped chart holding it get new fragments
+        self.assertEqual(
+            [old == new for old, new in zip(before, after)],
+            [True, True, True, True, False, False],
+        )
+
+
+    def test_section_built_from_its_own_tables(self):
+        profile = Profile.objects.create(title="Sections")
+        build_template(profile, 1)
+        housing = Section.objects.create(title="Housing", order=1, profile=profile)
+        Row.objects.create(title="Units", section=housing).items.add(
+            StatList.objects.create(
+                title="Housing units",
+                stat=DataPoint.objects.create(
+                    identifier="units",
+                    display_name="Units",
+                    lesp_code="(+ B25001001 B25001002)",
+                ),
+                _width="QUARTER",
+                _comparison_type="BINARY",
+                _paradigm="CR",
+            )
+        )
+        geography = detroit()
+
+        class SectionClient(PlaceholderClient):
+            requested = []
+
+            def get_full_geography_object(self, _):
+                return geography
+
+            def get_data_dispatched(self, data_request, _):
+                tables = {
+                    table.table_name.upper()
+                    for table_list in data_request.values()
+                    for table in table_list
+                }
+                self.requested.append(tables)
+                return synthetic_data(tables, geography)
+
+        request = ProfileRequest("06000US2616322000", TimeFrame.PRESENT)
+        with patch("smartcharts.profile.ApiClient", SectionClient):
+            section = geo_section(request, "housing").unwrap()
+            self.assertEqual(geo_section(request, "housing").unwrap(), section)
+            geo_section(request, "section_0")
+            missing = geo_section(request, "nowhere")
+
+        self.assertEqual(section["key"], "housing")
+        self.assertIn("housing_units", section["rows"]["units"]["designs"])
+        # The second call for housing is served from the section cache
+        self.assertEqual(
+            SectionClient.requested, [{"B25001"}, {"B01001", "B19013"}]
+        )
+        self.assertEqual(
+            missing, Failure(ProfileFailureModes.NO_SECTION_AVAILABLE)
+        )
+
+
+    def test_section_failures(self):
+        profile = Profile.objects.create(title="Section failures")
+        build_template(profile, 1)
+        # Other tests build the same section, and a cached one wouldn't fail
+        cache.clear()
+
+        class DownClient(PlaceholderClient):
+            def get_full_geography_object(self, _):
+                raise HipApiError("The api is down.")
+
+        request = ProfileRequest("06000US2616322000", TimeFrame.PRESENT)
+        with patch("smartcharts.profile.ApiClient", DownClient):
+            self.assertEqual(
+                geo_section(request, "section_0"),
+                Failure(ProfileFailureModes.UPSTREAM_FAILURE),
+            )
+            self.assertEqual(
+                geo_section(ProfileRequest("nonsense", TimeFrame.PRESENT), "section_0"),
+                Failure(ProfileFailureModes.UNKNOWN_GEOID),
+            )
+            self.assertEqual(
+                self.client.get(
+                    "/profiles/section/section_0/?geoid=06000US2616322000"
+                ).status_code,
+                503,
+            )
+
+        self.assertEqual(
+            self.client.get("/profiles/section/section_0/?timeframe=later").status_code,
+            400,
+        )
+
+    def test_fetch_geography_data_failures(self):
+        geography = detroit()
+        request = ProfileRequest("06000US2616322000", TimeFrame.PRESENT)
+
+        class Client:
+            def __init__(self, geography_error=None, data_error=None):
+                self.geography_error = geography_error
+                self.data_error = data_error
+
+            def get_full_geography_object(self, _):
+                if self.geography_error:
+                    raise self.geography_error
+                return geography
+
+            def get_data_dispatched(self, *_):
+                raise self.data_error
+
+        def fetch(**errors):
+            return fetch_geography_data(Client(**errors), request, {"tables": []})
+
+        self.assertEqual(
+            fetch(geography_error=NotFound("No such geography.")),
+            Failure(ProfileFailureModes.UNKNOWN_GEOID),
+        )
+        # A 404 for a table of a real geography is the api's problem
+        self.assertEqual(
+            fetch(data_error=NotFound("No such table.")),
+            Failure(ProfileFailureModes.UPSTREAM_FAILURE),
+        )
+        self.assertEqual(
+            fetch(data_error=RetriesExhausted("Down.")),
+            Failure(ProfileFailureModes.UPSTREAM_FAILURE),
+        )
+        # Bugs here aren't reported (or negative cached) as outages
+        with self.assertRaises(KeyError):
+            fetch(data_error=KeyError("B01001"))
+
+    def test_partial_profile_failures_fall_back_to_rebuild(self):
+        profile = Profile.objects.create(title="Partial failures")
+        build_template(profile, 1)
+        request = ProfileRequest("06000US2616322000", TimeFrame.PRESENT)
+
+        class DownClient(PlaceholderClient):
+            def get_full_geography_object(self, _):
+                raise HipApiError("The api is down.")
+
+        class StaleCache(CacheHandler):
+            def check_cache(self, request):
+                # Same release, but none of the current line items
+                return Failure(
+                    StaleProfile(
+                        "Out of date.",
+                        {
+                            "sections": {},
+                            "release_id": release_for_timeframe(request.timeframe),
+                            "profile_format": settings.PROFILE_VERSION,
+                            "line_items": {},
+                        },
+                    )
+                )
+
+        builder = GeoProfileBuilder(
+            StaleCache(),
+            lambda _: Success({"sections": {"rebuilt": True}}),
+            lambda profile: profile,
+            logging.getLogger(),
+            partial_builder=geo_partial_profile,
+            line_items=current_line_items,
+        )
+
+        with patch("smartcharts.profile.ApiClient", DownClient):
+            self.assertEqual(
+                geo_partial_profile(request, ["section_0/row_0/design_0"]),
+                Failure(ProfileFailureModes.UPSTREAM_FAILURE),
+            )
+            self.assertEqual(
+                geo_partial_profile(
+                    ProfileRequest("nonsense", TimeFrame.PRESENT),
+                    ["section_0/row_0/design_0"],
+                ),
+                Failure(ProfileFailureModes.UNKNOWN_GEOID),
+            )
+            self.assertEqual(
+                builder.build_geoid(request)["sections"], {"rebuilt": True}
+            )
+
+    def test_section_cache_key_follows_release(self):
+        profile = Profile.objects.create(title="Section release")
+        build_template(profile, 1)
+        section = load_profile_plan(profile.pk).sections[0]
+        request = ProfileRequest("06000US2616322000", TimeFrame.PRESENT)
+
+        before = section_cache_key(request, section)
+        with override_settings(ACS_YEAR="acs2099_5yr"):
+            self.assertNotEqual(section_cache_key(request, section), before)
+
+    @override_settings(
+        PARALLEL_POPULATE_WORKERS=2,
+        PARALLEL_POPULATE_MIN_SECTIONS=2,
+        FRAGMENT_CACHE_TIMEOUT=0,
+    )
+    def test_parallel_populate_matches_serial(self):
+        profile = Profile.objects.create(title="Parallel")
+        build_template(profile, 3)
+        geography = detroit()
+        plan = load_profile_plan(profile.pk)
+        api_response, metadata_pool = populate_inputs(plan, geography)
+
+        self.assertTrue(should_populate_in_parallel(plan))
+        try:
+            parallel = plan.populate(
+                geography, api_response, metadata_pool, TimeFrame.PRESENT
+            )
+        finally:
+            shutdown_pool()
+
+        with self.settings(PARALLEL_POPULATE_WORKERS=0):
+            serial = plan.populate(
+                geography, api_response, metadata_pool, TimeFrame.PRESENT
+            )
+
+        self.assertEqual(parallel, serial)
+        self.assertEqual(
+            list(parallel["sections"]), ["section_0", "section_1", "section_2"]
+        )
+
+    @override_settings(
+        PARALLEL_POPULATE_WORKERS=2,
+        PARALLEL_POPULATE_MIN_SECTIONS=2,
+        FRAGMENT_CACHE_TIMEOUT=0,
+    )
+    def test_parallel_geo_profile_matches_serial(self):
+        """
+        The whole geo_profile path, on a geography with comparatives, gives
+        the same profile either way.
+        """
+        profile = Profile.objects.create(title="Parallel profile")
+        build_template(profile, 4)
+        geography = detroit()
+        geography.parents = [
+            Geography(
+                "Wayne County, MI",
+                "05000US26163",
+                parents=[Geography("Michigan", "04000US26")],
+            )
+        ]
+
+        class LineageClient(PlaceholderClient):
+            def get_full_geography_object(self, _):
+                return geography
+
+            def get_data_dispatched(self, data_request, _):
+                return synthetic_data(
+                    {
+                        table.table_name.upper()
+                        for table_list in data_request.values()
+                        for table in table_list
+                    },
+                    geography,
+                )
+
+        request = ProfileRequest(geography.full_geoid, TimeFrame.PRESENT)
+        with patch("smartcharts.profile.ApiClient", LineageClient):
+            try:
+                parallel = geo_profile(request).unwrap()
+            finally:
+                shutdown_pool()
+
+            with self.settings(PARALLEL_POPULATE_WORKERS=0):
+                serial = geo_profile(request).unwrap()
+
+        self.assertEqual(parallel, serial)
+        self.assertEqual(
+            serial["geography"]["comparatives"], ["county", "state"]
+        )
+
+    @override_settings(PARALLEL_POPULATE_WORKERS=2)
+    def test_parallel_populate_worker_failures(self):
+        geography = detroit()
+
+        try:
+            # Section code that raises fails the build, as it would serially
+            with self.assertRaises(ValueError):
+                populate_sections(
+                    [BrokenSection()], geography, {}, None, TimeFrame.PRESENT
+                )
+            self.assertIsNotNone(parallel._pool)
+
+            # A dead worker breaks the pool, so it's replaced
+            with self.assertRaises(BrokenProcessPool):
+                populate_sections(
+                    [DyingSection()], geography, {}, None, TimeFrame.PRESENT
+                )
+            self.assertIsNone(parallel._pool)
+            self.assertEqual(
+                populate_sections(
+                    [BrokenSection(fail=False)], geography, {}, None, TimeFrame.PRESENT
+                ),
+                {"broken": {"title": "Fine"}},
+            )
+        finally:
+            shutdown_pool()
+
+    @override_settings(
+        PARALLEL_POPULATE_WORKERS=2,
+        PARALLEL_POPULATE_MIN_SECTIONS=2,
+        FRAGMENT_CACHE_TIMEOUT=0,
+    )
+    def test_parallel_populate_falls_back_when_a_worker_dies(self):
+        profile = Profile.objects.create(title="Dying worker")
+        build_template(profile, 2)
+        geography = detroit()
+        plan = load_profile_plan(profile.pk)
+        api_response, metadata_pool = populate_inputs(plan, geography)
+
+        with self.settings(PARALLEL_POPULATE_WORKERS=0):
+            serial = plan.populate_sections(
+                geography, api_response, metadata_pool, TimeFrame.PRESENT
+            )
+
+        def broken_pool(*_):
+            raise BrokenProcessPool("A worker died.")
+
+        with patch("smartcharts.plan.populate_sections", broken_pool):
+            self.assertEqual(
+                plan.populate_sections(
+                    geography, api_response, metadata_pool, TimeFrame.PRESENT
+                ),
+                serial,
+            )
+
+
+    def test_populate_line_items(self):
+        profile = Profile.objects.create(title="Line items")
+        build_template(profile, 2)
+        geography = detroit()
+        plan = load_profile_plan(profile.pk)
+        api_response, metadata_pool = populate_inputs(plan, geography)
+        populated = plan.populate(
+            geography, api_response, metadata_pool, TimeFrame.PRESENT
+        )
+
+        self.assertEqual(populated["line_items"], plan.line_items())
+        self.assertEqual(
+            plan.populate_line_items(
+                plan.line_items(),
+                geography,
+                api_response,
+                metadata_pool,
+                TimeFrame.PRESENT,
+            ),
+            populated["sections"],
+        )
+
+        partial = plan.populate_line_items(
+            ["section_1/row_1/chart_1"],
+            geography,
+            api_response,
+            metadata_pool,
+            TimeFrame.PRESENT,
+        )
+        self.assertEqual(
+            partial["section_1"]["rows"]["row_1"]["designs"],
+            {
+                "stat_1": None,
+                "chart_1": populated["sections"]["section_1"]["rows"]["row_1"][
+                    "designs"
+                ]["chart_1"],
+                "grouped_1": None,
+            },
+        )
+        self.assertEqual(
+            {
+                table.name
+                for table in plan.shopping_list_for(["section_0/row_0/stat_0"])
+            },
+            {"B01001"},
+        )
+
+
+    def test_profile_version_follows_template(self):
+        profile = Profile.objects.create(title="Versioned")
+        build_template(profile, 2)
+        before = load_profile_plan(profile.pk)
+
+        self.assertNotEqual(
+            before.profile_version(TimeFrame.PRESENT),
+            before.profile_version(TimeFrame.PAST),
+        )
+
+        point = DataPoint.objects.get(identifier="point_1")
+        point.lesp_code = "(/ B01001003 B01001001)"
+        point.save()
+        after = load_profile_plan(profile.pk)
+
+        self.assertNotEqual(
+            before.profile_version(TimeFrame.PRESENT),
+            after.profile_version(TimeFrame.PRESENT),
+        )
+        self.assertEqual(
+            [
+                before.section_versions()[key] == version
+                for key, version in after.section_versions().items()
+            ],
+            [True, False],
+        )
+
+
+# Builds a small plan by hand and prints its versions, in a fresh process
+PLAN_VERSION_SCRIPT = """
+import django
+django.setup()
+
+from smartcharts.metadata import ComparisonType, DataParadigm, TimeFrame
+from smartcharts.models import ColumnWidth
+from smartcharts.plan import (
+    PlannedDataPoint,
+    PlannedRow,
+    PlannedStatList,
+    build_section_plan,
+    build_profile_plan,
+)
+
+tables = ["B01001", "B02001", "B03002", "B19013", "B25077", "C17002"]
+points = tuple(
+    PlannedDataPoint(i, table, table, table, f"(+ {table}001 {table}002)", (table,))
+    for i, table in enumerate(tables)
+)
+design = PlannedStatList(
+    1, "stat", "Stat", "stat", ColumnWidth.QUARTER, ComparisonType.BINARY,
+    DataParadigm.CR, points, stat_type="PCT",
+)
+row = PlannedRow(1, "Row", "row", False, (design,))
+section = build_section_plan(1, "Section", "section", (row,))
+plan = build_profile_plan(1, "Plan", (section,))
+print(section.version, plan.profile_version(TimeFrame.PRESENT))
+"""
+
+
+class TestPlanVersion(TestCase):
+    def test_versions_agree_across_processes(self):
+        """
+        Every worker has to agree on the versions, or each one treats the
+        others' cached profiles as stale. String hashing is seeded per
+        process, so nothing hash-ordered can go into them.
+        """
+        versions = {
+            subprocess.run(
+                [sys.executable, "-c", PLAN_VERSION_SCRIPT],
+                env={**os.environ, "PYTHONHASHSEED": seed},
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+            for seed in ("1", "2")
+        }
+
+        self.assertEqual(len(versions), 1)
+
+
+class TestLespAnalysis(TestCase):
+    def test_constant_folding(self):
+        analysis = analyze_program("(* (/ 1 4) (+ B01001002 B01001003))")
+
+        self.assertEqual(analysis.program, ["*", 0.25, ["+", "B01001002", "B01001003"]])
+        self.assertEqual(analysis.tables, ("B01001",))
+        # two reads, one add, one multiply
+        self.assertEqual(analysis.cost, 4)
+
+    def test_cost_counts_variadic_operations(self):
+        analysis = analyze_program("(+ B01001001 B01001002 B01001003)")
+
+        self.assertEqual(analysis.cost, 5)
+
+    def test_unary_operations_are_left_to_lesp(self):
+        self.assertEqual(fold_constants(parse("(- 5)")), ["-", 5.0])
+        self.assertEqual(fold_constants(parse("(/ 4)")), ["/", 4.0])
+        self.assertEqual(fold_constants(parse("(+ 5)")), 5.0)
+
+    def test_variables_come_from_lesp(self):
+        lesp_code = "(+ B01001002 (* 2 B01001002) B02001003)"
+        analysis = analyze_program(lesp_code)
+
+        self.assertEqual(
+            analysis.variables, tuple(sorted(set(extract_variables(lesp_code))))
+        )
+        self.assertEqual(analysis.tables, ("B01001", "B02001"))
+
+    def test_rejects_broken_programs(self):
+        for lesp_code in ["", "(+ B01001001", "(+ B01001001))", "()", "(/ B01001001 (- 2 2))"]:
+            with self.assertRaises(LespAnalysisError):
+                analyze_program(lesp_code)
+
+    def test_profile_cost(self):
+        profile = Profile.objects.create(title="Costed Profile")
+        section = Section.objects.create(title="Section", profile=profile)
+        row = Row.objects.create(title="Row", section=section)
+        point = DataPoint.objects.create(
+            identifier="costed",
+            display_name="Costed",
+            lesp_code="(/ B01001002 B01001001)",
+        )
+        design = StatList.objects.create(
+            title="Costed stat",
+            _width="QUARTER",
+            _comparison_type="BINARY",
+            _paradigm="CR",
+            stat=point,
+        )
+        row.items.add(design)
+
+        self.assertEqual(point.cost, 3)
+        self.assertEqual(profile.estimated_cost(), 3)
+
+
 class TestGeography(TestCase):
     def test_show_lineage(self):
         geography = Geography(
@@ -259,6 +1085,70 @@ class TestBuildItem(TestCase):
         self.assertAlmostEqual(result["values"]["this"], 100 / 3)
         self.assertEqual(result["numerators"]["this"], 20000)
 
+    def test_transpose_estimate(self):
+        result = transpose_estimate(
+            "Basic Item",
+            {
+                "this": Estimate(50.0, 5.0),
+                "state": Estimate(100.0, 2.0),
+            },
+        )
+
+        self.assertEqual(result["name"], "Basic Item")
+        self.assertEqual(result["values"], {"this": 50.0, "state": 100.0})
+        self.assertEqual(result["error"], {"this": 5.0, "state": 2.0})
+        self.assertEqual(result["index"], {"this": 100, "state": 50})
+        self.assertEqual(result["error_ratio"], {"this": 10.0, "state": 2.0})
+
+    def test_select_comparatives(self):
+        lineage = [
+            {"relation": "this", "geoid": "14000US26163500100"},
+            {"relation": "county", "geoid": "05000US26163"},
+            {"relation": "CBSA", "geoid": "31000US19820"},
+            {"relation": "state", "geoid": "04000US26"},
+            {"relation": "nation", "geoid": "01000US"},
+        ]
+
+        self.assertEqual(
+            [geography["relation"] for geography in select_comparatives(lineage)],
+            ["this", "CBSA", "state"],
+        )
+
+    def test_saturate_datapoint_memoized(self):
+        cache = ResultCache(maxsize=10)
+        lesp_code = "(* 100 (/ B01001002 B01001001))"
+
+        first = saturate_datapoint(
+            "Basic Item",
+            self.api_response,
+            self.parents_detailed_lineage,
+            lesp_code,
+            release="acs2021_5yr",
+            cache=cache,
+        )
+        second = saturate_datapoint(
+            "Basic Item",
+            self.api_response,
+            self.parents_detailed_lineage,
+            lesp_code,
+            release="acs2021_5yr",
+            cache=cache,
+        )
+
+        self.assertEqual(first, second)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_result_cache_evicts_least_recently_used(self):
+        cache = ResultCache(maxsize=2)
+        cache.put("a", Estimate(1.0, 0.1))
+        cache.put("b", Estimate(2.0, 0.1))
+        cache.get("a")
+        cache.put("c", Estimate(3.0, 0.1))
+
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), Estimate(1.0, 0.1))
+        self.assertEqual(len(cache), 2)
+
     def test_evaluate_data_point(self):
         datapoint = DataPoint.objects.create(
             title="A serious data point",
@@ -289,3 +1179,29 @@ class TestApiClient(TestCase):
 
     def _test_get_parents(self):
         geo_obj = self.client.get_full_geography_object("06000US2616322000")
+
+    def test_missing_tables_only_counts_not_found(self):
+        def response(status_code, payload):
+            r = Mock(status_code=status_code)
+            r.json.return_value = payload
+            return r
+
+        def catalog(url, params=None):
+            if url.endswith("/metadata/tables/b01001"):
+                return response(200, {"tables": [{"table_id": "b01001"}]})
+            if "/metadata/tables/" in url:
+                return response(404, {"error": "No such table"})
+            if url.endswith("/1.0/table/B02001"):
+                return response(200, {"table_id": "B02001"})
+            if url.endswith("/1.0/table/B03002"):
+                return response(500, {"error": "Database is down"})
+            return response(404, {"error": "No such table"})
+
+        with patch("smartcharts.api_client.requests.get", side_effect=catalog):
+            self.assertEqual(
+                self.client.missing_tables(["B01001", "B02001", "B99999"]),
+                ["B99999"],
+            )
+
+            with self.assertRaises(HipApiError):
+                self.client.missing_tables(["B03002"])
@@ -0,0 +1,127 @@
+from io import StringIO
+
+import boto3
+import pytest
+from django.core.management import call_command
+from returns.result import Failure, Success
+
+from ..api_client import ApiClient
+from ..management.commands import warm_profile_cache
+from ..metadata import TimeFrame
+from ..profile import ProfileFailureModes, ProfileRequest
+from ..s3handler import reset_s3_clients
+from .test_s3_handler import MockSession
+
+
+@pytest.fixture
+def stub_build(monkeypatch):
+    """
+    S3 is the mock client and the api is a stub that knows every geoid
+    but 99000US1, and breaks on 99000US2.
+    """
+    reset_s3_clients()
+    monkeypatch.setattr(boto3, "Session", MockSession)
+    monkeypatch.setattr(warm_profile_cache, "_handler", None)
+    monkeypatch.setattr(warm_profile_cache, "current_profile_version", lambda _: "v1")
+    monkeypatch.setattr(warm_profile_cache, "enhance_api_data", lambda profile: profile)
+
+    built = []
+
+    def stub_profile(request):
+        built.append(request.geoid)
+        if request.geoid == "99000US1":
+            return Failure(ProfileFailureModes.UNKNOWN_GEOID)
+        if request.geoid == "99000US2":
+            raise KeyError("B01001")
+        return Success({"geoid": request.geoid})
+
+    monkeypatch.setattr(warm_profile_cache, "geo_profile", stub_profile)
+    monkeypatch.setattr(
+        ApiClient,
+        "get_child_geoids",
+        lambda _, sumlevel, parent: [
+            f"{sumlevel}00US{parent[-2:]}{i}" for i in range(3)
+        ],
+    )
+
+    yield built
+    reset_s3_clients()
+
+
+def warm(**options) -> str:
+    out = StringIO()
+    call_command(
+        "warm_profile_cache",
+        workers=0,
+        uploads=2,
+        stdout=out,
+        stderr=StringIO(),
+        **options,
+    )
+    return out.getvalue()
+
+
+def test_warm_from_file_and_resume(stub_build, tmp_path):
+    geoids = tmp_path / "geoids.txt"
+    geoids.write_text("# Michigan\n04000US26\n05000us26163\n\n99000US1\n04000US26\n")
+    checkpoint = tmp_path / "checkpoint"
+
+    output = warm(file=str(geoids), checkpoint=str(checkpoint))
+
+    assert sorted(stub_build) == ["04000US26", "05000US26163", "99000US1"]
+    assert "2 built, 0 already current, 1 failed" in output
+    assert set(checkpoint.read_text().split()) == {
+        "present:v1:04000US26",
+        "present:v1:05000US26163",
+    }
+    assert warm_profile_cache.worker_handler().is_current(
+        ProfileRequest("04000US26", TimeFrame.PRESENT)
+    )
+
+    # Only the failure is tried again
+    stub_build.clear()
+    warm(file=str(geoids), checkpoint=str(checkpoint))
+    assert stub_build == ["99000US1"]
+
+    # Without the checkpoint, current profiles are skipped, not rebuilt
+    stub_build.clear()
+    output = warm(file=str(geoids))
+    assert stub_build == ["99000US1"]
+    assert "0 built, 2 already current, 1 failed" in output
+
+
+def test_warm_checkpoint_follows_profile_version(stub_build, tmp_path, monkeypatch):
+    geoids = tmp_path / "geoids.txt"
+    geoids.write_text("04000US26\n")
+    checkpoint = tmp_path / "checkpoint"
+    warm(file=str(geoids), checkpoint=str(checkpoint))
+
+    # A new template or release makes the old entries stale
+    monkeypatch.setattr(warm_profile_cache, "current_profile_version", lambda _: "v2")
+    monkeypatch.setattr(warm_profile_cache, "_handler", None)
+    stub_build.clear()
+    output = warm(file=str(geoids), checkpoint=str(checkpoint))
+
+    assert stub_build == ["04000US26"]
+    assert "1 built" in output
+    assert "present:v2:04000US26" in checkpoint.read_text().split()
+
+
+def test_warm_sumlevel_expansion(stub_build):
+    output = warm(
+        within="04000US26", sumlevels=["050", "140"], timeframes=["present", "past"]
+    )
+
+    assert len(stub_build) == 12
+    assert "12 built" in output
+    assert "profiles/s" in output
+
+
+def test_warm_continues_past_errors(stub_build, tmp_path):
+    geoids = tmp_path / "geoids.txt"
+    geoids.write_text("99000US2\n04000US26\n")
+
+    output = warm(file=str(geoids))
+
+    assert sorted(stub_build) == ["04000US26", "99000US2"]
+    assert "1 built, 0 already current, 1 failed" in output
@@ -0,0 +1,317 @@
+"""
+Tiered Cache
+
+Every S3 hit is a network round trip followed by a gunzip and a JSON
+parse. The handlers here put faster tiers in front of it:
+
+    MemoryCache  a bounded LRU of ready-to-serve profiles in this process
+                 (parsed only, so it can't serve gzip pass-through)
+    DiskCache    gzipped profiles on local disk, evicted by total size
+    S3Handler    the shared store every process can see
+
+TieredCacheHandler reads them fastest first, copies a hit into the tiers
+above the one it came from, and writes new profiles to all of them. Every
+tier checks the profile version itself, so a stale entry in a fast tier
+never hides a fresh one further down.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+from typing import Callable
+import fcntl
+import gzip
+import json
+import os
+import tempfile
+
+from django.utils.safestring import SafeString
+from returns.result import Result, Success, Failure
+
+from .profile import ProfileRequest
+from .compression import get_codec
+from .s3handler import CacheHandler, StaleProfile, resolve_version
+
+
+def profile_key(request: ProfileRequest) -> tuple[str, str]:
+    return (request.geoid.upper(), request.timeframe.value.lower())
+
+
+def safe_name(name: str) -> str:
+    # geoids come from the url, so keep them from walking the tree
+    return "".join(c if (c.isalnum() or c == "-") else "_" for c in name)
+
+
+def check_version(profile: dict, version: str) -> Result:
+    if profile.get("profile_version", "") == version:
+        return Success(profile)
+
+    return Failure(
+        StaleProfile("The profile must be updated for this geoid.", profile)
+    )
+
+
+class MemoryCache(CacheHandler):
+    """
+    Profiles are kept as the dicts the views render, so a hit costs a dict
+    lookup. Hits are handed out as shallow copies, because the views add
+    their own keys to the profile.
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        profile_version: str | Callable[[ProfileRequest], str],
+    ):
+        self.maxsize = maxsize
+        self.profile_version = profile_version
+        self._entries: OrderedDict[tuple[str, str], dict] = OrderedDict()
+        self._lock = Lock()
+
+    def check_cache(self, request: ProfileRequest) -> Result:
+        key = profile_key(request)
+
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+            except KeyError:
+                return Failure("This geoid isn't in the memory cache.")
+            profile = dict(self._entries[key])
+
+        return check_version(profile, resolve_version(self.profile_version, request))
+
+    def cache_profile(self, request: ProfileRequest, profile: dict):
+        profile.update(
+            {"profile_version": resolve_version(self.profile_version, request)}
+        )
+
+        with self._lock:
+            self._entries[profile_key(request)] = dict(profile)
+            self._entries.move_to_end(profile_key(request))
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskCache(CacheHandler):
+    """
+    One gzipped JSON file per profile, named by its version so the version
+    can be checked without opening it. Reads bump the file's modified
+    time, so eviction drops the least recently used files once the
+    directory grows past max_bytes.
+
+    Every worker process on the host shares the directory, so the total
+    size is kept in a file next to the profiles and only changed under an
+    flock on it. Each eviction rescans the directory, which corrects the
+    total if files were removed behind the cache's back.
+    """
+
+    def __init__(
+        self,
+        root: str | Path,
+        max_bytes: int,
+        profile_version: str | Callable[[ProfileRequest], str],
+    ):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.profile_version = profile_version
+        self.codec = get_codec("gzip")
+        self._lock = Lock()
+
+    def to_path(self, request: ProfileRequest, version: str | None = None) -> Path:
+        geoid, timeframe = profile_key(request)
+        version = version or resolve_version(self.profile_version, request)
+        return (
+            self.root / timeframe / safe_name(geoid) / f"{safe_name(version)}.json.gz"
+        )
+
+    def read(self, path: Path) -> dict:
+        with gzip.open(path, "rb") as compressed:
+            profile_data_json = compressed.read().decode()
+
+        profile_data = json.loads(profile_data_json)
+        profile_data["profile_data_json"] = SafeString(profile_data_json)
+
+        return profile_data
+
+    def check_cache(self, request: ProfileRequest) -> Result:
+        path = self.to_path(request)
+
+        try:
+            profile_data = self.read(path)
+            os.utime(path)
+        except FileNotFoundError:
+            if older := next(path.parent.glob("*.json.gz"), None):
+                return Failure(
+                    StaleProfile(
+                        "The profile must be updated for this geoid.",
+                        lambda: self.read(older),
+                    )
+                )
+            return Failure("This geoid isn't in the disk cache.")
+        except (OSError, EOFError, ValueError):
+            return Failure("The disk cache entry for this geoid is unreadable.")
+
+        return Success(profile_data)
+
+    def check_cache_gzip(self, request: ProfileRequest) -> Result:
+        path = self.to_path(request)
+
+        try:
+            compressed = path.read_bytes()
+            os.utime(path)
+        except FileNotFoundError:
+            return Failure("This geoid isn't in the disk cache.")
+
+        return Success(compressed)
+
+    def cache_profile(self, request: ProfileRequest, profile: dict):
+        version = resolve_version(self.profile_version, request)
+        profile.update({"profile_version": version})
+        # The json is rebuilt from the file on the way out
+        profile_json = json.dumps(
+            {
+                key: value
+                for key, value in profile.items()
+                if key != "profile_data_json"
+            }
+        )
+
+        path = self.to_path(request, version)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Written like the S3 objects, so gzip pass-through can splice them.
+        # The temporary name is unique, since threads and processes may be
+        # writing the same profile at once.
+        compressor = self.codec.compressor(self.codec.default_level)
+        with tempfile.NamedTemporaryFile(
+            dir=path.parent, suffix=".tmp", delete=False
+        ) as temporary:
+            try:
+                temporary.write(
+                    compressor.compress(profile_json.encode()) + compressor.flush()
+                )
+            except BaseException:
+                os.unlink(temporary.name)
+                raise
+
+        with self.size_lock():
+            size = self.current_size()
+            previous = path.stat().st_size if path.exists() else 0
+            os.replace(temporary.name, path)
+            size += path.stat().st_size - previous
+
+            # Older versions of this profile won't be served again
+            for other in path.parent.glob("*.json.gz"):
+                if other != path:
+                    size -= self.remove(other)
+
+            if size > self.max_bytes:
+                size = self.evict()
+            self.size_path.write_text(str(size))
+
+    def entries(self) -> list[tuple[Path, os.stat_result]]:
+        entries = []
+        for path in self.root.glob("*/*/*.json.gz"):
+            try:
+                entries.append((path, path.stat()))
+            except FileNotFoundError:
+                # Evicted by another process
+                continue
+        return entries
+
+    @property
+    def size_path(self) -> Path:
+        return self.root / "size"
+
+    @contextmanager
+    def size_lock(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        with self._lock, open(self.root / "size.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def current_size(self) -> int:
+        try:
+            return int(self.size_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return sum(stat.st_size for _, stat in self.entries())
+
+    def remove(self, path: Path) -> int:
+        try:
+            size = path.stat().st_size
+            path.unlink()
+        except FileNotFoundError:
+            # Removed by another process
+            return 0
+        return size
+
+    def evict(self) -> int:
+        """
+        Removes the least recently used files until the directory fits in
+        max_bytes, returning its size from the scan.
+        """
+        entries = sorted(self.entries(), key=lambda entry: entry[1].st_mtime)
+        size = sum(stat.st_size for _, stat in entries)
+
+        for path, _ in entries:
+            if size <= self.max_bytes:
+                break
+            size -= self.remove(path)
+
+        return size
+
+
+class TieredCacheHandler(CacheHandler):
+    def __init__(self, tiers: list[CacheHandler]):
+        self.tiers = tiers
+
+    def check_cache(self, request: ProfileRequest) -> Result:
+        stale = None
+        failure = Failure("This geoid isn't cached in any tier.")
+
+        for depth, tier in enumerate(self.tiers):
+            match tier.check_cache(request):
+                case Success(profile):
+                    for faster in self.tiers[:depth]:
+                        faster.cache_profile(request, dict(profile))
+                    return Success(profile)
+
+                case Failure(StaleProfile() as found):
+                    stale = stale or found
+
+                case Failure(_) as failure:
+                    pass
+
+        return Failure(stale) if stale is not None else failure
+
+    def check_cache_gzip(self, request: ProfileRequest) -> Result:
+        """
+        The first tier holding the current profile as gzip bytes. Hits
+        aren't promoted here; check_cache does that for the parsed path.
+        """
+        failure = Failure("This geoid isn't cached as gzip in any tier.")
+
+        for tier in self.tiers:
+            match tier.check_cache_gzip(request):
+                case Success(compressed):
+                    return Success(compressed)
+                case Failure(_) as failure:
+                    pass
+
+        return failure
+
+    def cache_profile(self, request: ProfileRequest, profile: dict):
+        for tier in self.tiers:
+            tier.cache_profile(request, profile)
@@ -1,8 +1,15 @@
 from django.contrib import admin
 from django.urls import path
-from .views import geography_profile, timeseries_geography_profile
+from .views import (
+    geography_profile,
+    timeseries_geography_profile,
+    timeseries_profile_data,
+    geography_section,
+)
 
 urlpatterns = [
     path("present/", geography_profile),
     path("over-time/", timeseries_geography_profile),
+    path("over-time/data/", timeseries_profile_data),
+    path("section/<str:section_key>/", geography_section),
 ]
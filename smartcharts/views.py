@@ -1,14 +1,31 @@
+import json
 import logging
 from django.conf import settings
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, HttpResponseBadRequest, Http404
 from django.shortcuts import render
+from django.views.decorators.vary import vary_on_headers
 from returns.result import Success, Failure
 
-from .profile import ProfileRequest, geo_profile, enhance_api_data, ProfileFailureModes
+from .profile import (
+    ProfileRequest,
+    geo_profile,
+    geo_section,
+    geo_partial_profile,
+    current_line_items,
+    current_profile_version,
+    enhance_api_data,
+    ProfileFailureModes,
+)
 from .performance_profile import measure_performance
-from .build_manager import GeoProfileBuilder
+from .build_manager import GeoProfileBuilder, ProfileUnavailable
+from .negative_cache import NegativeCache
+from .popularity import PopularityTracker
 from .s3handler import S3Handler
+from . import metrics
+from .tiered_cache import MemoryCache, DiskCache, TieredCacheHandler
 from .metadata import TimeFrame
+from .compression import join_gzip
+from .utils import LazyEncoder
 
 
 logging.basicConfig()
@@ -17,31 +34,88 @@ logger = logging.getLogger(__name__)
 
 def build_s3_handler():
     """
-    You should cache this object for some length of time, because 
-    it's surprisingly expensive to build.
+    Cheap to build per request: the boto3 client behind it, which is the
+    expensive part, is made once per process and shared (see
+    s3handler.get_s3_client).
     """
     return S3Handler(
         settings.AWS_KEY,
         settings.AWS_SECRET,
         settings.AWS_SERVER_NAME,
         settings.AWS_FILE_ROOT,
-        settings.PROFILE_VERSION,
+        # Derived from the template and release, see current_profile_version
+        current_profile_version,
         dont_check=settings.DONT_CHECK_CACHE,
         dont_update=settings.DONT_CACHE,
+        codec=settings.PROFILE_CACHE_CODEC,
+        compression_level=settings.PROFILE_CACHE_COMPRESSION_LEVEL,
     )
 
 
+# Shared by every request this process serves
+memory_cache = MemoryCache(settings.PROFILE_MEMORY_CACHE_SIZE, current_profile_version)
+popularity = PopularityTracker(settings.PREWARM_TOP_N)
+
+
+@metrics.timed("views.build_cache_handler")
+def build_cache_handler():
+    """
+    Memory, then local disk (if configured), then S3.
+    """
+    s3_handler = build_s3_handler()
+    if settings.DONT_CHECK_CACHE:
+        return s3_handler
+
+    tiers = [memory_cache]
+    if settings.PROFILE_DISK_CACHE_DIR:
+        tiers.append(
+            DiskCache(
+                settings.PROFILE_DISK_CACHE_DIR,
+                settings.PROFILE_DISK_CACHE_BYTES,
+                current_profile_version,
+            )
+        )
+    tiers.append(s3_handler)
+
+    return TieredCacheHandler(tiers)
+
+
 def bob_the_builder(build_strategy=geo_profile, enhancer=enhance_api_data):
     return GeoProfileBuilder(
-        # Add the Cache handler of choice, in this case s3
-        cache_handler=build_s3_handler(),
+        # Add the Cache handler of choice, in this case memory, disk and s3
+        cache_handler=build_cache_handler(),
         # Provide the builder with the profile creation functions and the logger.
         builder=build_strategy,
         enhancer=enhancer,  # This is a peculiarity of census reporter that I'd like to factor out
         logger=logger,
+        # Cached profiles are patched with just the designs that changed.
+        partial_builder=geo_partial_profile,
+        line_items=current_line_items,
+        # Out of date profiles are served at once and rebuilt in the background.
+        serve_stale=settings.SERVE_STALE_PROFILES,
+        # Geoids that just failed to build are turned away for a while.
+        negative_cache=NegativeCache(),
+        # The most requested profiles are rebuilt when the version changes.
+        popularity=popularity if settings.PREWARM_TOP_N else None,
+        profile_version=current_profile_version,
     )
 
 
+def unavailable_response(unavailable: ProfileUnavailable) -> HttpResponse:
+    match unavailable.reason:
+        case ProfileFailureModes.UNKNOWN_GEOID | ProfileFailureModes.EMPTY_DATA:
+            raise Http404(f"There is no profile for this geoid ({unavailable}).")
+        case _:
+            headers = {}
+            if unavailable.retry_after:
+                headers["Retry-After"] = str(unavailable.retry_after)
+            return HttpResponse(
+                "The profile can't be built right now.",
+                status=503,
+                headers=headers,
+            )
+
+
 @measure_performance
 def geography_profile(request):
     # Create request object to for the profile builder
@@ -54,40 +128,92 @@ def geography_profile(request):
     profile_builder = bob_the_builder()
 
     # Build the profile!
-    profile_result = profile_builder.build_geoid(new_request)
-
-    match profile_result:
-        case Failure(fail_reason):
-            match fail_reason:
-                case _:
-                    raise Exception
-        case Success(profile):
-            # This stuff maybe can be factored out to some obj to pass around.
-            profile.update(
-                {
-                    "ACS_YEAR_NUMERIC": settings.ACS_YEAR_NUMERIC,
-                    "API_URL": settings.API_URL,
-                }
-            )
+    try:
+        profile = profile_builder.build_geoid(new_request)
+    except ProfileUnavailable as unavailable:
+        return unavailable_response(unavailable)
 
-            return render(request, 'smartcharts/profile.html', profile)
+    # This stuff maybe can be factored out to some obj to pass around.
+    profile.update(
+        {
+            "ACS_YEAR_NUMERIC": settings.ACS_YEAR_NUMERIC,
+            "API_URL": settings.API_URL,
+        }
+    )
 
+    return render(request, 'smartcharts/profile.html', profile)
 
-def timeseries_geography_profile(_):
-    past_request = ProfileRequest(        
-        geoid="06000US2616322000",
-        timeframe=TimeFrame.PAST,
-    )
 
+def timeseries_requests() -> tuple[ProfileRequest, ProfileRequest]:
     present_request = ProfileRequest(
         geoid="06000US2616322000",
         timeframe=TimeFrame.PRESENT,
     )
+    past_request = ProfileRequest(
+        geoid="06000US2616322000",
+        timeframe=TimeFrame.PAST,
+    )
+    return present_request, past_request
+
+
+def without_profile_json(profile: dict) -> dict:
+    return {
+        key: value for key, value in profile.items() if key != "profile_data_json"
+    }
+
+
+def gzip_passthrough(*parts: str | bytes) -> HttpResponse | None:
+    """
+    Splices stored gzipped JSON and literal JSON (str parts) into one gzip
+    stream, without inflating the stored objects. None if one of them was
+    written before they could be spliced.
+    """
+    if (compressed := join_gzip(*parts)) is None:
+        return None
+
+    return HttpResponse(
+        compressed,
+        content_type="application/json",
+        headers={"Content-Encoding": "gzip"},
+    )
 
+
+def timeseries_passthrough(profile_builder, present_request, past_request):
+    """
+    Both cached profiles sent as they are stored, or None if either isn't
+    cached that way.
+    """
+    match (
+        profile_builder.check_cache_gzip(present_request),
+        profile_builder.check_cache_gzip(past_request),
+    ):
+        case (Success(present_gzip), Success(past_gzip)):
+            return gzip_passthrough(
+                (
+                    f'{{"current_year": {json.dumps(settings.ACS_YEAR_NUMERIC)}, '
+                    f'"past_year": {json.dumps(settings.ACS_PAST_YEAR_NUMERIC)}, '
+                    f'"ACS_YEAR_NUMERIC": {json.dumps(settings.ACS_YEAR_NUMERIC)}, '
+                    f'"API_URL": {json.dumps(settings.API_URL)}, '
+                    '"profile_data_current_year": '
+                ),
+                present_gzip,
+                ', "profile_data_past_year": ',
+                past_gzip,
+                "}",
+            )
+
+    return None
+
+
+def timeseries_geography_profile(_):
+    present_request, past_request = timeseries_requests()
     profile_builder = bob_the_builder()
 
-    past_profile = profile_builder.build_geoid(past_request)
-    present_profile = profile_builder.build_geoid(present_request)
+    try:
+        past_profile = profile_builder.build_geoid(past_request)
+        present_profile = profile_builder.build_geoid(present_request)
+    except ProfileUnavailable as unavailable:
+        return unavailable_response(unavailable)
     
     return JsonResponse({
         "current_year": settings.ACS_YEAR_NUMERIC,
@@ -103,6 +229,67 @@ def timeseries_geography_profile(_):
     })
 
 
+@vary_on_headers("Accept-Encoding")
+def timeseries_profile_data(request):
+    """
+    The over time profiles without their profile_data_json_* strings, so
+    clients that accept gzip can be sent the cached profiles as they are
+    stored. Other clients, and cache misses, get the same keys as JSON.
+    """
+    present_request, past_request = timeseries_requests()
+    profile_builder = bob_the_builder()
+
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        response = timeseries_passthrough(
+            profile_builder, present_request, past_request
+        )
+        if response is not None:
+            return response
+
+    try:
+        past_profile = profile_builder.build_geoid(past_request)
+        present_profile = profile_builder.build_geoid(present_request)
+    except ProfileUnavailable as unavailable:
+        return unavailable_response(unavailable)
+
+    return JsonResponse({
+        "current_year": settings.ACS_YEAR_NUMERIC,
+        "past_year": settings.ACS_PAST_YEAR_NUMERIC,
+        "ACS_YEAR_NUMERIC": settings.ACS_YEAR_NUMERIC,
+        "API_URL": settings.API_URL,
+        "profile_data_current_year": without_profile_json(present_profile),
+        "profile_data_past_year": without_profile_json(past_profile),
+    })
+
+
+def geography_section(request, section_key):
+    """
+    One section of the profile as JSON, so the page can fetch the sections
+    above the fold first and the rest as they're scrolled to.
+    """
+    try:
+        timeframe = TimeFrame(request.GET.get("timeframe", TimeFrame.PRESENT.value))
+    except ValueError:
+        return HttpResponseBadRequest(
+            f"The timeframe must be one of {', '.join(t.value for t in TimeFrame)}."
+        )
+
+    section_request = ProfileRequest(
+        geoid=request.GET.get("geoid", "06000US2616322000"),
+        timeframe=timeframe,
+    )
+
+    match geo_section(section_request, section_key):
+        case Success(section):
+            return JsonResponse(section, encoder=LazyEncoder)
+        case Failure(ProfileFailureModes.NO_SECTION_AVAILABLE):
+            raise Http404(f"There is no section called {section_key}.")
+        case Failure(ProfileFailureModes.NO_PROFILE_AVAILABLE):
+            raise Http404("There is no profile to take the section from.")
+        case Failure(reason):
+            return unavailable_response(ProfileUnavailable(reason))
+
+
 def homepage(_):
     return HttpResponse(
         """